@@ -0,0 +1,121 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import hashlib, json, os, random, struct
+
+"""
+Scheduling of the change types of action scenes. Every action pair changes
+one property of one object or deliberately leaves it unchanged, which gives
+six change types; their names are the keys of the count file written by
+render_images.py (position changes are counted as "size" changes, as in the
+question templates).
+
+ChangeScheduler picks the change type of the next pair so that the achieved
+counts follow a target distribution. Without a seed it picks the type that is
+furthest below its target share, given the counts so far; these are loaded
+from the count file when a run is resumed. With a seed, image indices are
+split into blocks of PLAN_BLOCK_SIZE and every block gets a shuffled plan
+holding each type in proportion to its target, so the type of an image only
+depends on the seed and its index.
+"""
+
+
+# Change type -> (property, whether it is changed)
+CHANGE_TYPES = {
+  'size_changed': ('position', True),
+  'size_unchanged': ('position', False),
+  'color_changed': ('color', True),
+  'color_unchanged': ('color', False),
+  'mat_changed': ('material', True),
+  'mat_unchanged': ('material', False),
+}
+
+# Number of images per plan when seeded; divisible by 2, 3, 4, 5, 6 and 8 so
+# that common distributions are met exactly within every block
+PLAN_BLOCK_SIZE = 120
+
+
+def parse_distribution(text):
+  """
+  Parse a target distribution such as "size_changed=2,color_changed=1".
+  Weights are relative and change types that are not listed get weight 0; an
+  empty string gives the uniform distribution over all change types.
+  """
+  if not text:
+    return {name: 1.0 for name in CHANGE_TYPES}
+  weights = {name: 0.0 for name in CHANGE_TYPES}
+  for item in text.split(','):
+    name, sep, weight = item.partition('=')
+    name = name.strip()
+    if name not in CHANGE_TYPES or not sep:
+      raise ValueError('Expected <change type>=<weight> with a change type '
+                       'from %s, got "%s"' % (', '.join(sorted(CHANGE_TYPES)),
+                                               item))
+    weights[name] = float(weight)
+  if any(w < 0 for w in weights.values()) or sum(weights.values()) <= 0:
+    raise ValueError('Change type weights must be non-negative and not all 0')
+  return weights
+
+
+def load_counts(path):
+  """ Read the counts of a count file, or None if there is none """
+  if not os.path.isfile(path):
+    return None
+  try:
+    with open(path, 'r') as f:
+      return json.load(f)
+  except ValueError:
+    return None
+
+
+class ChangeScheduler(object):
+  def __init__(self, weights, counts=None, seed=None):
+    total = float(sum(weights.values()))
+    self.target = {name: weights.get(name, 0) / total for name in CHANGE_TYPES}
+    self.counts = {name: 0 for name in CHANGE_TYPES}
+    for name, count in (counts or {}).items():
+      if name in self.counts:
+        self.counts[name] = count
+    self.seed = seed
+    self._plan_block = None
+    self._plan = None
+
+  def next(self, index):
+    """ The change type for the image with the given index """
+    if self.seed is not None:
+      block, offset = divmod(index, PLAN_BLOCK_SIZE)
+      if block != self._plan_block:
+        self._plan = self.plan(block)
+        self._plan_block = block
+      return self._plan[offset]
+    total = sum(self.counts.values()) + 1
+    gaps = [(self.target[name] * total - self.counts[name], name)
+            for name in sorted(CHANGE_TYPES) if self.target[name] > 0]
+    largest = max(gap for gap, _ in gaps)
+    return random.choice([name for gap, name in gaps if gap >= largest - 1e-9])
+
+  def plan(self, block):
+    """
+    The change types of one block of images: each type appears in proportion
+    to its target, with the remainders going to the largest fractions.
+    """
+    quotas = {name: self.target[name] * PLAN_BLOCK_SIZE for name in CHANGE_TYPES}
+    plan = []
+    for name in sorted(CHANGE_TYPES):
+      plan += [name] * int(quotas[name])
+    by_remainder = sorted(CHANGE_TYPES,
+                          key=lambda name: (int(quotas[name]) - quotas[name],
+                                            name))
+    plan += by_remainder[:PLAN_BLOCK_SIZE - len(plan)]
+    text = '%d:changes:%d' % (self.seed, block)
+    digest = hashlib.sha256(text.encode('utf-8')).digest()
+    random.Random(struct.unpack('<I', digest[:4])[0]).shuffle(plan)
+    return plan
+
+  def record(self, name, count=1):
+    """ Count a finished pair with the given change type """
+    self.counts[name] += count
@@ -5,15 +5,36 @@
 # LICENSE file in the root directory of this source tree. An additional grant
 # of patent rights can be found in the PATENTS file in the same directory.
 
-import argparse, json, os, time
+import argparse, errno, hashlib, json, os, re, time
+from multiprocessing import Pool
 from shutil import copyfile as cp
 
+import io_utils
+
 """
 During rendering, each CLEVR scene file is dumped to disk as a separate JSON
 file; this is convenient for distributing rendering across multiple machines.
 This script collects all CLEVR scene files stored in a directory and combines
 them into a single JSON file. This script also adds the version number, date,
 and license to the output file.
+
+Scene files are parsed by a pool of --num_workers processes and the combined
+file is written as the scenes come in. With --incremental 1 an index of the
+joined files (name, mtime and size) is kept next to the output file; when only
+scenes with higher image indices were added since the last join, they are
+appended to the existing output instead of joining everything again.
+
+Reindexing (--func reindex) hardlinks or renames the images instead of
+copying them (--link_mode) and rewrites the scene files in parallel. With
+--reindex_mode map nothing is moved at all; only a mapping table from the old
+file names to the new indices is written, which readers apply with
+reindex_scene.
+
+Validation (--func validate) pairs images and scenes by the split and index
+in their file names and checks their contents: scene files must parse and
+refer to existing images, and images must be complete PNGs with the
+resolution recorded in the scene. The mtime based check of earlier versions
+is still available with --validate_mode mtime.
 """
 
 parser = argparse.ArgumentParser()
@@ -30,117 +51,440 @@ parser.add_argument('--start_idx', type=int, default=None)
 parser.add_argument('--func', required=True, type=str)
 parser.add_argument('--action', default=1, type=int)
 parser.add_argument('--time_threshold', default=20, type=int)
-
-def renum_cb_index(args):
-  os.system("mkdir %s" % args.output_dir)
-  os.system("mkdir %s" % os.path.join(args.output_dir, "scenes"))
-  os.system("mkdir %s" % os.path.join(args.output_dir, "images"))
-
+parser.add_argument('--num_workers', default=8, type=int,
+    help="Number of processes used to read scene files")
+parser.add_argument('--incremental', default=0, type=int,
+    help="Setting --incremental 1 appends new scenes to an existing " +
+         "--output_file instead of joining all scene files again")
+parser.add_argument('--index_file', default=None,
+    help="Index of the files joined into --output_file, used by " +
+         "--incremental 1. Defaults to --output_file with .index appended.")
+parser.add_argument('--link_mode', default='hardlink',
+    choices=['hardlink', 'rename', 'copy'],
+    help="How reindexed images are placed in --output_dir. hardlink and " +
+         "rename fall back to copying across filesystems.")
+parser.add_argument('--validate_mode', default='content',
+    choices=['content', 'mtime'],
+    help="content checks the files themselves; mtime only checks that the " +
+         "files of each sample were written within --time_threshold seconds")
+parser.add_argument('--width', default=None, type=int,
+    help="Expected image width for scenes without render_info")
+parser.add_argument('--height', default=None, type=int,
+    help="Expected image height for scenes without render_info")
+parser.add_argument('--checksum', default=0, type=int,
+    help="Setting --checksum 1 adds the SHA-1 of every file to the report")
+parser.add_argument('--report_file', default=None,
+    help="Write the validation report as JSON to this file")
+parser.add_argument('--reindex_mode', default='files', choices=['files', 'map'],
+    help="With --reindex_mode map, reindex only writes a mapping table " +
+         "(old file name -> new index and file names) to " +
+         "--output_dir/CLEVR_<split>_reindex.json instead of new files.")
+
+def place_file(src, dst, link_mode='hardlink'):
+  """
+  Put the file src at dst by hardlinking, renaming or copying it. Links and
+  renames that fail because src and dst are on different filesystems fall
+  back to a copy.
+  """
+  if os.path.lexists(dst):
+    os.remove(dst)
+  try:
+    if link_mode == 'hardlink':
+      os.link(src, dst)
+      return
+    elif link_mode == 'rename':
+      os.rename(src, dst)
+      return
+  except OSError as e:
+    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+      raise
+  cp(src, dst)
+  if link_mode == 'rename':
+    os.remove(src)
+
+
+def reindex_scene(scene, entry):
+  """
+  Apply a reindex entry (from the mapping table or computed by reindex) to a
+  scene loaded from the file entry['scene'].
+  """
+  scene['image_index'] = entry['image_index']
+  scene['image_filename'] = entry['image_filename']
+  if 'cor_image_filename' in entry:
+    scene['cor_image_filename'] = entry['cor_image_filename']
+  return scene
+
+
+def rewrite_scene(job):
+  src, dst, entry = job
+  with open(src, 'r') as f:
+    scene = json.load(f)
+  with open(dst, 'w') as f:
+    json.dump(reindex_scene(scene, entry), f)
+
+
+def reindex_entries(args):
+  """
+  List the files of args.split in sorted order with their new index and file
+  names. For cb scenes the image names are those of the new and cor images;
+  other splits also get the matching image of the same split.
+  """
   num_digits = 6
   img_template = 'CLEVR_%%s_%%0%dd.png' % (num_digits)
-  scene_template = 'CLEVR_%%s_%%0%dd.json' % (num_digits)
   all_scenes = [x for x in os.listdir(args.input_scene_dir) if x.endswith('.json') and args.split in x]
   all_scenes = sorted(all_scenes)
+  if args.split != 'cb':
+    all_images = [x for x in os.listdir(args.input_image_dir) if x.endswith('.png') and args.split in x]
+    all_images = sorted(all_images)
+    assert len(all_images) == len(all_scenes)
 
-  scene_dir = os.path.join(args.output_dir, "scenes")
-
+  entries = []
   for i, old_scn_name in enumerate(all_scenes):
-    new_img_name = img_template % ("new", i + args.start_idx)
-    cor_img_name = img_template % ("cor", i + args.start_idx)
-    new_scn_name = scene_template % (args.split, i + args.start_idx)
-
-    # load json
-    js = json.load(open(os.path.join(args.input_scene_dir, old_scn_name)))
-    js['image_index'] = (i + args.start_idx)
-    js['image_filename'] = new_img_name
-    js['cor_image_filename'] = cor_img_name
-    json.dump(js, open(os.path.join(scene_dir, new_scn_name), 'w'))
-
-
-def renum_index(args):
-  os.system("mkdir %s" % args.output_dir)
-  os.system("mkdir %s" % os.path.join(args.output_dir, "scenes"))
-  os.system("mkdir %s" % os.path.join(args.output_dir, "images"))
-
-  num_digits = 6
-  img_template = 'CLEVR_%s_%%0%dd.png' % (args.split, num_digits)
-  scene_template = 'CLEVR_%s_%%0%dd.json' % (args.split, num_digits)
-
-  # load reindexing files
-  all_images = [x for x in os.listdir(args.input_image_dir) if x.endswith('.png') and args.split in x]
-  all_images = sorted(all_images)
-  all_scenes = [x for x in os.listdir(args.input_scene_dir) if x.endswith('.json') and args.split in x]
-  all_scenes = sorted(all_scenes)
-
+    new_index = i + args.start_idx
+    entry = {
+      'scene': old_scn_name,
+      'image_index': new_index,
+      'scene_filename': 'CLEVR_%s_%0*d.json' % (args.split, num_digits, new_index),
+    }
+    if args.split == 'cb':
+      entry['image_filename'] = img_template % ("new", new_index)
+      entry['cor_image_filename'] = img_template % ("cor", new_index)
+    else:
+      old_img_name = all_images[i]
+      assert os.path.splitext(old_img_name)[0] == os.path.splitext(old_scn_name)[0]
+      entry['image'] = old_img_name
+      entry['image_filename'] = img_template % (args.split, new_index)
+    entries.append(entry)
+  return entries
+
+
+def reindex(args):
+  entries = reindex_entries(args)
+  if not os.path.isdir(args.output_dir):
+    os.makedirs(args.output_dir)
+  if args.reindex_mode == 'map':
+    map_file = os.path.join(args.output_dir, 'CLEVR_%s_reindex.json' % args.split)
+    io_utils.write_json(map_file, {'split': args.split, 'entries': entries})
+    print('Wrote mapping for %d files to %s' % (len(entries), map_file))
+    return
+
+  # Only the directories that files are placed in are created
   scene_dir = os.path.join(args.output_dir, "scenes")
   image_dir = os.path.join(args.output_dir, "images")
-
-  for i, (old_img_name, old_scn_name) in enumerate(zip(all_images, all_scenes)):
-    assert os.path.splitext(old_img_name)[0] == os.path.splitext(old_scn_name)[0]
-    new_img_name = img_template % (i + args.start_idx)
-    new_scn_name = scene_template % (i + args.start_idx)
-
-    # load json
-    js = json.load(open(os.path.join(args.input_scene_dir, old_scn_name)))
-    js['image_index'] = (i + args.start_idx)
-    js['image_filename'] = new_img_name
-    json.dump(js, open(os.path.join(scene_dir, new_scn_name), 'w'))
-
-    cp(os.path.join(args.input_image_dir, old_img_name), os.path.join(image_dir, new_img_name))
+  dirs = [scene_dir] if entries else []
+  if any('image' in entry for entry in entries):
+    dirs.append(image_dir)
+  for d in dirs:
+    if not os.path.isdir(d):
+      os.makedirs(d)
+
+  for entry in entries:
+    if 'image' in entry:
+      place_file(os.path.join(args.input_image_dir, entry['image']),
+                 os.path.join(image_dir, entry['image_filename']),
+                 args.link_mode)
+
+  jobs = [(os.path.join(args.input_scene_dir, entry['scene']),
+           os.path.join(scene_dir, entry['scene_filename']), entry)
+          for entry in entries]
+  if args.num_workers > 1 and len(jobs) > 1:
+    pool = Pool(args.num_workers)
+    try:
+      pool.map(rewrite_scene, jobs, chunksize=32)
+    finally:
+      pool.terminate()
+  else:
+    for job in jobs:
+      rewrite_scene(job)
+  print('Reindexed %d files' % len(entries))
+
+
+def scene_file_index(filename):
+  """ The image index in a scene filename such as CLEVR_new_000042.json """
+  return int(os.path.splitext(filename)[0].split('_')[-1])
+
+
+def read_scene(path):
+  """
+  Load a scene file and return its split, image index and JSON text as
+  json.dump would write it inside the combined file.
+  """
+  with open(path, 'r') as f:
+    scene = json.load(f)
+  return scene['split'], scene['image_index'], json.dumps(scene)
+
+
+def file_stat(path):
+  st = os.stat(path)
+  return [st.st_mtime, st.st_size]
+
+
+def read_join_index(args, info, filenames):
+  """
+  Decide how much of a previous join can be reused. Returns the list of
+  filenames to append to the existing output file, or None if the output has
+  to be rebuilt: because there is no usable index, the output file changed
+  since it was written, the info block differs, a joined file changed or
+  disappeared, or a new file sorts before the last joined one.
+  """
+  try:
+    with open(args.index_file, 'r') as f:
+      index = json.load(f)
+  except (IOError, OSError, ValueError):
+    return None
+  if not os.path.isfile(args.output_file) or \
+      os.path.getsize(args.output_file) != index['output_size']:
+    return None
+  if any(index['info'].get(k) != v for k, v in info.items()
+         if k != 'split' or v is not None):
+    return None
+  joined = index['files']
+  present = set(filenames)
+  for filename, stat in joined.items():
+    if filename not in present or \
+        file_stat(os.path.join(args.input_scene_dir, filename)) != stat:
+      return None
+  new_files = [f for f in filenames if f not in joined]
+  if new_files and joined and \
+      scene_file_index(new_files[0]) <= index['max_index']:
+    return None
+  return new_files
+
+
+def write_header(out, info):
+  out.write(('{"info": %s, "scenes": [' % json.dumps(info)).encode('utf-8'))
+
+
+def join_scene_files(args, filenames, info, check_split=False):
+  """
+  Join the scene files in args.input_scene_dir named in filenames, which must
+  be sorted by image index, into args.output_file. The files are parsed in
+  parallel and written out in order as they are parsed, so the scenes are
+  never all in memory at once. If info['split'] is None it is taken from the
+  first scene; with check_split all scenes must have the same split.
+  """
+  if args.index_file is None:
+    args.index_file = args.output_file + '.index'
+
+  new_files = None
+  if args.incremental:
+    new_files = read_join_index(args, info, filenames)
+  append = new_files is not None
+  if append:
+    with open(args.index_file, 'r') as f:
+      index = json.load(f)
+    split = index['info']['split']
+  else:
+    new_files = filenames
+    index = {'files': {}, 'max_index': -1}
+    split = info['split']
+  num_joined = len(index['files'])
+
+  paths = [os.path.join(args.input_scene_dir, f) for f in new_files]
+  pool = None
+  if args.num_workers > 1 and len(paths) > 1:
+    pool = Pool(args.num_workers)
+    results = pool.imap(read_scene, paths, chunksize=32)
+  else:
+    results = map(read_scene, paths)
+
+  try:
+    if append:
+      # Overwrite the closing "]}" of the previous join
+      out = open(args.output_file, 'r+b')
+      out.seek(-2, os.SEEK_END)
+      if out.read(2) != b']}':
+        raise ValueError('%s does not end with a scene list' % args.output_file)
+      out.seek(-2, os.SEEK_END)
+    else:
+      out = open(io_utils.temp_path(args.output_file), 'wb')
+    with out:
+      count = num_joined
+      for filename, (scene_split, image_index, text) in zip(new_files, results):
+        if split is None:
+          split = scene_split
+        if check_split:
+          msg = 'Input directory contains scenes from multiple splits'
+          assert scene_split == split, msg
+        if count == 0 and not append:
+          write_header(out, dict(info, split=split))
+        elif count > 0:
+          out.write(b', ')
+        out.write(text.encode('utf-8'))
+        count += 1
+        index['files'][filename] = file_stat(
+            os.path.join(args.input_scene_dir, filename))
+        index['max_index'] = max(index['max_index'],
+                                 scene_file_index(filename))
+      if count == 0 and not append:
+        write_header(out, dict(info, split=split))
+      out.write(b']}')
+  finally:
+    if pool is not None:
+      pool.terminate()
+  if not append:
+    os.replace(io_utils.temp_path(args.output_file), args.output_file)
+
+  index['info'] = dict(info, split=split)
+  index['output_size'] = os.path.getsize(args.output_file)
+  io_utils.write_json(args.index_file, index)
+  print('Joined %d scenes into %s (%d new)'
+        % (count, args.output_file, count - num_joined))
 
 
 def join_json_based_on_split(args):
   relevant_files = [x for x in os.listdir(args.input_scene_dir) if args.split in x and x.endswith(".json")]
   relevant_files = sorted(relevant_files)
 
-  all_scenes = []
-  for filename in relevant_files:
-    js = json.load(open(os.path.join(args.input_scene_dir, filename)))
-    all_scenes.append(js)
-  output = {
-    'info': {
-      'date': args.date,
-      'version': args.version,
-      'split': args.split,
-      'license': args.license,
-    },
-    'scenes': all_scenes
+  info = {
+    'date': args.date,
+    'version': args.version,
+    'split': args.split,
+    'license': args.license,
   }
-  with open(args.output_file, 'w') as f:
-    json.dump(output, f)
+  join_scene_files(args, relevant_files, info)
 
 
 def join_json(args):
   # folder that only contains a split
-  input_files = os.listdir(args.input_scene_dir)
-  scenes = []
-  split = None
-  for filename in os.listdir(args.input_scene_dir):
-    if not filename.endswith('.json'):
+  input_files = [x for x in os.listdir(args.input_scene_dir)
+                 if x.endswith('.json')]
+  input_files.sort(key=scene_file_index)
+  info = {
+    'date': args.date,
+    'version': args.version,
+    'split': None,
+    'license': args.license,
+  }
+  join_scene_files(args, input_files, info, check_split=True)
+
+
+FILENAME_RE = re.compile(r'^.+_(?P<split>[^_]+)_(?P<index>\d+)\.(?P<ext>png|json)$')
+
+
+def index_files(directory, ext):
+  """ Map (split, index) to the path of every file with extension ext """
+  files = {}
+  for filename in os.listdir(directory):
+    m = FILENAME_RE.match(filename)
+    if m is not None and m.group('ext') == ext:
+      key = (m.group('split'), int(m.group('index')))
+      files[key] = os.path.join(directory, filename)
+  return files
+
+
+def sha1(path):
+  h = hashlib.sha1()
+  with open(path, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      h.update(block)
+  return h.hexdigest()
+
+
+def validate_sample(job):
+  """
+  Check the files of one sample. job is (index, images, scenes, main_split,
+  image_dir, width, height, checksum) where images and scenes map splits to
+  paths (None if missing); main_split is the split of the scene whose image
+  references are followed. Returns a dict with the errors found and, with
+  checksum, the SHA-1 of each file.
+  """
+  index, images, scenes, main_split, image_dir, width, height, checksum = job
+  errors = []
+  result = {'image_index': index, 'split': main_split, 'errors': errors}
+
+  size = None
+  for split, path in sorted(scenes.items()):
+    if path is None:
+      errors.append('missing %s scene' % split)
       continue
-    path = os.path.join(args.input_scene_dir, filename)
-    with open(path, 'r') as f:
-      scene = json.load(f)
-    scenes.append(scene)
-    if split is not None:
-      msg = 'Input directory contains scenes from multiple splits'
-      assert scene['split'] == split, msg
-    else:
-      split = scene['split']
-  scenes.sort(key=lambda s: s['image_index'])
-  for s in scenes:
-    print(s['image_filename'])
-  output = {
-    'info': {
-      'date': args.date,
-      'version': args.version,
-      'split': split,
-      'license': args.license,
-    },
-    'scenes': scenes
+    try:
+      with open(path, 'r') as f:
+        scene = json.load(f)
+    except (IOError, OSError, ValueError) as e:
+      errors.append('%s scene does not parse: %s' % (split, e))
+      continue
+    if scene.get('image_index') != index:
+      errors.append('%s scene has image_index %r'
+                    % (split, scene.get('image_index')))
+    render_info = scene.get('render_info') or {}
+    if 'width' in render_info:
+      size = (render_info['width'], render_info['height'])
+    if split == main_split:
+      for key in ['image_filename', 'cor_image_filename']:
+        if key in scene and \
+            not os.path.isfile(os.path.join(image_dir, scene[key])):
+          errors.append('%s of %s scene does not exist: %s'
+                        % (key, split, scene[key]))
+  if size is None and width is not None:
+    size = (width, height)
+
+  for split, path in sorted(images.items()):
+    if path is None:
+      errors.append('missing %s image' % split)
+      continue
+    png_size = io_utils.read_png_size(path)
+    if png_size is None:
+      errors.append('%s image is not a complete PNG' % split)
+    elif size is not None and tuple(png_size) != tuple(size):
+      errors.append('%s image is %dx%d instead of %dx%d'
+                    % ((split,) + tuple(png_size) + tuple(size)))
+
+  if checksum:
+    paths = [p for p in list(images.values()) + list(scenes.values()) if p]
+    result['sha1'] = {os.path.basename(p): sha1(p) for p in paths}
+  return result
+
+
+def validate_contents(args):
+  images = index_files(args.input_image_dir, 'png')
+  scenes = index_files(args.input_scene_dir, 'json')
+
+  # Every sample is identified by one of its scene or image files; all other
+  # files of the sample are looked up by split and index
+  if args.action == 1:
+    samples = [(['new', 'cor'], ['new', 'cor', 'cb'], 'cb', index)
+               for index in sorted(set(i for _, i in list(images) + list(scenes)))]
+  else:
+    keys = sorted(set(images) | set(scenes), key=lambda k: (k[1], k[0]))
+    samples = [([split], [split], split, index) for split, index in keys]
+
+  jobs = []
+  for image_splits, scene_splits, main_split, index in samples:
+    jobs.append((index,
+                 {s: images.get((s, index)) for s in image_splits},
+                 {s: scenes.get((s, index)) for s in scene_splits},
+                 main_split, args.input_image_dir, args.width, args.height,
+                 args.checksum))
+
+  if args.num_workers > 1 and len(jobs) > 1:
+    pool = Pool(args.num_workers)
+    try:
+      results = pool.map(validate_sample, jobs, chunksize=32)
+    finally:
+      pool.terminate()
+  else:
+    results = [validate_sample(job) for job in jobs]
+
+  failed = [r for r in results if r['errors']]
+  report = {
+    'num_samples': len(results),
+    'num_failed': len(failed),
+    'failed': failed,
   }
-  with open(args.output_file, 'w') as f:
-    json.dump(output, f)
+  if args.checksum:
+    report['sha1'] = {}
+    for r in results:
+      report['sha1'].update(r['sha1'])
+  if args.report_file is not None:
+    io_utils.write_json(args.report_file, report, indent=2, sort_keys=True)
+
+  print('Validated %d samples, %d failed' % (len(results), len(failed)))
+  for r in failed[:10]:
+    print('%s %d: %s' % (r['split'], r['image_index'], '; '.join(r['errors'])))
+  if failed:
+    raise ValueError("Error: %d of %d samples are invalid"
+                     % (len(failed), len(results)))
 
 
 def validate_files(args):
@@ -188,7 +532,10 @@ if __name__ == '__main__':
   args = parser.parse_args()
 
   if args.func == 'validate':
-    validate_files(args)
+    if args.validate_mode == 'content':
+      validate_contents(args)
+    else:
+      validate_files(args)
 
   elif args.func == "reindex":
 
@@ -197,10 +544,7 @@ if __name__ == '__main__':
     if args.split == None:
       raise ValueError("Please Enter your split.")
 
-    if args.split == "cb":
-      renum_cb_index(args)
-    else:
-      renum_index(args)
+    reindex(args)
 
   elif args.func == "join_split":
     if args.split == None:
@@ -0,0 +1,401 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json, os, struct, threading, zlib
+
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import numpy as np
+
+"""
+Utilities for reading and writing rendered outputs. Nothing in here depends on
+Blender, so these functions can be used both from render_images.py and from
+standalone tools such as render_farm.py and collect_scenes.py.
+
+AsyncImageWriter moves PNG encoding out of the render loop: Blender writes an
+uncompressed TGA, and a background thread compresses it to a PNG while the
+next scene is being set up and rendered. zlib releases the GIL while it
+compresses, so the encoding really runs in parallel with Blender.
+"""
+
+
+PNG_SIGNATURE = b'\x89PNG\r\n\x1a\n'
+PNG_IEND = b'\x00\x00\x00\x00IEND\xaeB`\x82'
+
+
+def temp_path(path, tag='tmp'):
+  """
+  Return a hidden temporary path in the same directory as path; different tags
+  give different temporary paths for the same file. The extension is kept so
+  that programs which infer the file format from it (like Blender) still write
+  the right format. Being in the same directory guarantees that the final
+  os.replace is an atomic rename on the same filesystem.
+  """
+  dirname, basename = os.path.split(path)
+  return os.path.join(dirname, '.%s_%s' % (tag, basename))
+
+
+def write_json(path, obj, **kwargs):
+  """
+  Atomically write obj as JSON to path; extra kwargs go to json.dump. Readers
+  either see the previous file or the complete new one, never a partial one.
+  """
+  tmp = temp_path(path)
+  with open(tmp, 'w') as f:
+    json.dump(obj, f, **kwargs)
+  os.replace(tmp, path)
+
+
+def read_png_size(path):
+  """
+  Return (width, height) of a PNG file, or None if the file is missing, does
+  not start with a PNG header or does not end with the IEND chunk (which is
+  the case for files truncated by a crash).
+  """
+  try:
+    with open(path, 'rb') as f:
+      header = f.read(24)
+      if len(header) < 24 or header[:8] != PNG_SIGNATURE \
+          or header[12:16] != b'IHDR':
+        return None
+      f.seek(-len(PNG_IEND), os.SEEK_END)
+      if f.read() != PNG_IEND:
+        return None
+  except (IOError, OSError):
+    return None
+  return struct.unpack('>II', header[16:24])
+
+
+def is_valid_png(path, width=None, height=None):
+  """ Check that path is a complete PNG, optionally of the given size """
+  size = read_png_size(path)
+  if size is None:
+    return False
+  if width is not None and size[0] != width:
+    return False
+  if height is not None and size[1] != height:
+    return False
+  return True
+
+
+def is_valid_json(path):
+  """ Check that path exists and parses as JSON """
+  try:
+    with open(path, 'r') as f:
+      json.load(f)
+  except (IOError, OSError, ValueError):
+    return False
+  return True
+
+
+class SceneLog(object):
+  """
+  Append-only log of scene structures, written as one compact JSON object per
+  line. A record is only complete once its trailing newline has been written,
+  so a crash can at worst leave a torn last line, which readers skip.
+
+  Every line is {"output_split": split, "scene": scene_struct}, where split is
+  the output the scene belongs to (e.g. new, cor or cb) and not necessarily
+  the scene's own "split" field: the cb scene of an action pair describes the
+  new image and keeps its split. The last record of every output split is
+  kept and returned by last_record.
+  """
+  def __init__(self, path):
+    self.path = path
+    self.f = None
+    self.last = {}
+
+  def append(self, split, scene_struct):
+    if self.f is None:
+      self.f = open(self.path, 'a')
+    record = json.dumps(scene_struct, separators=(',', ':'))
+    self.f.write('%s%s}\n' % (_log_prefix(split).decode('utf-8'), record))
+    self.f.flush()
+    self.last[split] = (scene_struct['image_index'], record)
+
+  def last_record(self, split, image_index):
+    """
+    The JSON text of the scene of split that was appended last, or None if
+    that is not the scene of image_index
+    """
+    index, record = self.last.get(split, (None, None))
+    return record if index == image_index else None
+
+  def close(self):
+    if self.f is not None:
+      self.f.close()
+      self.f = None
+
+
+def _log_prefix(split):
+  """ The bytes of a scene log line in front of the scene record """
+  return ('{"output_split":%s,"scene":' % json.dumps(split)).encode('utf-8')
+
+
+def scan_scene_log(path, entries=None):
+  """
+  Index the complete records of a scene log. Returns a dict mapping
+  (output split, image_index) to (path, offset, length) of the bytes of the
+  scene record; if a scene was logged more than once the last record wins.
+  Pass the dict returned for one log as entries to merge several logs into
+  one index.
+  """
+  if entries is None:
+    entries = {}
+  if not os.path.isfile(path):
+    return entries
+  with open(path, 'rb') as f:
+    offset = 0
+    for line in f:
+      if line.endswith(b'\n'):
+        try:
+          entry = json.loads(line.decode('utf-8'))
+          key = (entry['output_split'], entry['scene']['image_index'])
+          prefix = _log_prefix(entry['output_split'])
+          if line.startswith(prefix):
+            # The record without the prefix and the closing brace
+            entries[key] = (path, offset + len(prefix),
+                            len(line) - len(prefix) - 2)
+        except (ValueError, KeyError, TypeError):
+          pass
+      offset += len(line)
+  return entries
+
+
+def write_scenes_from_log(output_path, info, entries, keys):
+  """
+  Atomically write a combined scene file {"info": info, "scenes": [...]} whose
+  scenes are the logged records for keys, in order. entries is an index from
+  scan_scene_log; records are copied byte for byte from the logs without
+  being parsed again.
+  """
+  tmp = temp_path(output_path)
+  logs = {}
+  try:
+    with open(tmp, 'wb') as out:
+      out.write(b'{"info": ' + json.dumps(info).encode('utf-8') +
+                b', "scenes": [')
+      for i, key in enumerate(keys):
+        path, offset, length = entries[key]
+        if path not in logs:
+          logs[path] = open(path, 'rb')
+        logs[path].seek(offset)
+        if i > 0:
+          out.write(b', ')
+        out.write(logs[path].read(length))
+      out.write(b']}')
+  finally:
+    for f in logs.values():
+      f.close()
+  os.replace(tmp, output_path)
+
+
+def read_tga(path):
+  """
+  Read an uncompressed true-color TGA file (as written by Blender for the
+  TARGA_RAW format) into a uint8 array of shape (height, width, channels) with
+  the top row first and channels in RGB(A) order.
+  """
+  with open(path, 'rb') as f:
+    data = f.read()
+  id_length, colormap_type, image_type = struct.unpack('<BBB', data[:3])
+  colormap_length, colormap_depth = struct.unpack('<HB', data[5:8])
+  width, height, depth, descriptor = struct.unpack('<HHBB', data[12:18])
+  if image_type != 2 or depth not in (24, 32):
+    raise ValueError('%s is not an uncompressed 24 or 32 bit TGA' % path)
+  offset = 18 + id_length
+  if colormap_type:
+    offset += colormap_length * ((colormap_depth + 7) // 8)
+  c = depth // 8
+  pixels = np.frombuffer(data, dtype=np.uint8, count=width * height * c,
+                         offset=offset).reshape(height, width, c)
+  # TGA stores BGR(A) and, unless bit 5 of the descriptor is set, the bottom
+  # row first
+  pixels = pixels[:, :, [2, 1, 0, 3][:c]]
+  if not descriptor & 0x20:
+    pixels = pixels[::-1]
+  return np.ascontiguousarray(pixels)
+
+
+def _png_chunk(chunk_type, data):
+  crc = zlib.crc32(chunk_type + data) & 0xffffffff
+  return struct.pack('>I', len(data)) + chunk_type + data + \
+         struct.pack('>I', crc)
+
+
+def encode_png(pixels, compress_level=6):
+  """
+  Encode a uint8 array of shape (height, width, 3 or 4) as an 8 bit RGB or
+  RGBA PNG and return its bytes. Every row uses the Up filter, which suits
+  rendered images with smooth vertical gradients.
+  """
+  h, w, c = pixels.shape
+  color_type = {3: 2, 4: 6}[c]
+  rows = pixels.reshape(h, w * c)
+  filtered = np.empty((h, w * c + 1), dtype=np.uint8)
+  filtered[:, 0] = 2
+  filtered[0, 1:] = rows[0]
+  # uint8 arithmetic wraps around, which is exactly the modulo 256 the
+  # filter needs
+  np.subtract(rows[1:], rows[:-1], out=filtered[1:, 1:])
+  ihdr = struct.pack('>IIBBBBB', w, h, 8, color_type, 0, 0, 0)
+  idat = zlib.compress(filtered.tobytes(), compress_level)
+  return PNG_SIGNATURE + _png_chunk(b'IHDR', ihdr) + \
+         _png_chunk(b'IDAT', idat) + _png_chunk(b'IEND', b'')
+
+
+def _unfilter_row(filter_type, row, prev, bpp):
+  """ Undo the PNG filter of one row in place (row and prev are bytearrays) """
+  n = len(row)
+  if filter_type == 3:
+    for i in range(n):
+      left = row[i - bpp] if i >= bpp else 0
+      row[i] = (row[i] + ((left + prev[i]) >> 1)) & 0xff
+  elif filter_type == 4:
+    for i in range(n):
+      a = row[i - bpp] if i >= bpp else 0
+      b = prev[i]
+      c = prev[i - bpp] if i >= bpp else 0
+      p = a + b - c
+      pa, pb, pc = abs(p - a), abs(p - b), abs(p - c)
+      if pa <= pb and pa <= pc:
+        pred = a
+      elif pb <= pc:
+        pred = b
+      else:
+        pred = c
+      row[i] = (row[i] + pred) & 0xff
+
+
+def read_png(path):
+  """
+  Read an 8 bit, non-interlaced RGB or RGBA PNG into a uint8 array of shape
+  (height, width, channels). Rows with the None, Sub and Up filters (all that
+  encode_png writes) are decoded with array operations; Average and Paeth
+  rows, as written by Blender, need a slower loop.
+  """
+  with open(path, 'rb') as f:
+    data = f.read()
+  if data[:8] != PNG_SIGNATURE:
+    raise ValueError('%s is not a PNG file' % path)
+  pos = 8
+  idat = []
+  header = None
+  while pos < len(data):
+    length, chunk_type = struct.unpack('>I4s', data[pos:pos + 8])
+    chunk = data[pos + 8:pos + 8 + length]
+    if chunk_type == b'IHDR':
+      header = struct.unpack('>IIBBBBB', chunk)
+    elif chunk_type == b'IDAT':
+      idat.append(chunk)
+    elif chunk_type == b'IEND':
+      break
+    pos += 12 + length
+  w, h, depth, color_type, _, _, interlace = header
+  if depth != 8 or color_type not in (2, 6) or interlace:
+    raise ValueError('%s is not an 8 bit non-interlaced RGB(A) PNG' % path)
+  c = {2: 3, 6: 4}[color_type]
+  raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8)
+  raw = raw.reshape(h, w * c + 1)
+  filters = raw[:, 0]
+  rows = raw[:, 1:].copy()
+  prev = np.zeros(w * c, dtype=np.uint8)
+  for y in range(h):
+    filter_type = filters[y]
+    if filter_type == 1:
+      # Sub: a running sum over the pixels of the row, modulo 256
+      row = rows[y].reshape(w, c).astype(np.uint32)
+      rows[y] = (np.cumsum(row, axis=0) & 0xff).astype(np.uint8).ravel()
+    elif filter_type == 2:
+      rows[y] += prev
+    elif filter_type in (3, 4):
+      row = bytearray(rows[y].tobytes())
+      _unfilter_row(filter_type, row, bytearray(prev.tobytes()), c)
+      rows[y] = np.frombuffer(bytes(row), dtype=np.uint8)
+    elif filter_type != 0:
+      raise ValueError('%s uses unknown PNG filter %d' % (path, filter_type))
+    prev = rows[y]
+  return rows.reshape(h, w, c)
+
+
+def convert_color_mode(pixels, color_mode=None):
+  """ Drop or add an (opaque) alpha channel to match color_mode """
+  if color_mode == 'RGB' and pixels.shape[2] == 4:
+    return pixels[:, :, :3]
+  if color_mode == 'RGBA' and pixels.shape[2] == 3:
+    alpha = np.full(pixels.shape[:2] + (1,), 255, dtype=np.uint8)
+    return np.concatenate([pixels, alpha], axis=2)
+  return pixels
+
+
+class AsyncImageWriter(object):
+  """
+  Encode and write images on a background thread. Jobs run in the order they
+  were submitted: submit() converts a raw TGA to a PNG and atomically moves
+  it into place, call() runs an arbitrary function once all earlier jobs are
+  done (e.g. to record that an image is finished). At most max_pending jobs
+  are queued; submit() blocks while the queue is full.
+
+  If a job fails, all later jobs are dropped and the error is raised from
+  the next submit(), call() or flush().
+  """
+  def __init__(self, compress_level=6, color_mode=None, max_pending=4):
+    self.compress_level = compress_level
+    self.color_mode = color_mode
+    self.jobs = queue.Queue(maxsize=max_pending)
+    self.error = None
+    self.thread = threading.Thread(target=self._run)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _run(self):
+    while True:
+      job = self.jobs.get()
+      try:
+        if job is None:
+          return
+        if self.error is None:
+          job[0](*job[1:])
+      except Exception as e:
+        self.error = e
+      finally:
+        self.jobs.task_done()
+
+  def _check(self):
+    if self.error is not None:
+      raise RuntimeError('Writing images failed: %r' % (self.error,))
+
+  def _write(self, raw_path, output_path):
+    pixels = convert_color_mode(read_tga(raw_path), self.color_mode)
+    data = encode_png(pixels, self.compress_level)
+    tmp = temp_path(output_path)
+    with open(tmp, 'wb') as f:
+      f.write(data)
+    os.replace(tmp, output_path)
+    os.remove(raw_path)
+
+  def submit(self, raw_path, output_path):
+    """ Queue the TGA at raw_path to be written as a PNG to output_path """
+    self._check()
+    self.jobs.put((self._write, raw_path, output_path))
+
+  def call(self, fn, *args):
+    self._check()
+    self.jobs.put((fn,) + args)
+
+  def flush(self):
+    """ Wait until every queued job is done """
+    self.jobs.join()
+    self._check()
+
+  def close(self):
+    self.flush()
+    self.jobs.put(None)
+    self.thread.join()
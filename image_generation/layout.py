@@ -0,0 +1,187 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import math, random
+
+import numpy as np
+
+"""
+Geometry of object layouts that does not need Blender. Objects are described
+by their (x, y, r) positions on the ground plane as in render_images.py, and
+the camera by a CameraModel, a plain pinhole model that can be serialized.
+
+Occlusion is estimated analytically: every object is approximated by a sphere
+of radius r resting on the ground, which projects to a disk, and the visible
+part of each disk is measured on a fixed set of sample points. The estimate
+is only used to screen out layouts before anything is rendered; the
+visibility render in render_images.py stays the final check.
+"""
+
+
+# Sample points covering the unit disk, used to measure visible disk areas
+_DISK_SAMPLES = np.array([(x, y) for x in np.linspace(-1, 1, 9)
+                          for y in np.linspace(-1, 1, 9)
+                          if x * x + y * y <= 1.0])
+
+
+class CameraModel(object):
+  """
+  A pinhole camera: matrix_world is the 4x4 camera to world matrix (the camera
+  looks along its -z axis with +y up, as in Blender), angle the field of view
+  along the larger image dimension, and width and height the image size in
+  pixels.
+  """
+  def __init__(self, matrix_world, angle, width, height):
+    self.matrix_world = np.array(matrix_world, dtype=np.float64)
+    self.angle = angle
+    self.width = width
+    self.height = height
+    self.world_to_camera = np.linalg.inv(self.matrix_world)
+    self.focal = 0.5 * max(width, height) / math.tan(0.5 * angle)
+
+  def to_dict(self):
+    return {
+      'matrix_world': self.matrix_world.tolist(),
+      'angle': self.angle,
+      'width': self.width,
+      'height': self.height,
+    }
+
+  @classmethod
+  def from_dict(cls, d):
+    return cls(d['matrix_world'], d['angle'], d['width'], d['height'])
+
+  def moved(self, location):
+    """ The same camera translated to location """
+    matrix_world = self.matrix_world.copy()
+    matrix_world[:3, 3] = location
+    return CameraModel(matrix_world, self.angle, self.width, self.height)
+
+  @property
+  def location(self):
+    return tuple(self.matrix_world[:3, 3].tolist())
+
+  def project(self, points):
+    """
+    Project an (N, 3) array of world points. Returns an (N, 3) array of pixel
+    x, y (origin at the top left, as in utils.get_camera_coords) and the
+    distance in front of the camera.
+    """
+    points = np.asarray(points, dtype=np.float64).reshape(-1, 3)
+    local = points.dot(self.world_to_camera[:3, :3].T) + self.world_to_camera[:3, 3]
+    depth = -local[:, 2]
+    safe = np.where(depth > 1e-6, depth, 1e-6)
+    px = 0.5 * self.width + self.focal * local[:, 0] / safe
+    py = 0.5 * self.height - self.focal * local[:, 1] / safe
+    return np.stack([px, py, depth], axis=1)
+
+
+def camera_directions(camera):
+  """
+  The six axis-aligned directions of a scene as seen from the camera, as
+  computed by render_images.py: left and behind are the camera's left and
+  viewing directions projected onto the ground plane.
+  """
+  rotation = camera.matrix_world[:3, :3]
+  behind = -rotation[:, 2]
+  left = -rotation[:, 0]
+  up = rotation[:, 1]
+  plane_behind = np.array([behind[0], behind[1], 0.0])
+  plane_behind /= np.linalg.norm(plane_behind)
+  plane_left = np.array([left[0], left[1], 0.0])
+  plane_left /= np.linalg.norm(plane_left)
+  plane_up = np.array([0.0, 0.0, 1.0 if up[2] >= 0 else -1.0])
+  directions = {}
+  for name, vec in [('behind', plane_behind), ('left', plane_left),
+                    ('above', plane_up)]:
+    directions[name] = tuple(vec.tolist())
+  directions['front'] = tuple((-plane_behind).tolist())
+  directions['right'] = tuple((-plane_left).tolist())
+  directions['below'] = tuple((-plane_up).tolist())
+  return directions
+
+
+def visible_pixels(positions, camera):
+  """
+  Estimate the number of visible pixels of every object: the area of its
+  projected disk that lies inside the image and is not covered by the disk
+  of an object nearer to the camera.
+  """
+  centers = np.array([(x, y, r) for x, y, r in positions], dtype=np.float64)
+  projected = camera.project(centers)
+  depth = projected[:, 2]
+  radius = camera.focal * centers[:, 2] / np.maximum(depth, 1e-6)
+  pixels = []
+  for i in range(len(positions)):
+    if depth[i] <= 0:
+      pixels.append(0.0)
+      continue
+    samples = projected[i, :2] + radius[i] * _DISK_SAMPLES
+    visible = ((samples[:, 0] >= 0) & (samples[:, 0] < camera.width) &
+               (samples[:, 1] >= 0) & (samples[:, 1] < camera.height))
+    for j in np.flatnonzero((depth < depth[i]) & (depth > 0)):
+      offset = samples - projected[j, :2]
+      visible &= (offset * offset).sum(axis=1) > radius[j] * radius[j]
+    area = math.pi * radius[i] * radius[i]
+    pixels.append(area * visible.mean())
+  return pixels
+
+
+def placement_ok(x, y, r, others, directions, min_dist, margin):
+  """
+  Check the placement rules of render_images.py for an object at (x, y) with
+  radius r: it keeps min_dist from all other objects and is more than margin
+  away from them along the four cardinal directions.
+  """
+  for (xx, yy, rr) in others:
+    dx, dy = x - xx, y - yy
+    if math.sqrt(dx * dx + dy * dy) - r - rr < min_dist:
+      return False
+    for name in ['left', 'right', 'front', 'behind']:
+      direction = directions[name]
+      m = dx * direction[0] + dy * direction[1]
+      if 0 < m < margin:
+        return False
+  return True
+
+
+def changes_relation(old, new, directions, eps):
+  """
+  Whether an object moved from old to new (both (x, y)) is related to its old
+  position along some cardinal direction, i.e. whether the move shows up in
+  the relationships computed with the same eps.
+  """
+  dx, dy = new[0] - old[0], new[1] - old[1]
+  return any(dx * directions[name][0] + dy * directions[name][1] > eps
+             for name in ['left', 'right', 'front', 'behind'])
+
+
+def sample_move(positions, index, directions, camera, min_dist, margin,
+                min_pixels, max_tries, eps=0.2, rng=random):
+  """
+  Find a new position for object index that keeps the placement rules,
+  changes at least one of its cardinal relations to its old position and
+  leaves every object with an estimated min_pixels visible pixels.
+
+  Returns ((x, y), num_tries), with None instead of the position if no
+  candidate passed within max_tries.
+  """
+  px, py, r = positions[index]
+  others = positions[:index] + positions[index + 1:]
+  for num_tries in range(1, max_tries + 1):
+    x = rng.uniform(-3, 3)
+    y = rng.uniform(-3, 3)
+    if not placement_ok(x, y, r, others, directions, min_dist, margin):
+      continue
+    if not changes_relation((px, py), (x, y), directions, eps):
+      continue
+    moved = list(positions)
+    moved[index] = (x, y, r)
+    if min(visible_pixels(moved, camera)) < min_pixels:
+      continue
+    return (x, y), num_tries
+  return None, max_tries
@@ -0,0 +1,207 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, hashlib, json, os, random, struct, subprocess, sys, tempfile
+import threading
+try:
+  import queue
+except ImportError:
+  import Queue as queue
+
+import layout, vocabulary
+
+"""
+Sample scene layouts ahead of rendering in a separate process. With
+--pipeline 1, render_images.py starts this file as a script with a JSON
+config describing the base scene (camera, lamps) and the sampling settings.
+The script writes one scene spec per image index as a JSON line to stdout:
+the jittered camera and lamp locations and every object's shape, size,
+color, material, position and rotation. Layouts are screened with the
+analytic occlusion estimate of layout.py, so Blender only has to add the
+objects, confirm visibility and render.
+
+LayoutPipeline runs the script and reads its specs on a background thread
+into a bounded queue; when the queue is full the sampler blocks on its
+output pipe, so it stays a few scenes ahead of the renderer but no more.
+"""
+
+
+def sample_scene(config, vocab, camera, rng):
+  """
+  Sample one scene spec like render_scene does inside Blender: jitter the
+  camera and lamps, then place objects until the layout keeps the placement
+  rules and every object is estimated to be visible.
+  """
+  def rand(L):
+    return 2.0 * L * (rng.random() - 0.5)
+
+  num_objects = rng.randint(config['min_objects'], config['max_objects'])
+  camera_location = [c + rand(config['camera_jitter'])
+                     for c in camera.location]
+  camera = camera.moved(camera_location)
+  directions = layout.camera_directions(camera)
+  lamp_locations = {}
+  for name, location in sorted(config['lamp_locations'].items()):
+    jitter = config['lamp_jitter'].get(name, 0)
+    lamp_locations[name] = [c + rand(jitter) for c in location]
+
+  num_restarts = 0
+  while True:
+    positions = []
+    objects = []
+    for i in range(num_objects):
+      size_name, r = rng.choice(vocab.size_mapping)
+      for _ in range(config['max_retries']):
+        x = rng.uniform(-3, 3)
+        y = rng.uniform(-3, 3)
+        if layout.placement_ok(x, y, r, positions, directions,
+                               config['min_dist'], config['margin']):
+          break
+      else:
+        break
+
+      if vocab.shape_color_combos is None:
+        obj_name, obj_name_out = rng.choice(vocab.object_mapping)
+        color_name, _ = rng.choice(vocab.color_items)
+      else:
+        obj_name_out, color_choices = rng.choice(vocab.shape_color_combos)
+        color_name = rng.choice(color_choices)
+        obj_name = vocab.shapes[obj_name_out]
+      if obj_name == 'Cube':
+        r /= 2 ** 0.5
+      theta = 360.0 * rng.random()
+      _, mat_name_out = rng.choice(vocab.material_mapping)
+      positions.append((x, y, r))
+      objects.append({
+        'shape': obj_name_out,
+        'size': size_name,
+        'material': mat_name_out,
+        'color': color_name,
+        'rotation': theta,
+        'x': x,
+        'y': y,
+        'r': r,
+      })
+    if (len(objects) == num_objects and
+        min(layout.visible_pixels(positions, camera)) >=
+        config['min_pixels_per_object']):
+      break
+    num_restarts += 1
+
+  return {
+    'camera_location': camera_location,
+    'lamp_locations': lamp_locations,
+    'objects': objects,
+    'num_restarts': num_restarts,
+  }
+
+
+def index_rng(seed, index):
+  """ A random generator for one image index, or a fresh one without seed """
+  if seed is None:
+    return random.Random()
+  text = '%d:layout:%d' % (seed, index)
+  digest = hashlib.sha256(text.encode('utf-8')).digest()
+  return random.Random(struct.unpack('<I', digest[:4])[0])
+
+
+def main(args):
+  with open(args.config, 'r') as f:
+    config = json.load(f)
+  vocab = vocabulary.load_vocabulary(config['properties_json'],
+                                     config['shape_color_combos_json'])
+  camera = layout.CameraModel.from_dict(config['camera'])
+  num_views = config.get('num_views', 1)
+  for index in config['indices']:
+    # The views of a layout share it, so it is seeded by its first index
+    layout_id = index - index % num_views
+    spec = sample_scene(config, vocab, camera,
+                        index_rng(config['seed'], layout_id))
+    spec['image_index'] = index
+    try:
+      sys.stdout.write(json.dumps(spec) + '\n')
+      sys.stdout.flush()
+    except (IOError, OSError):
+      # The renderer has gone away
+      return
+
+
+class LayoutPipeline(object):
+  """
+  Runs this file as a separate process for the given config and keeps up to
+  queue_size of its scene specs ready. get(index) returns the spec for an
+  image index, or None if there is none, e.g. because the index was already
+  handed out once or the sampler died; the caller then samples the scene
+  itself.
+  """
+  def __init__(self, config, python=None, queue_size=8):
+    f, self.config_path = tempfile.mkstemp(suffix='.json')
+    with os.fdopen(f, 'w') as fout:
+      json.dump(config, fout)
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          'layout_sampler.py')
+    env = dict(os.environ)
+    path = env.get('PYTHONPATH')
+    env['PYTHONPATH'] = os.path.dirname(script) + (
+        os.pathsep + path if path else '')
+    self.proc = subprocess.Popen(
+        [python or sys.executable, script, '--config', self.config_path],
+        stdout=subprocess.PIPE, env=env)
+    self.queue = queue.Queue(maxsize=queue_size)
+    self.next_spec = None
+    self.finished = False
+    self.thread = threading.Thread(target=self._read)
+    self.thread.daemon = True
+    self.thread.start()
+
+  def _read(self):
+    for line in iter(self.proc.stdout.readline, b''):
+      try:
+        spec = json.loads(line.decode('utf-8'))
+      except ValueError:
+        break
+      self.queue.put(spec)
+    self.queue.put(None)
+
+  def depth(self):
+    """ Number of specs that are ready """
+    return self.queue.qsize() + (self.next_spec is not None)
+
+  def get(self, index):
+    """ The spec for index; blocks until the sampler has produced it """
+    while True:
+      if self.next_spec is None:
+        if self.finished:
+          return None
+        spec = self.queue.get()
+        if spec is None:
+          self.finished = True
+          return None
+        self.next_spec = spec
+      if self.next_spec['image_index'] < index:
+        # Skipped by the renderer
+        self.next_spec = None
+        continue
+      if self.next_spec['image_index'] > index:
+        return None
+      spec, self.next_spec = self.next_spec, None
+      return spec
+
+  def close(self):
+    if self.proc.poll() is None:
+      self.proc.terminate()
+    self.proc.wait()
+    if os.path.exists(self.config_path):
+      os.remove(self.config_path)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description="Write scene specs for render_images.py --pipeline 1")
+  parser.add_argument('--config', required=True)
+  main(parser.parse_args())
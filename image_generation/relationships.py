@@ -0,0 +1,60 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import numpy as np
+
+"""
+Spatial relationships between the objects of a CLEVR scene. This module only
+needs NumPy, so it can be used both from render_images.py inside Blender and
+from standalone tools that work with scene JSON files.
+"""
+
+
+def compute_all_relationships(scene_struct, eps=0.2):
+  """
+  Computes relationships between all pairs of objects in the scene.
+
+  Returns a dictionary mapping string relationship names to lists of lists of
+  integers, where output[rel][i] gives a list of object indices that have the
+  relationship rel with object i. For example if j is in output['left'][i] then
+  object j is left of object i.
+
+  All pairs are handled at once: the offsets between all pairs of objects are
+  projected onto every direction vector in a single array expression.
+  """
+  objects = scene_struct['objects']
+  names = [name for name in scene_struct['directions']
+           if name != 'above' and name != 'below']
+  if not names:
+    return {}
+  coords = np.array([obj['3d_coords'] for obj in objects], dtype=np.float64)
+  coords = coords.reshape(len(objects), 3)
+  directions = np.array([scene_struct['directions'][name] for name in names],
+                        dtype=np.float64)
+
+  # diff[i, j] = coords[j] - coords[i]; the dot products are summed in the
+  # same order as a per-pair loop would so that pairs right at eps end up on
+  # the same side.
+  diff = coords[None, :, :] - coords[:, None, :]
+  dots = diff[None, :, :, 0] * directions[:, 0, None, None] \
+       + diff[None, :, :, 1] * directions[:, 1, None, None] \
+       + diff[None, :, :, 2] * directions[:, 2, None, None]
+  related = dots > eps
+
+  # An object is never related to itself, nor to an identical copy of itself
+  # (as happens for unchanged objects in the combined scene of an action pair).
+  # Identical objects share their coordinates, so only those pairs need the
+  # full comparison.
+  for i, j in zip(*np.nonzero((diff == 0).all(axis=2))):
+    if i == j or objects[i] == objects[j]:
+      related[:, i, j] = False
+
+  all_relationships = {}
+  for d, name in enumerate(names):
+    all_relationships[name] = [np.flatnonzero(row).tolist()
+                               for row in related[d]]
+  return all_relationships
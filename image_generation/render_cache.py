@@ -0,0 +1,99 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import errno, hashlib, json, os, shutil
+
+import io_utils
+
+"""
+Content-addressed cache of rendered images. A rendered image is fully
+determined by its scene specification: the objects with their exact
+placement, the camera and lamp positions, the render settings, the Blender
+version and the asset files. The cache hashes a canonical JSON encoding of
+that specification and stores the image under the hash, so rendering the
+same specification again only links the cached file into place.
+
+Files are shared with hardlinks where possible, so a cache on the same
+filesystem as the output costs no extra space.
+"""
+
+
+def hash_files(paths):
+  """
+  Hash the contents of the given files and of all files in the given
+  directories, together with their names. Used to tie cache entries to the
+  exact assets (base scene, shapes, materials, properties) they were rendered
+  with.
+  """
+  h = hashlib.sha1()
+  for path in sorted(paths):
+    if os.path.isdir(path):
+      files = sorted(os.path.join(path, f) for f in os.listdir(path))
+    else:
+      files = [path]
+    for f in files:
+      if not os.path.isfile(f):
+        continue
+      h.update(os.path.basename(f).encode('utf-8') + b'\0')
+      with open(f, 'rb') as fin:
+        for block in iter(lambda: fin.read(1 << 20), b''):
+          h.update(block)
+  return h.hexdigest()
+
+
+def link_or_copy(src, dst):
+  """ Atomically place a hardlink to src (or a copy of it) at dst """
+  tmp = io_utils.temp_path(dst, 'link%d' % os.getpid())
+  if os.path.lexists(tmp):
+    os.remove(tmp)
+  try:
+    os.link(src, tmp)
+  except OSError as e:
+    if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK):
+      raise
+    shutil.copyfile(src, tmp)
+  os.replace(tmp, dst)
+
+
+class RenderCache(object):
+  def __init__(self, cache_dir):
+    self.cache_dir = cache_dir
+    if not os.path.isdir(cache_dir):
+      os.makedirs(cache_dir)
+
+  def key(self, spec):
+    """ The cache key of a JSON serializable scene specification """
+    text = json.dumps(spec, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+  def path(self, key):
+    return os.path.join(self.cache_dir, key[:2], key + '.png')
+
+  def fetch(self, key, output_path):
+    """
+    Place the cached image for key at output_path. Returns False if there is
+    no valid cached image.
+    """
+    path = self.path(key)
+    if not io_utils.is_valid_png(path):
+      return False
+    link_or_copy(path, output_path)
+    return True
+
+  def store(self, key, image_path):
+    """ Add a rendered image to the cache """
+    path = self.path(key)
+    if os.path.exists(path):
+      return
+    if not os.path.isdir(os.path.dirname(path)):
+      try:
+        os.makedirs(os.path.dirname(path))
+      except OSError as e:
+        # Another worker may have created it in the meantime
+        if e.errno != errno.EEXIST:
+          raise
+    link_or_copy(image_path, path)
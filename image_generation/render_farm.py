@@ -0,0 +1,309 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, os, sys, subprocess, time, logging
+from collections import deque
+
+"""
+Drives a pool of Blender workers that render CLEVR images in parallel on a
+single node. Each worker is a separate Blender process running render_images.py
+with its own GPU (or its own number of CPU threads). Image indices are handed
+out from a shared work queue in chunks; when a worker crashes or stops making
+progress it is killed and the indices it did not finish are put back on the
+queue. Every finished index is appended to a manifest file, and indices that
+are already in the manifest are skipped, so an interrupted run can simply be
+started again with the same arguments.
+
+Arguments after "--" are forwarded unchanged to render_images.py, like this:
+
+python render_farm.py --start_idx 0 --num_images 1000 --gpus 0 1 -- @args
+"""
+
+# Exit code of render_images.py after stopping at --memory_ceiling_mb (the
+# same as session.EXIT_RECYCLE, which needs Blender to import)
+EXIT_RECYCLE = 75
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--start_idx', default=0, type=int,
+    help="The index of the first image to render.")
+parser.add_argument('--num_images', default=5, type=int,
+    help="The number of images to render.")
+parser.add_argument('--gpus', default=[], nargs='*', type=int,
+    help="CUDA devices to render on; each device gets --workers_per_gpu " +
+         "workers, and each of those renders with --use_gpu set to that device.")
+parser.add_argument('--workers_per_gpu', default=1, type=int,
+    help="The number of Blender workers to run on each GPU.")
+parser.add_argument('--cpu_workers', default=0, type=int,
+    help="The number of CPU-only Blender workers to run. If no --gpus are " +
+         "given this defaults to a single CPU worker.")
+parser.add_argument('--cpu_threads', default=0, type=int,
+    help="The number of render threads for each CPU worker; 0 lets Blender " +
+         "use all cores.")
+parser.add_argument('--chunk_size', default=50, type=int,
+    help="The number of consecutive indices handed to a worker at a time. " +
+         "Each chunk is rendered by a fresh Blender process.")
+parser.add_argument('--hang_timeout', default=900, type=int,
+    help="A worker that has not finished an image for this many seconds is " +
+         "considered hung; it is killed and its indices are reassigned.")
+parser.add_argument('--max_attempts', default=3, type=int,
+    help="Give up on a chunk after this many consecutive attempts that " +
+         "finished no images at all.")
+parser.add_argument('--poll_interval', default=2.0, type=float,
+    help="How often (in seconds) to check on the workers.")
+parser.add_argument('--blender', default='blender',
+    help="Path to the Blender binary.")
+parser.add_argument('--script', default='render_images.py',
+    help="The rendering script that each worker runs.")
+parser.add_argument('--manifest', default='../output/render_manifest.jsonl',
+    help="File that records one JSON line per finished image index. Indices " +
+         "already listed here are not rendered again.")
+parser.add_argument('--work_dir', default='../output/farm',
+    help="Directory for per-worker progress logs, Blender logs and the " +
+         "partial scene/count files written by each chunk.")
+
+
+def split_argv(argv):
+  """
+  Split the command line into arguments for this script and arguments that
+  are forwarded to the rendering script, separated by "--".
+  """
+  if '--' in argv:
+    idx = argv.index('--')
+    return argv[:idx], argv[(idx + 1):]
+  return argv, []
+
+
+def load_manifest(path):
+  """ Return the set of image indices recorded in a manifest file """
+  done = set()
+  if not os.path.isfile(path):
+    return done
+  with open(path, 'r') as f:
+    for line in f:
+      line = line.strip()
+      if not line: continue
+      try:
+        done.add(json.loads(line)['image_index'])
+      except (ValueError, KeyError):
+        # A torn last line from an interrupted run; the index is re-rendered
+        continue
+  return done
+
+
+def make_chunks(indices, chunk_size):
+  """
+  Group a sorted list of indices into (start, num) chunks of consecutive
+  indices, each at most chunk_size long.
+  """
+  chunks = []
+  for idx in indices:
+    if chunks and chunks[-1][0] + chunks[-1][1] == idx \
+        and chunks[-1][1] < chunk_size:
+      chunks[-1][1] += 1
+    else:
+      chunks.append([idx, 1])
+  return [tuple(c) for c in chunks]
+
+
+class Worker(object):
+  """
+  One slot of the farm. A slot runs at most one Blender process at a time,
+  each process rendering a single chunk of indices.
+  """
+  def __init__(self, name, gpu=None, threads=0):
+    self.name = name
+    self.gpu = gpu
+    self.threads = threads
+    self.proc = None
+    self.chunk = None
+    self.done = set()
+    self.last_progress = None
+    self.progress_log = None
+    self.blender_log = None
+
+  def busy(self):
+    return self.proc is not None
+
+  def launch(self, chunk, args, render_argv):
+    self.chunk = chunk
+    self.done = set()
+    self.last_progress = time.time()
+    start, num = chunk
+    prefix = os.path.join(args.work_dir, self.name)
+    self.progress_log = '%s.progress' % prefix
+    # Progress is read back from this file, so it must not contain lines left
+    # over from the previous chunk
+    open(self.progress_log, 'w').close()
+
+    cmd = [args.blender, '--background', '-noaudio']
+    if self.threads > 0:
+      cmd += ['--threads', str(self.threads)]
+    cmd += ['--python', args.script, '--']
+    cmd += render_argv
+    cmd += [
+      '--start_idx', str(start),
+      '--num_images', str(num),
+      '--log_file', self.progress_log,
+      '--render_log_file', '%s.render.log' % prefix,
+      '--output_scene_file', '%s_scenes_%d.json' % (prefix, start),
+      '--output_cb_scene_file', '%s_cb_scenes_%d.json' % (prefix, start),
+      '--output_scene_log', '%s_scenes.jsonl' % prefix,
+      '--shard_prefix', 'CLEVR-%s' % self.name,
+      '--output_count_file', '%s_counts_%d.json' % (prefix, start),
+    ]
+    if self.gpu is not None:
+      cmd += ['--use_gpu', str(self.gpu)]
+    self.blender_log = open('%s.blender.log' % prefix, 'a')
+    self.proc = subprocess.Popen(cmd, stdout=self.blender_log,
+                                 stderr=subprocess.STDOUT)
+    logger.info('%s: rendering %d images starting at %d (pid %d)'
+                % (self.name, num, start, self.proc.pid))
+
+  def read_progress(self):
+    """
+    Return the indices finished since the last call. render_images.py appends
+    one line per finished image holding that image's index plus one.
+    """
+    new = []
+    with open(self.progress_log, 'r') as f:
+      for line in f:
+        line = line.strip()
+        if not line: continue
+        try:
+          idx = int(line) - 1
+        except ValueError:
+          continue
+        if idx not in self.done:
+          self.done.add(idx)
+          new.append(idx)
+    if new:
+      self.last_progress = time.time()
+    return new
+
+  def remaining(self):
+    start, num = self.chunk
+    return [i for i in range(start, start + num) if i not in self.done]
+
+  def kill(self):
+    if self.proc is not None and self.proc.poll() is None:
+      self.proc.kill()
+      self.proc.wait()
+
+  def release(self):
+    self.proc = None
+    self.chunk = None
+    if self.blender_log is not None:
+      self.blender_log.close()
+      self.blender_log = None
+
+
+def make_workers(args):
+  workers = []
+  for gpu in args.gpus:
+    for i in range(args.workers_per_gpu):
+      workers.append(Worker('gpu%d_%d' % (gpu, i), gpu=gpu))
+  num_cpu = args.cpu_workers
+  if num_cpu == 0 and len(workers) == 0:
+    num_cpu = 1
+  for i in range(num_cpu):
+    workers.append(Worker('cpu_%d' % i, threads=args.cpu_threads))
+  return workers
+
+
+def main(args, render_argv):
+  if not os.path.isdir(args.work_dir):
+    os.makedirs(args.work_dir)
+  manifest_dir = os.path.dirname(args.manifest)
+  if manifest_dir and not os.path.isdir(manifest_dir):
+    os.makedirs(manifest_dir)
+
+  done = load_manifest(args.manifest)
+  wanted = range(args.start_idx, args.start_idx + args.num_images)
+  pending = [i for i in wanted if i not in done]
+  logger.info('%d of %d images already in %s; %d left to render'
+              % (args.num_images - len(pending), args.num_images,
+                 args.manifest, len(pending)))
+
+  # Each queue entry is (chunk, number of attempts without any progress)
+  queue = deque((c, 0) for c in make_chunks(pending, args.chunk_size))
+  attempts = {}
+  failed = []
+  workers = make_workers(args)
+  manifest = open(args.manifest, 'a')
+
+  def record(worker, indices):
+    for idx in sorted(indices):
+      manifest.write(json.dumps({'image_index': idx, 'worker': worker.name,
+                                 'time': time.time()}) + '\n')
+    manifest.flush()
+
+  def requeue(worker, reason):
+    remaining = worker.remaining()
+    if not remaining:
+      return
+    tries = 0 if worker.done else attempts.get(worker.chunk, 0) + 1
+    logger.warning('%s: %s; %d images of chunk %d+%d left'
+                   % (worker.name, reason, len(remaining),
+                      worker.chunk[0], worker.chunk[1]))
+    for chunk in make_chunks(remaining, args.chunk_size):
+      if tries >= args.max_attempts:
+        logger.error('giving up on images %d to %d after %d attempts'
+                     % (chunk[0], chunk[0] + chunk[1] - 1, tries))
+        failed.extend(range(chunk[0], chunk[0] + chunk[1]))
+      else:
+        queue.appendleft((chunk, tries))
+
+  try:
+    while queue or any(w.busy() for w in workers):
+      for w in workers:
+        if w.busy():
+          record(w, w.read_progress())
+          code = w.proc.poll()
+          if code is not None:
+            record(w, w.read_progress())
+            if w.remaining():
+              if code == EXIT_RECYCLE:
+                requeue(w, 'restarting after reaching its memory ceiling')
+              else:
+                requeue(w, 'exited with code %d' % code)
+            w.release()
+          elif time.time() - w.last_progress > args.hang_timeout:
+            w.kill()
+            record(w, w.read_progress())
+            requeue(w, 'no progress for %ds' % args.hang_timeout)
+            w.release()
+        if not w.busy() and queue:
+          chunk, tries = queue.popleft()
+          attempts[chunk] = tries
+          w.launch(chunk, args, render_argv)
+      time.sleep(args.poll_interval)
+  except KeyboardInterrupt:
+    logger.info('Exit on Ctrl C; stopping workers.')
+    for w in workers:
+      if w.busy():
+        w.kill()
+        record(w, w.read_progress())
+        w.release()
+    manifest.close()
+    sys.exit(1)
+  manifest.close()
+
+  if failed:
+    logger.error('%d images could not be rendered: %s'
+                 % (len(failed), ', '.join(str(i) for i in failed)))
+    sys.exit(1)
+  logger.info('All %d images rendered.' % args.num_images)
+
+
+if __name__ == '__main__':
+  farm_argv, render_argv = split_argv(sys.argv[1:])
+  args = parser.parse_args(farm_argv)
+  logging.basicConfig(level=logging.INFO,
+                      format='%(asctime)s %(levelname)s %(message)s')
+  logger = logging.getLogger(__name__)
+  main(args, render_argv)
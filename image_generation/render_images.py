@@ -6,7 +6,8 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import math, sys, random, argparse, json, os, tempfile, copy, time, logging, traceback
+import math, sys, random, argparse, json, os, tempfile, time, logging, traceback, shutil
+import hashlib, struct
 from datetime import datetime as dt
 from datetime import timedelta as td
 from collections import Counter
@@ -32,10 +33,14 @@ except ImportError as e:
   INSIDE_BLENDER = False
 if INSIDE_BLENDER:
   try:
-    import utils
+    import utils, io_utils, render_cache as cache, session, shards
+    import telemetry as render_telemetry
+    from relationships import compute_all_relationships
+    import vocabulary, change_scheduler, layout, layout_sampler, resolutions
   except ImportError as e:
     print("\nERROR")
-    print("Running render_images.py from Blender and cannot import utils.py.")
+    print("Running render_images.py from Blender and cannot import utils.py")
+    print("or io_utils.py.")
     print("You may need to add a .pth file to the site-packages of Blender's")
     print("bundled python with a command like this:\n")
     print("echo $PWD >> $BLENDER/$VERSION/python/lib/python3.5/site-packages/clevr.pth")
@@ -113,8 +118,44 @@ parser.add_argument('--output_scene_file', default='../output/CLEVR_scenes.json'
     help="Path to write a single JSON file containing all scene information")
 parser.add_argument('--output_cb_scene_file', default='../output/CLEVR_cb_scenes.json',
     help="Path to write a single JSON file containing all combined scene information")
+parser.add_argument('--output_scene_log', default='../output/CLEVR_scenes.jsonl',
+    help="Append-only file that receives every rendered scene (new, cor and " +
+         "cb) as one compact JSON line. --output_scene_file and " +
+         "--output_cb_scene_file are built from this log.")
+parser.add_argument('--save_scene_files', default=1, type=int,
+    help="Setting --save_scene_files 0 skips writing a separate JSON file " +
+         "per scene to --output_scene_dir; scenes are then only stored in " +
+         "--output_scene_log.")
+parser.add_argument('--output_shard_dir', default=None,
+    help="If set, every finished sample (the new and cor images and the cb " +
+         "scene, or the image and scene outside of action mode) is also " +
+         "packed into tar shards in this directory; see shards.py.")
+parser.add_argument('--shard_prefix', default=None,
+    help="Name prefix of the shards and their index file. Defaults to " +
+         "--filename_prefix; processes writing to the same --output_shard_dir " +
+         "need different prefixes.")
+parser.add_argument('--samples_per_shard', default=1000, type=int,
+    help="The number of samples per shard.")
+parser.add_argument('--remove_packed_files', default=0, type=int,
+    help="Setting --remove_packed_files 1 deletes the images of each " +
+         "sample once it has been packed into a shard.")
+parser.add_argument('--scene_reset', default='revert', choices=['revert', 'purge'],
+    help="How the scene is reset between images. revert reloads the base " +
+         "scene file; purge removes the objects added for the last image, " +
+         "restores the camera and lights and deletes orphaned datablocks, " +
+         "which avoids reloading the file and the materials.")
+parser.add_argument('--memory_ceiling_mb', default=0, type=int,
+    help="If the resident memory of Blender exceeds this many MB after an " +
+         "image, stop after writing all outputs and exit with code 75 so " +
+         "that render_farm.py restarts the worker. 0 disables the ceiling.")
 parser.add_argument('--output_count_file', default='../output/CLEVR_counts.json',
     help="Path to write a single JSON file containing number of action objects information")
+parser.add_argument('--change_distribution', default='',
+    help="Target distribution of the change types of action scenes, as " +
+         "comma separated <change type>=<weight> pairs, e.g. " +
+         "size_changed=2,color_changed=1,mat_changed=1. The change types " +
+         "are the keys of --output_count_file; types that are not listed " +
+         "are not used. By default all six types are equally likely.")
 parser.add_argument('--output_blend_dir', default='output/blendfiles',
     help="The directory where blender scene files will be stored, if the " +
          "user requested that these files be saved using the " +
@@ -125,6 +166,11 @@ parser.add_argument('--save_blendfiles', type=int, default=0,
          "each generated image to be stored in the directory specified by " +
          "the --output_blend_dir flag. These files are not saved by default " +
          "because they take up ~5-10MB each.")
+parser.add_argument('--seed', default=None, type=int,
+    help="If given, the random state is derived from this seed and the " +
+         "image index before each image, so that every image can be " +
+         "reproduced from its index alone, independently of --start_idx, " +
+         "--num_images or the worker that renders it.")
 parser.add_argument('--version', default='1.0',
     help="String to store in the \"version\" field of the generated JSON file")
 parser.add_argument('--license',
@@ -133,7 +179,21 @@ parser.add_argument('--license',
 parser.add_argument('--date', default=dt.today().strftime("%m/%d/%Y"),
     help="String to store in the \"date\" field of the generated JSON file; " +
          "defaults to today's date")
-parser.add_argument('--log_file', default='log.log')
+parser.add_argument('--resume', default=0, type=int,
+    help="Setting --resume 1 skips every index in the requested range whose " +
+         "outputs (images and scene JSON files, including the cor and cb " +
+         "files in action mode) already exist and are complete, and renders " +
+         "only the missing ones.")
+parser.add_argument('--log_file', default='log.log',
+    help="File to which the index (plus one) of each finished image is " +
+         "appended; used by render_farm.py to track progress.")
+parser.add_argument('--timing_file', default=None,
+    help="File to which one JSON line with per-phase timings is appended " +
+         "for every image; defaults to --log_file with its extension " +
+         "replaced by _timing.jsonl. Summarize it with telemetry.py.")
+parser.add_argument('--render_log_file', default='../output/blender_render.log',
+    help="File that receives Blender's own render output unless " +
+         "--render_verbose is given.")
 
 # Rendering options
 parser.add_argument('--action', default=1, type=int,
@@ -161,11 +221,75 @@ parser.add_argument('--render_min_bounces', default=8, type=int,
     help="The minimum number of bounces to use for rendering.")
 parser.add_argument('--render_max_bounces', default=8, type=int,
     help="The maximum number of bounces to use for rendering.")
+parser.add_argument('--num_views', default=1, type=int,
+    help="Render every layout from this many jittered camera positions. " +
+         "The views of a layout get consecutive image indices starting at " +
+         "a multiple of --num_views and share their objects and lamps; " +
+         "each scene records that multiple as layout_id. With --seed a " +
+         "layout only depends on its layout_id. Not supported together " +
+         "with --action 1.")
+parser.add_argument('--pipeline', default=0, type=int,
+    help="Setting --pipeline 1 samples scene layouts in a separate process " +
+         "(layout_sampler.py) that stays ahead of Blender, so that Blender " +
+         "only adds the objects, checks their visibility and renders. " +
+         "Layouts that fail the visibility check in Blender, and images " +
+         "the sampler has no layout for, are sampled in Blender as usual.")
+parser.add_argument('--pipeline_queue_size', default=8, type=int,
+    help="The number of layouts the sampler may have ready ahead of Blender")
+parser.add_argument('--pipeline_python', default=None,
+    help="Python interpreter for the layout sampler; it needs NumPy. By " +
+         "default the Python bundled with Blender is used.")
+parser.add_argument('--render_cache_dir', default=None,
+    help="Directory of a render cache shared between runs. Images are " +
+         "stored under a hash of everything that determines them (objects, " +
+         "camera, lamps, render settings, Blender version and assets); when " +
+         "a scene is rendered again the cached image is reused.")
+parser.add_argument('--async_write', default=0, type=int,
+    help="Setting --async_write 1 lets Blender write an uncompressed TGA " +
+         "and encodes the PNG on a background thread, so that compressing " +
+         "and writing the image overlaps with setting up and rendering the " +
+         "next scene.")
+parser.add_argument('--png_compression', default=6, type=int,
+    help="zlib compression level (0-9) for PNGs encoded with " +
+         "--async_write 1. Lower levels encode faster but give larger files.")
+parser.add_argument('--resolution_variants', default=None,
+    help="Comma separated list of smaller sizes, e.g. 320x240,160x120, to " +
+         "produce from every rendered image. Each variant is the center " +
+         "of the render cropped to the variant's aspect ratio and " +
+         "downsampled with an area filter. Images are written to a " +
+         "subdirectory of --output_image_dir named after the size, and " +
+         "the combined scene files get a copy per size with pixel_coords " +
+         "mapped into the variant. The variants are made on the " +
+         "background image writer thread, so this implies --async_write 1.")
+parser.add_argument('--png_color_mode', default=None, choices=['RGB', 'RGBA'],
+    help="Color mode of PNGs encoded with --async_write 1. By default the " +
+         "color mode of the base scene's output settings is kept.")
+parser.add_argument('--render_profile', default=None,
+    choices=['draft', 'standard', 'final'],
+    help="Named render quality profile. Each profile sets the sample count " +
+         "and bounces, and, where the Blender version supports it, an " +
+         "adaptive sampling noise threshold and denoising. Without adaptive " +
+         "sampling the profile's fixed sample count is used. If given, this " +
+         "overrides --render_num_samples, --render_min_bounces and " +
+         "--render_max_bounces.")
 parser.add_argument('--render_tile_size', default=256, type=int,
     help="The tile size to use for rendering. This should not affect the " +
          "quality of the rendered image but may affect the speed; CPU-based " +
          "rendering may achieve better performance using smaller tile sizes " +
          "while larger tile sizes may be optimal for GPU-based rendering.")
+parser.add_argument('--partial_cor_render', default=0, type=int,
+    help="Setting --partial_cor_render 1 renders the cor image of an action " +
+         "pair only inside the region that the change can affect (the " +
+         "changed object and its shadows) and composites it onto the new " +
+         "image. Only color and material changes are rendered this way; " +
+         "position changes always get a full render, and pairs without a " +
+         "change reuse the new image.")
+parser.add_argument('--partial_render_padding', default=8, type=int,
+    help="Number of pixels by which the partially rendered region is grown " +
+         "on every side, to cover soft shadow edges and nearby reflections.")
+parser.add_argument('--partial_render_max_area', default=0.5, type=float,
+    help="If the partially rendered region would cover more than this " +
+         "fraction of the image, the cor image is fully rendered instead.")
 
 parser.add_argument("--debug", action='store_true', default=False,
     help="If Enable, then print debugging information.")
@@ -183,7 +307,9 @@ class LogRenderInfo():
     self.old = os.dup(1)
     sys.stdout.flush()
     os.close(1)
-    os.open(self.logfile, os.O_WRONLY)
+    # Append, since several processes (e.g. render_farm.py chunks) may share
+    # one log file
+    os.open(self.logfile, os.O_WRONLY | os.O_APPEND)
 
   def off(self):
     # disable output redirection
@@ -192,10 +318,37 @@ class LogRenderInfo():
     os.close(self.old)
 
 
+# Render quality profiles for --render_profile. "samples" is the maximum
+# number of samples per pixel; with adaptive sampling Cycles stops sampling a
+# pixel once its noise drops below "adaptive_threshold", but never before
+# "adaptive_min_samples" samples. Without adaptive sampling (Blender before
+# 2.83) every pixel gets "fixed_samples", which for standard and final is the
+# default --render_num_samples, so those profiles never render fewer samples
+# than the default settings.
+RENDER_PROFILES = {
+  'draft': {'samples': 64, 'fixed_samples': 64,
+            'min_bounces': 4, 'max_bounces': 4,
+            'adaptive_threshold': 0.05, 'adaptive_min_samples': 16,
+            'denoise': True},
+  'standard': {'samples': 256, 'fixed_samples': 512,
+               'min_bounces': 8, 'max_bounces': 8,
+               'adaptive_threshold': 0.02, 'adaptive_min_samples': 32,
+               'denoise': True},
+  'final': {'samples': 512, 'fixed_samples': 512,
+            'min_bounces': 8, 'max_bounces': 8,
+            'adaptive_threshold': 0.01, 'adaptive_min_samples': 64,
+            'denoise': False},
+}
+
+# Colors for the visibility check are drawn from their own generator, so the
+# number of visibility checks does not change the random layout of a scene
+palette_rng = random.Random()
+
+# The lamps of the base scene; their positions are jittered per scene
+LAMP_NAMES = ['Lamp_Key', 'Lamp_Fill', 'Lamp_Back']
+
 SIZE_CHANGED, SIZE_UNCHANGED, COLOR_CHANGED, COLOR_UNCHANGED, MAT_CHANGED, MAT_UNCHANGED \
   = "size_changed", "size_unchanged", "color_changed", "color_unchanged", "mat_changed", "mat_unchanged"
-counts = {SIZE_CHANGED: 0, SIZE_UNCHANGED: 0, COLOR_CHANGED: 0,
-          COLOR_UNCHANGED: 0, MAT_CHANGED: 0, MAT_UNCHANGED: 0}
 
 def main(args):
   if not args.render_verbose:
@@ -212,124 +365,578 @@ def main(args):
 
   # load base file, all scene depends on this
   bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
-
-  all_scene_paths = []
-  all_combined_scene_paths = []
+  memory.snapshot()
+  warn_unsupported_sampling(args)
+  recycle = False
+
+  indices = list(range(args.start_idx, args.start_idx + args.num_images))
+  if args.resume and args.output_shard_dir is not None:
+    # Only packed samples are complete; their files may have been removed
+    packed = shards.load_index(args.output_shard_dir)
+    pending = [idx for idx in indices if idx not in packed]
+  elif args.resume:
+    logged = io_utils.scan_scene_log(args.output_scene_log)
+    pending = [idx for idx in indices
+               if not is_index_complete(args, idx, img_template,
+                                        scene_template, logged)]
+  if args.resume:
+    logger.info("RESUMING: %i / %i images already complete"
+                % (len(indices) - len(pending), len(indices)))
+    indices = pending
+
+  pipeline = None
+  if args.pipeline:
+    pipeline = start_layout_pipeline(args, indices)
 
   count_num_images = 0
   try:
-    while count_num_images < args.num_images:
+    while count_num_images < len(indices):
       i = count_num_images
+      output_index = indices[i]
       start = time.time()
+      telemetry.start_image(output_index)
+      if args.seed is not None:
+        seed_index(args.seed, output_index)
       img_path = img_template
       scene_path = scene_template
 
       blend_path = None
       if args.save_blendfiles == 1:
         blend_path = blend_template
-      num_objects = random.randint(args.min_objects, args.max_objects)
+
+      # Take the layout from the sampler if there is one for this index;
+      # time spent waiting for it means the sampler does not keep up
+      spec = None
+      if pipeline is not None and not reuses_layout(args, output_index):
+        telemetry.count('pipeline_queue_depth', pipeline.depth())
+        with telemetry.phase('pipeline_wait'):
+          spec = pipeline.get(output_index)
+        if spec is None:
+          telemetry.count('pipeline_fallbacks')
+      if spec is not None:
+        num_objects = len(spec['objects'])
+      else:
+        num_objects = random.randint(args.min_objects, args.max_objects)
 
       if args.action:
         render_success = render_scene_with_action(args,
                           num_objects=num_objects,
-                          output_index=(i + args.start_idx),
+                          output_index=output_index,
                           output_image=img_path,
                           output_scene=scene_path,
                           output_blendfile=blend_path,
+                          spec=spec,
                         )
-        if render_success:
-          all_combined_scene_paths.append(scene_path % (args.csplit, (i + args.start_idx)))
       else:
         if blend_path is not None:
-          blend_path = blend_path % (args.split, (i + args.start_idx))
+          blend_path = blend_path % (args.split, output_index)
         render_success = render_scene(args,
                           num_objects=num_objects,
-                          output_index=(i + args.start_idx),
+                          output_index=output_index,
                           output_split=args.split,
-                          output_image=img_path % (args.split, (i + args.start_idx)),
-                          output_scene=scene_path % (args.split, (i + args.start_idx)),
-                          output_blendfile=blend_path
+                          output_image=img_path % (args.split, output_index),
+                          output_scene=scene_path % (args.split, output_index),
+                          output_blendfile=blend_path,
+                          spec=spec,
                         )
       end = time.time()
+      rss = session.rss_mb()
+      datablocks = memory.counts()
+      telemetry.end_image(success=render_success, num_objects=num_objects,
+                          rss_mb=rss, datablocks=datablocks)
+      logger.info("MEMORY: %.0f MB resident, datablocks: %s"
+                  % (rss, ', '.join('%s %d' % kv
+                                    for kv in sorted(datablocks.items()))))
       if render_success:
-        all_scene_paths.append(scene_path % (args.split, (i + args.start_idx)))
-
         logger.info("NUMBER OF IMAGES PROCESSED: %i / %i ---- Time_Per_Image %s, Avg_Per_Image %s, Time in Total: %s"
-                    % (i+1, args.num_images, str(td(seconds=int(end - start))),
+                    % (i+1, len(indices), str(td(seconds=int(end - start))),
                        str(td(seconds=int((end - main_start) / (i+1) * 100)) // 100),
                        str(td(seconds=int(end - main_start)))))
         count_num_images += 1
-        with open(args.log_file, "a") as f:
-          f.write(str(count_num_images + args.start_idx) + "\n")
+        # An image only counts as finished once its PNGs are on disk
+        scene_json = None
+        if shard_writer is not None:
+          scene_json = scene_log.last_record(
+              args.csplit if args.action else args.split, output_index)
+        if image_writer is None:
+          finish_image(args, output_index, img_template, scene_json)
+        else:
+          image_writer.call(finish_image, args, output_index, img_template,
+                            scene_json)
+        if args.action:
+          # Keep the counts current so that a resumed run continues from them
+          io_utils.write_json(args.output_count_file, scheduler.counts)
+      if args.memory_ceiling_mb > 0 and rss > args.memory_ceiling_mb:
+        # Finish normally so that all outputs are written, but tell the
+        # caller to continue in a fresh process
+        logger.info("Memory ceiling of %d MB reached; stopping after %i / %i "
+                    "images" % (args.memory_ceiling_mb, count_num_images,
+                                len(indices)))
+        recycle = True
+        break
   except KeyboardInterrupt:
     logger.info("Exit On Ctrl C.")
     exit()
   except Exception as e:
     logger.warning("Unexpected: %s" % traceback.format_exc())
     exit()
+  finally:
+    if pipeline is not None:
+      pipeline.close()
+    if image_writer is not None:
+      image_writer.close()
+    if shard_writer is not None:
+      shard_writer.close()
+
+  # After rendering all images, combine the scenes logged for the requested
+  # range into a single JSON file per split. Records are copied from the
+  # scene log, so the per-image JSON files are not read again.
+  scene_log.close()
+  logged = io_utils.scan_scene_log(args.output_scene_log)
+  if args.action:
+    # Only pairs whose combined scene was written are complete
+    done = [idx for idx in range(args.start_idx, args.start_idx + args.num_images)
+            if (args.csplit, idx) in logged]
+  else:
+    done = [idx for idx in range(args.start_idx, args.start_idx + args.num_images)
+            if (args.split, idx) in logged]
+
+  scene_info = {
+    'date': args.date,
+    'version': args.version,
+    'split': args.split,
+    'license': args.license,
+  }
+  cb_info = dict(scene_info, split=args.csplit)
+  cb_keys = [(args.csplit, idx) for idx in done] if args.action else []
+  io_utils.write_scenes_from_log(args.output_cb_scene_file, cb_info, logged,
+                                 cb_keys)
+  io_utils.write_scenes_from_log(args.output_scene_file, scene_info, logged,
+                                 [(args.split, idx) for idx in done])
+  for variant in variants:
+    # One combined file per variant, e.g. CLEVR_scenes_320x240.json
+    for path, info, keys in [
+        (args.output_cb_scene_file, cb_info, cb_keys),
+        (args.output_scene_file, scene_info,
+         [(args.split, idx) for idx in done])]:
+      stem, ext = os.path.splitext(path)
+      resolutions.write_variant_scenes('%s_%s%s' % (stem, variant.name, ext),
+                                       info, logged, keys, variant)
+  io_utils.write_json(args.output_count_file, scheduler.counts)
 
-  # After rendering all images, combine the JSON files for each scene into a
-  # single JSON file.
-  all_scenes = []
-  all_combined_scenes = []
-  # pick the minimum length of the two in case termination breaks in between the storage
-  length = min(len(all_scene_paths), len(all_combined_scene_paths))
-  for scene_path, cb_scene_path in zip(all_scene_paths[0:length], all_combined_scene_paths[0:length]):
-    with open(scene_path, 'r') as f:
-      all_scenes.append(json.load(f))
-    with open(cb_scene_path, 'r') as f:
-      all_combined_scenes.append(json.load(f))
-
-  all_scene_output = {
-    'info': {
-      'date': args.date,
-      'version': args.version,
-      'split': args.split,
-      'license': args.license,
-    },
-    'scenes': all_scenes
+  if not args.render_verbose:
+    render_log.off()
+  if recycle:
+    sys.exit(session.EXIT_RECYCLE)
+
+
+def seed_index(seed, index, stream=None):
+  """
+  Seed all random number generators from --seed and the image index, so that
+  an image only depends on its index and not on what was rendered before it
+  or by which worker. A stream name gives the index a separate sequence,
+  e.g. 'layout' for the layout shared by the views of --num_views.
+  """
+  if stream is None:
+    text = '%d:%d' % (seed, index)
+  else:
+    text = '%d:%s:%d' % (seed, stream, index)
+  digest = hashlib.sha256(text.encode('utf-8')).digest()
+  index_seed, palette_seed = struct.unpack('<II', digest[:8])
+  random.seed(index_seed)
+  np.random.seed(index_seed)
+  palette_rng.seed(palette_seed)
+
+
+def reuses_layout(args, output_index):
+  """
+  Whether the layout of the image output_index is already in the scene.
+  With --num_views the images output_index // num_views * num_views and the
+  following num_views - 1 indices are views of one layout, and the layout is
+  kept in Blender from one view to the next.
+  """
+  return (args.num_views > 1 and shared_layout.get('layout_id') ==
+          output_index - output_index % args.num_views)
+
+
+def set_directions(scene_struct, camera):
+  """
+  Figure out the left, up, and behind directions along the plane as seen
+  from camera and record them in the scene structure
+  """
+  # The ground plane is horizontal, so its normal is the world up vector
+  plane_normal = Vector((0, 0, 1))
+  cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
+  cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
+  cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
+  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
+  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
+  plane_up = cam_up.project(plane_normal).normalized()
+
+  # Save all six axis-aligned directions in the scene struct
+  scene_struct['directions']['behind'] = tuple(plane_behind)
+  scene_struct['directions']['front'] = tuple(-plane_behind)
+  scene_struct['directions']['left'] = tuple(plane_left)
+  scene_struct['directions']['right'] = tuple(-plane_left)
+  scene_struct['directions']['above'] = tuple(plane_up)
+  scene_struct['directions']['below'] = tuple(-plane_up)
+
+
+def place_view_camera(args):
+  """
+  Move the camera to a new view of the layout in shared_layout: a viewpoint
+  screened by sample_view and confirmed by a visibility render. Only the
+  camera is retried; if no viewpoint passes within --max_retries visibility
+  renders, the camera is put back at the layout's own viewpoint, which
+  passed when the layout was built, and False is returned.
+  """
+  camera = bpy.data.objects['Camera']
+  for _ in range(args.max_retries):
+    location = sample_view(args, shared_layout['positions'])
+    if location is None:
+      break
+    camera.location = location
+    bpy.context.scene.update()
+    if check_visibility(shared_layout['blender_objects'],
+                        args.min_pixels_per_object):
+      return True
+    telemetry.count('view_rejects')
+  camera.location = shared_layout['camera_location']
+  bpy.context.scene.update()
+  return False
+
+
+def sample_view(args, positions):
+  """
+  Pick a jittered camera location for another view of the current layout
+  under which the objects keep the placement rules (the directions turn with
+  the camera) and are estimated to be visible. Returns None if there is none
+  within --max_retries tries.
+  """
+  camera = utils.get_camera_model(bpy.data.objects['Camera'])
+  base = shared_layout['base_camera_location']
+  for _ in range(args.max_retries):
+    location = [c + 2.0 * args.camera_jitter * (random.random() - 0.5)
+                for c in base]
+    view = camera.moved(location)
+    directions = layout.camera_directions(view)
+    if not all(layout.placement_ok(x, y, r, positions[:i], directions,
+                                   args.min_dist, args.margin)
+               for i, (x, y, r) in enumerate(positions)):
+      continue
+    if min(layout.visible_pixels(positions, view)) < args.min_pixels_per_object:
+      continue
+    return location
+  return None
+
+
+def start_layout_pipeline(args, indices):
+  """
+  Start the layout sampler process for the given image indices (see
+  layout_sampler.py). It is configured from the base scene, which must be
+  loaded. Returns None if the process cannot be started.
+  """
+  camera = bpy.data.objects['Camera']
+  base = utils.get_camera_model(camera)
+  # Further views of a layout do not need one of their own
+  pending = set(indices)
+  indices = [idx for idx in indices
+             if idx % args.num_views == 0 or idx - 1 not in pending]
+  config = {
+    'indices': indices,
+    'seed': args.seed,
+    'num_views': args.num_views,
+    'camera': layout.CameraModel(base.matrix_world, base.angle,
+                                 args.width, args.height).to_dict(),
+    'camera_jitter': args.camera_jitter,
+    'lamp_locations': {name: tuple(bpy.data.objects[name].location)
+                       for name in LAMP_NAMES},
+    'lamp_jitter': {'Lamp_Key': args.key_light_jitter,
+                    'Lamp_Fill': args.fill_light_jitter,
+                    'Lamp_Back': args.back_light_jitter},
+    'min_objects': args.min_objects,
+    'max_objects': args.max_objects,
+    'min_dist': args.min_dist,
+    'margin': args.margin,
+    'min_pixels_per_object': args.min_pixels_per_object,
+    'max_retries': args.max_retries,
+    'properties_json': args.properties_json,
+    'shape_color_combos_json': args.shape_color_combos_json,
   }
+  python = args.pipeline_python or bpy.app.binary_path_python
+  try:
+    return layout_sampler.LayoutPipeline(config, python=python,
+                                         queue_size=args.pipeline_queue_size)
+  except OSError as e:
+    logger.warning("Could not start the layout sampler (%s); sampling "
+                   "layouts in Blender" % e)
+    return None
+
+
+def reset_scene(args):
+  """
+  Bring the scene back to the base scene before placing new objects, either
+  by reloading the file (--scene_reset revert) or by removing what the last
+  scene added (--scene_reset purge), and make sure the materials are loaded.
+  """
+  with telemetry.phase('reset'):
+    if args.scene_reset == 'revert':
+      bpy.ops.wm.revert_mainfile()
+      memory.materials_loaded = False
+    else:
+      memory.restore()
+
+  # Load materials
+  with telemetry.phase('load_materials'):
+    if not memory.materials_loaded:
+      utils.load_materials(args.material_dir)
+      memory.materials_loaded = True
+
+
+def is_index_complete(args, index, img_template, scene_template, logged):
+  """
+  Check whether all outputs for an image index exist and are complete: the
+  PNGs must be whole and have the requested resolution and the scenes must be
+  in the scene log (logged, from io_utils.scan_scene_log) and, unless
+  --save_scene_files 0, the scene files must parse. In action mode this
+  requires the new and cor images and the new, cor and cb scenes; the cb scene
+  is written last, after everything else.
+  """
+  if args.action:
+    image_splits = [args.split, args.asplit]
+    scene_splits = [args.split, args.asplit, args.csplit]
+  else:
+    image_splits = scene_splits = [args.split]
+  for split in image_splits:
+    if not io_utils.is_valid_png(img_template % (split, index),
+                                 args.width, args.height):
+      return False
+    for variant in variants:
+      if not io_utils.is_valid_png(
+          variant_image_path(img_template % (split, index), variant),
+          variant.width, variant.height):
+        return False
+  for split in scene_splits:
+    if (split, index) not in logged:
+      return False
+    if args.save_scene_files and \
+        not io_utils.is_valid_json(scene_template % (split, index)):
+      return False
+  return True
 
-  all_cb_scene_output = {
-    'info': {
-      'date': args.date,
-      'version': args.version,
-      'split': args.csplit,
-      'license': args.license,
-    },
-    'scenes': all_combined_scenes
+
+def save_scene(args, split, scene_struct, output_scene):
+  """
+  Append a finished scene to the scene log under the output split it belongs
+  to and, unless --save_scene_files 0, also write it to its own JSON file.
+  """
+  with telemetry.phase('json_write'):
+    if args.save_scene_files:
+      io_utils.write_json(output_scene, scene_struct, indent=2)
+    scene_log.append(split, scene_struct)
+
+
+def render_image(output_image):
+  """
+  Render the current scene and write it to output_image. The image is first
+  written to a temporary file in the same directory and then renamed, so a
+  crash while writing never leaves a truncated PNG under the final name.
+
+  With --async_write 1 Blender writes an uncompressed TGA instead, which is
+  handed to the background image writer to be encoded as a PNG.
+  """
+  render_args = bpy.context.scene.render
+  if image_writer is None:
+    tmp_image = io_utils.temp_path(output_image)
+    render_args.filepath = tmp_image
+    bpy.ops.render.render(write_still=True)
+    os.replace(tmp_image, output_image)
+    render_args.filepath = output_image
+    return
+
+  raw_image = os.path.splitext(io_utils.temp_path(output_image, 'raw'))[0]
+  raw_image += '.tga'
+  old_format = render_args.image_settings.file_format
+  render_args.image_settings.file_format = 'TARGA_RAW'
+  render_args.filepath = raw_image
+  try:
+    bpy.ops.render.render(write_still=True)
+  finally:
+    render_args.image_settings.file_format = old_format
+    render_args.filepath = output_image
+  with telemetry.phase('write_wait'):
+    image_writer.submit(raw_image, output_image)
+
+
+def flush_images():
+  """ Wait until the background image writer has written all images """
+  if image_writer is not None:
+    with telemetry.phase('write_wait'):
+      image_writer.flush()
+
+
+def finish_image(args, output_index, img_template, scene_json):
+  """
+  Record that all outputs of output_index are written: make the
+  --resolution_variants of its images, pack the sample into the current shard
+  if --output_shard_dir is set, then append the index to the progress log.
+  With --async_write 1 this runs on the image writer thread after the images
+  of output_index have been written.
+  """
+  image_splits = [args.split, args.asplit] if args.action else [args.split]
+  if variants:
+    for split in image_splits:
+      image = img_template % (split, output_index)
+      resolutions.write_variant_images(
+          image, lambda variant: variant_image_path(image, variant), variants,
+          args.png_compression)
+  if shard_writer is not None:
+    scene_split = args.csplit if args.action else args.split
+    if scene_json is None:
+      raise RuntimeError('No %s scene was logged for image %d, so it cannot '
+                         'be packed into a shard' % (scene_split, output_index))
+    members = [('%s.png' % split, img_template % (split, output_index))
+               for split in image_splits]
+    for variant in variants:
+      members += [('%s.%s.png' % (split, variant.name),
+                   variant_image_path(img_template % (split, output_index),
+                                      variant))
+                  for split in image_splits]
+    members.append(('%s.json' % scene_split, scene_json.encode('utf-8')))
+    shard_writer.write(output_index,
+                       '%s_%06d' % (args.filename_prefix, output_index),
+                       members)
+    if args.remove_packed_files:
+      for _, path in members[:-1]:
+        os.remove(path)
+  with open(args.log_file, "a") as f:
+    f.write(str(output_index + 1) + "\n")
+
+
+def variant_image_path(image, variant):
+  """ Path of a --resolution_variants variant of the image at path image """
+  dirname, basename = os.path.split(image)
+  return os.path.join(dirname, variant.name, basename)
+
+
+def get_render_cache_key(args, scene_struct, region=None):
+  """
+  Hash everything that determines the rendered image of scene_struct: the
+  objects and their placement, the camera and lamps, the render settings,
+  the output encoding and the asset files. For a partial cor render, region
+  is the rendered box, which depends on --partial_render_padding. Returns
+  None without a cache.
+  """
+  if render_cache is None:
+    return None
+  global asset_hash
+  if asset_hash is None:
+    asset_hash = cache.hash_files([args.base_scene_blendfile,
+                                   args.properties_json, args.shape_dir,
+                                   args.material_dir])
+  keys = ['shape', 'size', 'material', 'color', '3d_coords', 'rotation']
+  spec = {
+    'objects': [{k: obj[k] for k in keys} for obj in scene_struct['objects']],
+    'camera_location': scene_struct['camera_location'],
+    'lamp_locations': scene_struct['lamp_locations'],
+    'render_info': scene_struct['render_info'],
+    'use_gpu': args.use_gpu is not None,
+    'png': [args.async_write, args.png_compression, args.png_color_mode],
+    'partial': list(region) if region is not None else None,
+    'assets': asset_hash,
   }
-  with open(args.output_cb_scene_file, 'w') as f:
-    json.dump(all_cb_scene_output, f)
+  return render_cache.key(spec)
 
-  with open(args.output_scene_file, 'w') as f:
-    json.dump(all_scene_output, f)
 
-  with open(args.output_count_file, 'w') as f:
-    json.dump(counts, f)
+def fetch_cached_image(cache_key, output_image):
+  """ Put the cached image for cache_key at output_image if there is one """
+  if cache_key is None or not render_cache.fetch(cache_key, output_image):
+    return False
+  telemetry.count('render_cache_hits')
+  return True
 
-  if not args.render_verbose:
-    render_log.off()
 
+def store_cached_image(cache_key, output_image):
+  """ Add output_image to the cache once it has been written """
+  if cache_key is None:
+    return
+  if image_writer is None:
+    render_cache.store(cache_key, output_image)
+  else:
+    image_writer.call(render_cache.store, cache_key, output_image)
 
-def render_scene(args,
-    num_objects=5,
-    output_index=0,
-    output_split='none',
-    output_image='render.png',
-    output_scene='render.json',
-    output_blendfile=None,
-  ):
 
-  render_success = False
+def render_image_region(output_image, base_image, box):
+  """
+  Render only the pixels inside box (x0, y0, x1, y1) and composite them onto
+  the image in base_image, writing the result atomically to output_image. All
+  pixels outside of box are taken from base_image unchanged.
+  """
+  render_args = bpy.context.scene.render
+  w, h = render_args.resolution_x, render_args.resolution_y
+  x0, y0, x1, y1 = box
+  region_image = io_utils.temp_path(output_image, 'region')
+
+  # Border coordinates are fractions of the image with y going up
+  render_args.use_border = True
+  render_args.use_crop_to_border = False
+  render_args.border_min_x = float(x0) / w
+  render_args.border_max_x = float(x1) / w
+  render_args.border_min_y = 1.0 - float(y1) / h
+  render_args.border_max_y = 1.0 - float(y0) / h
+  render_args.filepath = region_image
+  try:
+    bpy.ops.render.render(write_still=True)
+  finally:
+    render_args.use_border = False
+    render_args.filepath = output_image
 
-  # Load the main blendfile
-  # bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
-  bpy.ops.wm.revert_mainfile()
+  tmp_image = io_utils.temp_path(output_image)
+  utils.composite_region(base_image, region_image, tmp_image, box)
+  os.remove(region_image)
+  os.replace(tmp_image, output_image)
 
-  # Load materials
-  utils.load_materials(args.material_dir)
 
+def get_cor_render_region(args, scene_change_counts, blender_objects, camera):
+  """
+  Find the part of the cor image that can differ from the new image. Returns
+  None if the whole image has to be rendered, an empty box (0, 0, 0, 0) if
+  nothing changed, and otherwise the pixel box (x0, y0, x1, y1) around the
+  recolored objects and the shadows they cast from every lamp.
+  """
+  # Objects are placed by setting their location directly, so make sure
+  # their world matrices are up to date before projecting them
+  bpy.context.scene.update()
+  render_args = bpy.context.scene.render
+  w, h = render_args.resolution_x, render_args.resolution_y
+  lamps = [bpy.data.objects[name] for name in LAMP_NAMES]
+  boxes = []
+  for obj_id, obj_counts in zip(scene_change_counts['obj_id'],
+                                scene_change_counts['counts']):
+    # A moved object changes shadows and reflections all over the scene
+    if obj_counts[SIZE_CHANGED] > 0:
+      return None
+    if obj_counts[COLOR_CHANGED] > 0 or obj_counts[MAT_CHANGED] > 0:
+      boxes.append(utils.get_screen_bbox(camera, blender_objects[obj_id],
+                                         lamps=lamps,
+                                         padding=args.partial_render_padding))
+  if not boxes:
+    return (0, 0, 0, 0)
+  x0 = min(b[0] for b in boxes)
+  y0 = min(b[1] for b in boxes)
+  x1 = max(b[2] for b in boxes)
+  y1 = max(b[3] for b in boxes)
+  if (x1 - x0) * (y1 - y0) > args.partial_render_max_area * w * h:
+    return None
+  return (x0, y0, x1, y1)
+
+
+def configure_render(args, output_image):
+  """
+  Set up the renderer for the current scene: resolution, devices and sampling.
+  Returns a dict describing the effective render settings, which is stored in
+  the "render_info" field of each scene structure.
+  """
   # Set render arguments so we can get pixel coordinates later.
   # We use functionality specific to the CYCLES renderer so BLENDER_RENDER
   # cannot be used.
@@ -341,7 +948,6 @@ def render_scene(args,
   render_args.resolution_percentage = 100
   render_args.tile_x = args.render_tile_size
   render_args.tile_y = args.render_tile_size
-
   if args.use_gpu is not None:
     # Blender changed the API for enabling CUDA at some point
     if bpy.app.version < (2, 78, 0):
@@ -365,12 +971,131 @@ def render_scene(args,
   # Some CYCLES-specific stuff
   bpy.data.worlds['World'].cycles.sample_as_light = True
   bpy.context.scene.cycles.blur_glossy = 2.0
-  bpy.context.scene.cycles.samples = args.render_num_samples
-  bpy.context.scene.cycles.transparent_min_bounces = args.render_min_bounces
-  bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
   if args.use_gpu is not None:
     bpy.context.scene.cycles.device = 'GPU'
 
+  render_info = configure_sampling(args)
+  render_info['width'] = args.width
+  render_info['height'] = args.height
+  render_info['blender_version'] = bpy.app.version_string
+  return render_info
+
+
+def configure_sampling(args):
+  """
+  Set the Cycles sample count, bounces, adaptive sampling and denoising from
+  the --render_profile (or from the individual --render_* flags if no profile
+  is given). Adaptive sampling is only used where the running Blender version
+  supports it, and otherwise the profile's fixed sample count is rendered.
+  Returns the settings read back from the scene after setting them.
+  """
+  if args.render_profile is None:
+    profile = {
+      'samples': args.render_num_samples,
+      'fixed_samples': args.render_num_samples,
+      'min_bounces': args.render_min_bounces,
+      'max_bounces': args.render_max_bounces,
+      'adaptive_threshold': None,
+      'adaptive_min_samples': 0,
+      'denoise': False,
+    }
+  else:
+    profile = RENDER_PROFILES[args.render_profile]
+
+  scene = bpy.context.scene
+  cycles = scene.cycles
+  cycles.transparent_min_bounces = profile['min_bounces']
+  cycles.transparent_max_bounces = profile['max_bounces']
+
+  # Adaptive sampling was added to Cycles in Blender 2.83
+  has_adaptive = hasattr(cycles, 'use_adaptive_sampling')
+  adaptive = has_adaptive and profile['adaptive_threshold'] is not None
+  if has_adaptive:
+    cycles.use_adaptive_sampling = adaptive
+  if adaptive:
+    cycles.samples = profile['samples']
+    cycles.adaptive_threshold = profile['adaptive_threshold']
+    cycles.adaptive_min_samples = profile['adaptive_min_samples']
+  else:
+    cycles.samples = profile['fixed_samples']
+
+  # Denoising is a render layer setting in Blender 2.79 and a scene setting
+  # from 2.81 on; older versions do not have it at all
+  denoise_flags = []
+  for layer in getattr(scene.render, 'layers', []):
+    if hasattr(layer.cycles, 'use_denoising'):
+      layer.cycles.use_denoising = profile['denoise']
+      denoise_flags.append(layer.cycles.use_denoising)
+  if not denoise_flags and hasattr(cycles, 'use_denoising'):
+    cycles.use_denoising = profile['denoise']
+    denoise_flags.append(cycles.use_denoising)
+
+  return {
+    'profile': args.render_profile,
+    'samples': cycles.samples,
+    'min_bounces': cycles.transparent_min_bounces,
+    'max_bounces': cycles.transparent_max_bounces,
+    'adaptive_threshold': cycles.adaptive_threshold if adaptive else None,
+    'adaptive_min_samples': cycles.adaptive_min_samples if adaptive else 0,
+    'denoise': any(denoise_flags),
+  }
+
+
+def warn_unsupported_sampling(args):
+  """
+  Log once which parts of --render_profile the running Blender version
+  cannot apply
+  """
+  if args.render_profile is None:
+    return
+  profile = RENDER_PROFILES[args.render_profile]
+  scene = bpy.context.scene
+  if not hasattr(scene.cycles, 'use_adaptive_sampling'):
+    logger.warning("Blender %s has no adaptive sampling; the %s profile "
+                   "renders a fixed %d samples per pixel"
+                   % (bpy.app.version_string, args.render_profile,
+                      profile['fixed_samples']))
+  has_denoising = hasattr(scene.cycles, 'use_denoising') or any(
+      hasattr(layer.cycles, 'use_denoising')
+      for layer in getattr(scene.render, 'layers', []))
+  if profile['denoise'] and not has_denoising:
+    logger.warning("Blender %s has no denoising; the %s profile renders "
+                   "without it" % (bpy.app.version_string,
+                                   args.render_profile))
+
+
+def render_scene(args,
+    num_objects=5,
+    output_index=0,
+    output_split='none',
+    output_image='render.png',
+    output_scene='render.json',
+    output_blendfile=None,
+    spec=None,
+  ):
+
+  render_success = False
+
+  # With --num_views, the views of a layout share its objects and lamps and
+  # only move the camera. The layout is a function of its layout_id alone, so
+  # whichever of its views comes first builds it.
+  layout_id = output_index - output_index % args.num_views
+  view_index = output_index - layout_id
+  reuse = reuses_layout(args, output_index)
+  if not reuse:
+    # Load the main blendfile
+    # bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
+    reset_scene(args)
+    shared_layout.clear()
+    shared_layout['base_camera_location'] = \
+      tuple(bpy.data.objects['Camera'].location)
+    if args.num_views > 1 and args.seed is not None:
+      seed_index(args.seed, layout_id, stream='layout')
+      if spec is None:
+        num_objects = random.randint(args.min_objects, args.max_objects)
+
+  render_info = configure_render(args, output_image)
+
   # This will give ground-truth information about the scene and its objects
   scene_struct = {
       'split': output_split,
@@ -378,63 +1103,88 @@ def render_scene(args,
       'image_filename': os.path.basename(output_image),
       'objects': [],
       'directions': {},
+      'render_info': render_info,
   }
-
-  # Put a plane on the ground so we can compute cardinal directions
-  bpy.ops.mesh.primitive_plane_add(radius=5)
-  plane = bpy.context.object
+  if args.num_views > 1:
+    scene_struct['layout_id'] = layout_id
+    scene_struct['view_index'] = view_index
 
   def rand(L):
     return 2.0 * L * (random.random() - 0.5)
 
-  # Add random jitter to camera position
-  if args.camera_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Camera'].location[i] += rand(args.camera_jitter)
-
-  # Figure out the left, up, and behind directions along the plane and record
-  # them in the scene structure
   camera = bpy.data.objects['Camera']
-  plane_normal = plane.data.vertices[0].normal
-  cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
-  cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
-  cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
-  plane_behind = (cam_behind - cam_behind.project(plane_normal)).normalized()
-  plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
-  plane_up = cam_up.project(plane_normal).normalized()
-
-  # Delete the plane; we only used it for normals anyway. The base scene file
-  # contains the actual ground plane.
-  utils.delete_object(plane)
-
-  # Save all six axis-aligned directions in the scene struct
-  scene_struct['directions']['behind'] = tuple(plane_behind)
-  scene_struct['directions']['front'] = tuple(-plane_behind)
-  scene_struct['directions']['left'] = tuple(plane_left)
-  scene_struct['directions']['right'] = tuple(-plane_left)
-  scene_struct['directions']['above'] = tuple(plane_up)
-  scene_struct['directions']['below'] = tuple(-plane_up)
-
-  # Add random jitter to lamp positions
-  if args.key_light_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Lamp_Key'].location[i] += rand(args.key_light_jitter)
-  if args.back_light_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Lamp_Back'].location[i] += rand(args.back_light_jitter)
-  if args.fill_light_jitter > 0:
-    for i in range(3):
-      bpy.data.objects['Lamp_Fill'].location[i] += rand(args.fill_light_jitter)
-
-  # Now make some random objects
-  objects, blender_objects, _ = add_random_objects(scene_struct, num_objects, args, camera)
+  if not reuse:
+    # Add random jitter to camera position, or take the jittered position
+    # from the spec of the layout sampler
+    if spec is not None:
+      camera.location = spec['camera_location']
+    elif args.camera_jitter > 0:
+      for i in range(3):
+        camera.location[i] += rand(args.camera_jitter)
+    set_directions(scene_struct, camera)
+
+    # Add random jitter to lamp positions
+    if spec is not None:
+      for name in LAMP_NAMES:
+        bpy.data.objects[name].location = spec['lamp_locations'][name]
+    elif args.key_light_jitter > 0:
+      for i in range(3):
+        bpy.data.objects['Lamp_Key'].location[i] += rand(args.key_light_jitter)
+    if spec is None and args.back_light_jitter > 0:
+      for i in range(3):
+        bpy.data.objects['Lamp_Back'].location[i] += rand(args.back_light_jitter)
+    if spec is None and args.fill_light_jitter > 0:
+      for i in range(3):
+        bpy.data.objects['Lamp_Fill'].location[i] += rand(args.fill_light_jitter)
+
+    # Now make some random objects
+    if spec is not None:
+      objects, blender_objects, positions = add_objects_from_spec(scene_struct, spec, args, camera)
+    else:
+      objects, blender_objects, positions = add_random_objects(scene_struct, num_objects, args, camera)
+
+    if args.num_views > 1:
+      shared_layout['layout_id'] = layout_id
+      shared_layout['camera_location'] = tuple(camera.location)
+      shared_layout['objects'] = objects
+      shared_layout['blender_objects'] = blender_objects
+      shared_layout['positions'] = positions
+
+  if reuse or view_index > 0:
+    if view_index > 0:
+      # The camera of a view only depends on the image index, whether or
+      # not the layout was just built
+      if args.seed is not None:
+        seed_index(args.seed, output_index)
+      if not place_view_camera(args):
+        telemetry.count('view_fallbacks')
+    else:
+      # The first view is retried after a failed render
+      camera.location = shared_layout['camera_location']
+      bpy.context.scene.update()
+    set_directions(scene_struct, camera)
+    # Project the objects into the new view
+    blender_objects = shared_layout['blender_objects']
+    positions = shared_layout['positions']
+    objects = [dict(record, pixel_coords=utils.get_camera_coords(camera, obj.location))
+               for record, obj in zip(shared_layout['objects'], blender_objects)]
+
+  # Record the jittered camera and lamp positions; together with the objects
+  # they determine the rendered image
+  scene_struct['camera_location'] = tuple(camera.location)
+  scene_struct['lamp_locations'] = {name: tuple(bpy.data.objects[name].location)
+                                    for name in LAMP_NAMES}
 
   # Render the scene and dump the scene data structure
   scene_struct['objects'] = objects
   scene_struct['relationships'] = compute_all_relationships(scene_struct)
   try:
     # if fail, start with a new scene
-    bpy.ops.render.render(write_still=True)
+    with telemetry.phase('render'):
+      cache_key = get_render_cache_key(args, scene_struct)
+      if not fetch_cached_image(cache_key, output_image):
+        render_image(output_image)
+        store_cached_image(cache_key, output_image)
     render_success = True
   except KeyboardInterrupt:
     logging.info("Exit on Ctrl C")
@@ -443,11 +1193,11 @@ def render_scene(args,
     logger.warning("Rendering Failed Due to %s" % traceback.format_exc())
 
   if render_success:
-    with open(output_scene, 'w') as f:
-      json.dump(scene_struct, f, indent=2)
+    save_scene(args, output_split, scene_struct, output_scene)
 
     if output_blendfile is not None:
-      bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+      with telemetry.phase('blend_save'):
+        bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
   return render_success
 
 
@@ -457,6 +1207,7 @@ def render_scene_with_action(args,
     output_image='render.png',
     output_scene='render.json',
     output_blendfile=None,
+    spec=None,
   ):
 
   render_success = False
@@ -476,50 +1227,10 @@ def render_scene_with_action(args,
 
   # Load the main blendfile
   # bpy.ops.wm.open_mainfile(filepath=args.base_scene_blendfile)
-  bpy.ops.wm.revert_mainfile()
-
-  # Load materials
-  utils.load_materials(args.material_dir)
+  reset_scene(args)
 
-  # Set render arguments so we can get pixel coordinates later.
-  # We use functionality specific to the CYCLES renderer so BLENDER_RENDER
-  # cannot be used.
   render_args = bpy.context.scene.render
-  render_args.engine = "CYCLES"
-  render_args.filepath = output_image
-  render_args.resolution_x = args.width
-  render_args.resolution_y = args.height
-  render_args.resolution_percentage = 100
-  render_args.tile_x = args.render_tile_size
-  render_args.tile_y = args.render_tile_size
-  if args.use_gpu is not None:
-    # Blender changed the API for enabling CUDA at some point
-    if bpy.app.version < (2, 78, 0):
-      bpy.context.user_preferences.system.compute_device_type = 'CUDA'
-      bpy.context.user_preferences.system.compute_device = 'CUDA_0'
-    else:
-      cycles_prefs = bpy.context.user_preferences.addons['cycles'].preferences
-      cycles_prefs.compute_device_type = 'CUDA'
-      logger.debug("Setting GPU")
-      for d in cycles_prefs.devices:
-        logger.debug(d.name)
-      # disable all of them first
-      for d in cycles_prefs.devices:
-          d.use = False
-      # Enable CPU
-      cycles_prefs.devices[0].use = True
-      assert len(args.use_gpu) < len(cycles_prefs.devices)
-      for gpu_id in args.use_gpu:
-          cycles_prefs.devices[gpu_id + 1].use = True
-
-  # Some CYCLES-specific stuff
-  bpy.data.worlds['World'].cycles.sample_as_light = True
-  bpy.context.scene.cycles.blur_glossy = 2.0
-  bpy.context.scene.cycles.samples = args.render_num_samples
-  bpy.context.scene.cycles.transparent_min_bounces = args.render_min_bounces
-  bpy.context.scene.cycles.transparent_max_bounces = args.render_max_bounces
-  if args.use_gpu is not None:
-    bpy.context.scene.cycles.device = 'GPU'
+  render_info = configure_render(args, output_image)
 
   # This will give ground-truth information about the scene and its objects
   scene_struct = {
@@ -528,24 +1239,25 @@ def render_scene_with_action(args,
       'image_filename': os.path.basename(output_image),
       'objects': [],
       'directions': {},
+      'render_info': render_info,
   }
 
-  # Put a plane on the ground so we can compute cardinal directions
-  bpy.ops.mesh.primitive_plane_add(radius=5)
-  plane = bpy.context.object
-
   def rand(L):
     return 2.0 * L * (random.random() - 0.5)
 
-  # Add random jitter to camera position
-  if args.camera_jitter > 0:
+  # Add random jitter to camera position, or take the jittered position from
+  # the spec of the layout sampler
+  if spec is not None:
+    bpy.data.objects['Camera'].location = spec['camera_location']
+  elif args.camera_jitter > 0:
     for i in range(3):
       bpy.data.objects['Camera'].location[i] += rand(args.camera_jitter)
 
   # Figure out the left, up, and behind directions along the plane and record
   # them in the scene structure
   camera = bpy.data.objects['Camera']
-  plane_normal = plane.data.vertices[0].normal
+  # The ground plane is horizontal, so its normal is the world up vector
+  plane_normal = Vector((0, 0, 1))
   cam_behind = camera.matrix_world.to_quaternion() * Vector((0, 0, -1))
   cam_left = camera.matrix_world.to_quaternion() * Vector((-1, 0, 0))
   cam_up = camera.matrix_world.to_quaternion() * Vector((0, 1, 0))
@@ -553,10 +1265,6 @@ def render_scene_with_action(args,
   plane_left = (cam_left - cam_left.project(plane_normal)).normalized()
   plane_up = cam_up.project(plane_normal).normalized()
 
-  # Delete the plane; we only used it for normals anyway. The base scene file
-  # contains the actual ground plane.
-  utils.delete_object(plane)
-
   # Save all six axis-aligned directions in the scene struct
   scene_struct['directions']['behind'] = tuple(plane_behind)
   scene_struct['directions']['front'] = tuple(-plane_behind)
@@ -566,25 +1274,41 @@ def render_scene_with_action(args,
   scene_struct['directions']['below'] = tuple(-plane_up)
 
   # Add random jitter to lamp positions
-  if args.key_light_jitter > 0:
+  if spec is not None:
+    for name in LAMP_NAMES:
+      bpy.data.objects[name].location = spec['lamp_locations'][name]
+  elif args.key_light_jitter > 0:
     for i in range(3):
       bpy.data.objects['Lamp_Key'].location[i] += rand(args.key_light_jitter)
-  if args.back_light_jitter > 0:
+  if spec is None and args.back_light_jitter > 0:
     for i in range(3):
       bpy.data.objects['Lamp_Back'].location[i] += rand(args.back_light_jitter)
-  if args.fill_light_jitter > 0:
+  if spec is None and args.fill_light_jitter > 0:
     for i in range(3):
       bpy.data.objects['Lamp_Fill'].location[i] += rand(args.fill_light_jitter)
 
+  # Record the jittered camera and lamp positions; together with the objects
+  # they determine the rendered image
+  scene_struct['camera_location'] = tuple(camera.location)
+  scene_struct['lamp_locations'] = {name: tuple(bpy.data.objects[name].location)
+                                    for name in LAMP_NAMES}
+
   # Now make some random objects
-  objects, blender_objects, positions = add_random_objects(scene_struct, num_objects, args, camera)
+  if spec is not None:
+    objects, blender_objects, positions = add_objects_from_spec(scene_struct, spec, args, camera)
+  else:
+    objects, blender_objects, positions = add_random_objects(scene_struct, num_objects, args, camera)
 
   # Render the scene and dump the scene data structure
   scene_struct['objects'] = objects
   scene_struct['relationships'] = compute_all_relationships(scene_struct)
   try:
     # if fail, start with a new scene
-    bpy.ops.render.render(write_still=True)
+    with telemetry.phase('render'):
+      cache_key = get_render_cache_key(args, scene_struct)
+      if not fetch_cached_image(cache_key, output_image):
+        render_image(output_image)
+        store_cached_image(cache_key, output_image)
     render_success = True
   except KeyboardInterrupt:
     logging.info("Exit on Ctrl C")
@@ -593,11 +1317,11 @@ def render_scene_with_action(args,
     logger.warning("Rendering Failed Due to %s" % traceback.format_exc())
 
   if render_success:
-    with open(output_scene, 'w') as f:
-      json.dump(scene_struct, f, indent=2)
+    save_scene(args, args.split, scene_struct, output_scene)
 
     if output_blendfile is not None:
-      bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+      with telemetry.phase('blend_save'):
+        bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
 
   #########################################################################
   # Render a second image based on the first one: only one property changed
@@ -605,6 +1329,7 @@ def render_scene_with_action(args,
   # start second image only if first image succeeds
   if args.action and render_success:
     render_success = False
+    base_image = output_image
     # reset output filenames
     output_image = image_template % (args.asplit, output_index)
     output_scene = scene_template % (args.asplit, output_index)
@@ -614,28 +1339,61 @@ def render_scene_with_action(args,
     # reset render args
     render_args.filepath = output_image
 
-    # copy scene_struct
-    scene_struct_action = copy.deepcopy(scene_struct)
-
-    # reset for action objects
-    scene_struct_action['split'] = args.asplit
-    scene_struct_action['image_filename'] = os.path.basename(output_image)
-    scene_struct_action['objects'] = []
-
-    # modify one property based on objects and blender_objects
-    scene_change_counts, objects_action, blender_objects_action, positions_action = \
-      modify_objects(args, number_objects=1,
-                     objects=copy.deepcopy(objects), blender_objects=blender_objects,
-                     positions=copy.deepcopy(positions), scene_struct=copy.deepcopy(scene_struct_action),
-                     camera=camera, max_prop_change=1)
+    # The action scene shares directions and render info with the original
+    # scene. modify_objects replaces the records of the objects it changes
+    # instead of editing them, so the two object lists can share all records
+    # of unchanged objects; only the lists themselves are copied.
+    scene_struct_action = {
+        'split': args.asplit,
+        'image_index': output_index,
+        'image_filename': os.path.basename(output_image),
+        'objects': [],
+        'directions': scene_struct['directions'],
+        'render_info': scene_struct['render_info'],
+        'camera_location': scene_struct['camera_location'],
+        'lamp_locations': scene_struct['lamp_locations'],
+    }
+
+    # modify one property based on objects and blender_objects; the
+    # scheduler picks the change that keeps the counts on target
+    with telemetry.phase('modify'):
+      change_type = scheduler.next(output_index)
+      scene_change_counts, objects_action, blender_objects_action, positions_action = \
+        modify_objects(args, number_objects=1,
+                       objects=list(objects), blender_objects=blender_objects,
+                       positions=list(positions), scene_struct=scene_struct_action,
+                       camera=camera, change_types=[change_type])
 
     # Render the scene and dump the scene data structure
     scene_struct_action['objects'] = objects_action
     scene_struct_action['relationships'] = compute_all_relationships(scene_struct_action)
 
+    region = None
+    if args.partial_cor_render:
+      region = get_cor_render_region(args, scene_change_counts,
+                                     blender_objects_action, camera)
+      # The cor image is built from the new image, so that has to be written
+      if region is not None:
+        flush_images()
     try:
       # if fail, start with a new scene
-      bpy.ops.render.render(write_still=True)
+      with telemetry.phase('cor_render'):
+        # Partial renders differ from full renders in their noise, and from
+        # each other in the rendered box, so they are cached separately
+        cache_key = get_render_cache_key(args, scene_struct_action,
+                                         region=region)
+        if fetch_cached_image(cache_key, output_image):
+          pass
+        elif region is None:
+          render_image(output_image)
+        elif region == (0, 0, 0, 0):
+          # Nothing changed, so the cor image is identical to the new image
+          tmp_image = io_utils.temp_path(output_image)
+          shutil.copyfile(base_image, tmp_image)
+          os.replace(tmp_image, output_image)
+        else:
+          render_image_region(output_image, base_image, region)
+        store_cached_image(cache_key, output_image)
       render_success = True
     except KeyboardInterrupt:
       logging.info("Exit on Ctrl C")
@@ -644,11 +1402,11 @@ def render_scene_with_action(args,
       logger.warning("Rendering Failed Due to %s" % traceback.format_exc())
 
     if render_success:
-      with open(output_scene, 'w') as f:
-        json.dump(scene_struct_action, f, indent=2)
+      save_scene(args, args.asplit, scene_struct_action, output_scene)
 
       if output_blendfile is not None:
-        bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
+        with telemetry.phase('blend_save'):
+          bpy.ops.wm.save_as_mainfile(filepath=output_blendfile)
 
       #############################################################
       # Generate a combined scene json file for question generating
@@ -666,11 +1424,14 @@ def render_scene_with_action(args,
          'cor_image_filename': scene_struct_action['image_filename'],
          'cor_objects': scene_struct_action['objects'],
          'cor_directions': scene_struct_action['directions'],
-         'scene_change_counts': scene_change_counts}
+         'scene_change_counts': scene_change_counts,
+         'render_info': scene_struct['render_info']}
 
       # create temperary scene_struct that contains two set of objects stack tgt
-      scene_struct_combined_temps = copy.deepcopy(scene_struct_combined)
-      scene_struct_combined_temps['objects'].extend(scene_struct_combined_temps['cor_objects'])
+      scene_struct_combined_temps = {
+        'directions': scene_struct['directions'],
+        'objects': objects + objects_action,
+      }
 
       # compute relationships of the same index
       scene_struct_combined['relationships'] = \
@@ -687,7 +1448,7 @@ def render_scene_with_action(args,
         # only work for one obj and one property change
         type_of_change = None
         for (prop, num_counts) in obj_count_dict.items():
-          counts[prop] += num_counts
+          scheduler.record(prop, num_counts)
           if num_counts > 0:
             type_of_change = prop
 
@@ -697,8 +1458,10 @@ def render_scene_with_action(args,
         else:
           changes['type'] = type_of_change
           changes['id'] = obj_id
-          changes['obj'] = copy.deepcopy(objects[obj_id])
-          changes['cobj'] = copy.deepcopy(objects_action[obj_id])
+          # Object records only hold immutable values, so a shallow copy is
+          # enough to add the direction flags below
+          changes['obj'] = dict(objects[obj_id])
+          changes['cobj'] = dict(objects_action[obj_id])
           index_of_cobj_combined = len(objects) + obj_id
 
           for direction, relations_to_obj in scene_struct_combined['relationships'].items():
@@ -723,8 +1486,7 @@ def render_scene_with_action(args,
       scene_struct_combined['changes'] = changes
 
 
-      with open(output_scene, 'w') as f:
-        json.dump(scene_struct_combined, f, indent=2)
+      save_scene(args, args.csplit, scene_struct_combined, output_scene)
   return render_success
 
 def add_random_objects(scene_struct, num_objects, args, camera):
@@ -732,76 +1494,69 @@ def add_random_objects(scene_struct, num_objects, args, camera):
   Add random objects to the current blender scene
   """
 
-  # Load the property file
-  with open(args.properties_json, 'r') as f:
-    properties = json.load(f)
-    color_name_to_rgba = {}
-    for name, rgb in properties['colors'].items():
-      rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-      color_name_to_rgba[name] = rgba
-    material_mapping = [(v, k) for k, v in properties['materials'].items()]
-    object_mapping = [(v, k) for k, v in properties['shapes'].items()]
-    size_mapping = list(properties['sizes'].items())
-
-  shape_color_combos = None
-  if args.shape_color_combos_json is not None:
-    with open(args.shape_color_combos_json, 'r') as f:
-      shape_color_combos = list(json.load(f).items())
+  # The property files are only parsed the first time they are needed
+  vocab = vocabulary.load_vocabulary(args.properties_json,
+                                     args.shape_color_combos_json)
 
   positions = []
   objects = []
   blender_objects = []
   for i in range(num_objects):
     # Choose a random size
-    size_name, r = random.choice(size_mapping)
+    size_name, r = random.choice(vocab.size_mapping)
 
     # Try to place the object, ensuring that we don't intersect any existing
     # objects and that we are more than the desired margin away from all existing
     # objects along all cardinal directions.
     num_tries = 0
-    while True:
-      # If we try and fail to place an object too many times, then delete all
-      # the objects in the scene and start over.
-      num_tries += 1
-      if num_tries > args.max_retries:
-        for obj in blender_objects:
-          utils.delete_object(obj)
-        return add_random_objects(scene_struct, num_objects, args, camera)
-      x = random.uniform(-3, 3)
-      y = random.uniform(-3, 3)
-      # Check to make sure the new object is further than min_dist from all
-      # other objects, and further than margin along the four cardinal directions
-      dists_good = True
-      margins_good = True
-      for (xx, yy, rr) in positions:
-        dx, dy = x - xx, y - yy
-        dist = math.sqrt(dx * dx + dy * dy)
-        if dist - r - rr < args.min_dist:
-          dists_good = False
+    with telemetry.phase('placement'):
+      while True:
+        # If we try and fail to place an object too many times, then delete all
+        # the objects in the scene and start over.
+        num_tries += 1
+        if num_tries > args.max_retries:
           break
-        for direction_name in ['left', 'right', 'front', 'behind']:
-          direction_vec = scene_struct['directions'][direction_name]
-          assert direction_vec[2] == 0
-          margin = dx * direction_vec[0] + dy * direction_vec[1]
-          if 0 < margin < args.margin:
-            print("BROKEN MARGIN: %.2f %2f %s" % (margin, args.margin, direction_name))
-            margins_good = False
+        x = random.uniform(-3, 3)
+        y = random.uniform(-3, 3)
+        # Check to make sure the new object is further than min_dist from all
+        # other objects, and further than margin along the four cardinal directions
+        dists_good = True
+        margins_good = True
+        for (xx, yy, rr) in positions:
+          dx, dy = x - xx, y - yy
+          dist = math.sqrt(dx * dx + dy * dy)
+          if dist - r - rr < args.min_dist:
+            dists_good = False
+            break
+          for direction_name in ['left', 'right', 'front', 'behind']:
+            direction_vec = scene_struct['directions'][direction_name]
+            assert direction_vec[2] == 0
+            margin = dx * direction_vec[0] + dy * direction_vec[1]
+            if 0 < margin < args.margin:
+              print("BROKEN MARGIN: %.2f %2f %s" % (margin, args.margin, direction_name))
+              margins_good = False
+              break
+          if not margins_good:
             break
-        if not margins_good:
-          break
 
-      if dists_good and margins_good:
-        break
+        if dists_good and margins_good:
+          break
+    telemetry.count('placement_attempts', num_tries)
+    if num_tries > args.max_retries:
+      telemetry.count('placement_restarts')
+      for obj in blender_objects:
+        utils.delete_object(obj)
+      return add_random_objects(scene_struct, num_objects, args, camera)
 
     # Choose random color and shape
-    if shape_color_combos is None:
-      obj_name, obj_name_out = random.choice(object_mapping)
-      color_name, rgba = random.choice(list(color_name_to_rgba.items()))
+    if vocab.shape_color_combos is None:
+      obj_name, obj_name_out = random.choice(vocab.object_mapping)
+      color_name, rgba = random.choice(vocab.color_items)
     else:
-      obj_name_out, color_choices = random.choice(shape_color_combos)
+      obj_name_out, color_choices = random.choice(vocab.shape_color_combos)
       color_name = random.choice(color_choices)
-      obj_name = [k for k, v in object_mapping if v == obj_name_out][0]
-      rgba = color_name_to_rgba[color_name]
+      obj_name = vocab.shapes[obj_name_out]
+      rgba = vocab.color_name_to_rgba[color_name]
 
     # For cube, adjust the size a bit
     if obj_name == 'Cube':
@@ -811,14 +1566,14 @@ def add_random_objects(scene_struct, num_objects, args, camera):
     theta = 360.0 * random.random()
 
     # Actually add the object to the scene
-    utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
-    obj = bpy.context.object
-    blender_objects.append(obj)
-    positions.append((x, y, r))
+    with telemetry.phase('object_setup'):
+      obj = utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
+      blender_objects.append(obj)
+      positions.append((x, y, r))
 
-    # Attach a random material
-    mat_name, mat_name_out = random.choice(material_mapping)
-    utils.add_material(mat_name, Color=rgba)
+      # Attach a random material
+      mat_name, mat_name_out = random.choice(vocab.material_mapping)
+      utils.add_material(mat_name, Color=rgba)
 
     # Record data about the object in the scene data structure
     pixel_coords = utils.get_camera_coords(camera, obj.location)
@@ -838,6 +1593,7 @@ def add_random_objects(scene_struct, num_objects, args, camera):
     # If any of the objects are fully occluded then start over; delete all
     # objects from the scene and place them all again.
     logger.debug('Some objects are occluded; replacing objects')
+    telemetry.count('visibility_restarts')
     for obj in blender_objects:
       utils.delete_object(obj)
     return add_random_objects(scene_struct, num_objects, args, camera)
@@ -845,29 +1601,73 @@ def add_random_objects(scene_struct, num_objects, args, camera):
   return objects, blender_objects, positions
 
 
+def add_objects_from_spec(scene_struct, spec, args, camera):
+  """
+  Add the objects of a scene spec from the layout sampler to the current
+  blender scene. The sampler has only estimated visibility, so it is checked
+  as usual; if the spec fails that check, or the placement rules under the
+  actual camera directions, the objects are removed and the layout is
+  sampled here instead.
+  """
+  vocab = vocabulary.load_vocabulary(args.properties_json,
+                                     args.shape_color_combos_json)
+
+  positions = []
+  objects = []
+  blender_objects = []
+  with telemetry.phase('object_setup'):
+    for o in spec['objects']:
+      obj = utils.add_object(args.shape_dir, vocab.shapes[o['shape']], o['r'],
+                             (o['x'], o['y']), theta=o['rotation'])
+      blender_objects.append(obj)
+      positions.append((o['x'], o['y'], o['r']))
+      utils.add_material(vocab.materials[o['material']],
+                         Color=vocab.color_name_to_rgba[o['color']])
+
+  for obj, o in zip(blender_objects, spec['objects']):
+    pixel_coords = utils.get_camera_coords(camera, obj.location)
+    objects.append({
+      'shape': o['shape'],
+      'size': o['size'],
+      'material': o['material'],
+      '3d_coords': tuple(obj.location),
+      'rotation': o['rotation'],
+      'pixel_coords': pixel_coords,
+      'color': o['color'],
+    })
+  telemetry.count('placement_restarts', spec['num_restarts'])
+
+  placement_good = all(
+      layout.placement_ok(x, y, r, positions[:i], scene_struct['directions'],
+                          args.min_dist, args.margin)
+      for i, (x, y, r) in enumerate(positions))
+  if placement_good and check_visibility(blender_objects,
+                                         args.min_pixels_per_object):
+    return objects, blender_objects, positions
+
+  logger.debug('Layout from the sampler was rejected; replacing objects')
+  telemetry.count('pipeline_rejects')
+  for obj in blender_objects:
+    utils.delete_object(obj)
+  return add_random_objects(scene_struct, len(spec['objects']), args, camera)
+
+
 def modify_objects(args, number_objects, objects, blender_objects,
     positions, scene_struct,
-    camera, max_prop_change=1
+    camera, change_types
   ):
-  # Load the property file
-  with open(args.properties_json, 'r') as f:
-    properties = json.load(f)
-    color_name_to_rgba = {}
-    for name, rgb in properties['colors'].items():
-      rgba = [float(c) / 255.0 for c in rgb] + [1.0]
-      color_name_to_rgba[name] = rgba
-    material_mapping = [(v, k) for k, v in properties['materials'].items()]
-    size_mapping = list(properties['sizes'].items())
-
-  shape_color_combos = None
-  if args.shape_color_combos_json is not None:
-    with open(args.shape_color_combos_json, 'r') as f:
-      shape_color_combos = list(json.load(f).items())
-
-  # find index of all potential modifications and properties to change
-  pool_of_properties = ["position", "material", "color"]
+  """
+  Apply the given change types (see change_scheduler.py) to number_objects
+  random objects in the current blender scene. The objects, blender_objects
+  and positions lists are updated in place, but the object records in objects
+  are never edited: a changed object gets a new record, so the caller may pass
+  a shallow copy of a list whose records are shared with another scene.
+  """
+  vocab = vocabulary.load_vocabulary(args.properties_json,
+                                     args.shape_color_combos_json)
+
+  # find index of all potential modifications
   indices_modifications = np.random.choice(range(len(objects)), number_objects).tolist()
-  props_modifications = np.random.choice(pool_of_properties, max_prop_change).tolist()
 
   # Create variable to store all changes
   prop_changed = {"obj_id": [], "counts": []}
@@ -881,211 +1681,108 @@ def modify_objects(args, number_objects, objects, blender_objects,
                                          COLOR_CHANGED: 0, COLOR_UNCHANGED: 0,
                                          MAT_CHANGED: 0, MAT_UNCHANGED: 0})
 
-    for prop in props_modifications:
-      if prop == "color":
-        # Choose random color
-        color_name, rgba = random.choice(list(color_name_to_rgba.items()))
-
-        # Count color
-        if color_name != objects[index]['color']:
-          # Change Objects info
-          objects[index]['color'] = color_name
-          # Delete all original materials
-          for i in range(len(blender_obj.data.materials)):
-            blender_obj.data.materials.pop(i)
-          # Set active object to
-          bpy.context.scene.objects.active = blender_obj
-          # Set new color with original mat
-          mat_name_out = objects[index]['material']
-          utils.add_material(properties['materials'][mat_name_out], Color=rgba)
-          prop_changed['counts'][i][COLOR_CHANGED] += 1
-        else:
-          prop_changed['counts'][i][COLOR_UNCHANGED] += 1
+    for change_type in change_types:
+      prop, enable_change = change_scheduler.CHANGE_TYPES[change_type]
+      if not enable_change:
+        # Unchanged pairs keep the scene as it is
+        prop_changed['counts'][i][change_type] += 1
+
+      elif prop == "color":
+        # Choose a random color other than the current one
+        color_name, rgba = random.choice(
+            [(name, rgba) for name, rgba in vocab.color_items
+             if name != objects[index]['color']])
+
+        # Change Objects info; the record may be shared with the original
+        # scene, so replace it rather than editing it
+        objects[index] = dict(objects[index], color=color_name)
+        # Delete all original materials
+        for k in range(len(blender_obj.data.materials)):
+          blender_obj.data.materials.pop(k)
+        # Set active object to
+        bpy.context.scene.objects.active = blender_obj
+        # Set new color with original mat
+        mat_name_out = objects[index]['material']
+        utils.add_material(vocab.materials[mat_name_out], Color=rgba)
+        prop_changed['counts'][i][COLOR_CHANGED] += 1
 
       elif prop == "material":
-        # random select new material
-        mat_name, mat_name_out = random.choice(material_mapping)
-
-        if mat_name_out != objects[index]['material']:
-          # change materials
-          objects[index]['material'] = mat_name_out
-          # Delete all original materials
-          for i in range(len(blender_obj.data.materials)):
-            blender_obj.data.materials.pop(i)
-          # Set active object to
-          bpy.context.scene.objects.active = blender_obj
-          # set new material with original color
-          color_name = objects[index]['color']
-          utils.add_material(mat_name, Color=color_name_to_rgba[color_name])
-          prop_changed['counts'][i][MAT_CHANGED] += 1
-        else:
-          prop_changed['counts'][i][MAT_UNCHANGED] += 1
+        # Choose a random material other than the current one
+        mat_name, mat_name_out = random.choice(
+            [(name, name_out) for name, name_out in vocab.material_mapping
+             if name_out != objects[index]['material']])
+
+        # change materials; replace the possibly shared record
+        objects[index] = dict(objects[index], material=mat_name_out)
+        # Delete all original materials
+        for k in range(len(blender_obj.data.materials)):
+          blender_obj.data.materials.pop(k)
+        # Set active object to
+        bpy.context.scene.objects.active = blender_obj
+        # set new material with original color
+        color_name = objects[index]['color']
+        utils.add_material(mat_name, Color=vocab.color_name_to_rgba[color_name])
+        prop_changed['counts'][i][MAT_CHANGED] += 1
 
       elif prop == "position":
-        # 20% chance to generate unchanged scene
-        enable_change = np.random.choice([True, False], p = [0.8, 0.2])
-
-        if not enable_change:
+        # If the chosen object cannot be moved, try the others before giving
+        # up, so that the pair still gets the scheduled change
+        others = [k for k in range(len(objects)) if k != index]
+        random.shuffle(others)
+        for candidate in [index] + others:
+          if move_object(args, candidate, objects, blender_objects,
+                         positions, scene_struct, camera):
+            prop_changed['obj_id'][i] = candidate
+            prop_changed['counts'][i][SIZE_CHANGED] += 1
+            break
+        else:
           prop_changed['counts'][i][SIZE_UNCHANGED] += 1
 
-        elif enable_change:
-          # get color
-          color_name = objects[index]['color']
-          rgba = color_name_to_rgba[color_name]
-
-          # get materials
-          mat_name_out = objects[index]['material']
-          mat_name = properties['materials'][mat_name_out]
-
-          # get shape
-          obj_name_out = objects[index]['shape']
-          obj_name = properties['shapes'][obj_name_out]
-
-          # get rotation
-          theta = objects[index]['rotation']
-
-          # get previous position
-          (px, py, pr) = positions[index]
-          r, size_name = pr, objects[index]['size']
-          positions.pop(index)
-
-          # Find new position
-          # Try to place the object, ensuring that we don't intersect any existing
-          # objects and that we are more than the desired margin away from all existing
-          # objects along all cardinal directions.
-          num_tries = 0
-          while True:
-            # If we try and fail to place an object too many times, then assign the old position back
-            if num_tries > args.max_retries:
-              break
-            x = random.uniform(-3, 3)
-            y = random.uniform(-3, 3)
-            # Check to make sure the new object is further than min_dist from all
-            # other objects, and further than margin along the four cardinal directions
-            dists_good = True
-            margins_good = True
-            for (xx, yy, rr) in positions:
-              dx, dy = x - xx, y - yy
-              dist = math.sqrt(dx * dx + dy * dy)
-              if dist - r - rr < args.min_dist:
-                dists_good = False
-                break
-              for direction_name in ['left', 'right', 'front', 'behind']:
-                direction_vec = scene_struct['directions'][direction_name]
-                assert direction_vec[2] == 0
-                margin = dx * direction_vec[0] + dy * direction_vec[1]
-                if 0 < margin < args.margin:
-                  print("BROKEN MARGIN: %.2f %2f %s" % (margin, args.margin, direction_name))
-                  margins_good = False
-                  break
-              if not margins_good:
-                break
-
-            if dists_good and margins_good:
-              break
-
-          # there is intersection, save previous position and exit modification
-          if not (dists_good and margins_good):
-            positions.insert(index, (px, py, pr))
-            prop_changed['counts'][i][SIZE_UNCHANGED] += 1
-
-          # no intersection, generate new object
-          else:
-            # add new object
-            utils.add_object(args.shape_dir, obj_name, r, (x, y), theta=theta)
-            obj = bpy.context.object
-            bpy.context.scene.objects.active = obj
-
-            # Attach a random material
-            utils.add_material(mat_name, Color=rgba)
-
-            # delete objects and add the new to the list
-            objects.pop(index)
-            utils.delete_object(blender_obj)
-            blender_objects.pop(index)
-            blender_objects.insert(index, obj)
-            positions.insert(index, (x, y, r))
-
-            # Record data about the object in the scene data structure
-            pixel_coords = utils.get_camera_coords(camera, obj.location)
-            objects.insert(index,{
-                                  'shape': obj_name_out,
-                                  'size': size_name,
-                                  'material': mat_name_out,
-                                  '3d_coords': tuple(obj.location),
-                                  'rotation': theta,
-                                  'pixel_coords': pixel_coords,
-                                  'color': color_name,
-                                })
-            blender_obj = obj
-
-            # Check that all objects are at least partially visible in the rendered image
-            all_visible = check_visibility(blender_objects, args.min_pixels_per_object)
-
-            if all_visible:
-              prop_changed['counts'][i][SIZE_CHANGED] += 1
-
-            else:
-              # not valid scene
-              # add original object back to its old position
-              utils.add_object(args.shape_dir, obj_name, pr, (px, py), theta=theta)
-              obj = bpy.context.object
-              # Delete all original materials
-              for i in range(len(obj.data.materials)):
-                obj.data.materials.pop(i)
-              # Attach a random material
-              utils.add_material(mat_name, Color=rgba)
-
-              # delete old object and add the original back
-              utils.delete_object(blender_obj)
-              blender_objects.pop(index)
-              positions.pop(index)
-              objects.pop(index)
-              blender_objects.insert(index, obj)
-              positions.insert(index, (px, py, pr))
-
-              # Record data about the object in the scene data structure
-              pixel_coords = utils.get_camera_coords(camera, obj.location)
-              objects.insert(index, {
-                'shape': obj_name_out,
-                'size': size_name,
-                'material': mat_name_out,
-                '3d_coords': tuple(obj.location),
-                'rotation': theta,
-                'pixel_coords': pixel_coords,
-                'color': color_name,
-              })
-              # Count unchanged
-              prop_changed['counts'][i][SIZE_UNCHANGED] += 1
-
   return prop_changed, objects, blender_objects, positions
 
 
-def compute_all_relationships(scene_struct, eps=0.2):
+def move_object(args, index, objects, blender_objects, positions,
+                scene_struct, camera):
   """
-  Computes relationships between all pairs of objects in the scene.
-  
-  Returns a dictionary mapping string relationship names to lists of lists of
-  integers, where output[rel][i] gives a list of object indices that have the
-  relationship rel with object i. For example if j is in output['left'][i] then
-  object j is left of object i.
+  Move the object at index to a random new position that keeps the placement
+  constraints, visibly changes its relations and leaves all objects visible.
+  Candidates are screened without Blender first (see layout.py); only a
+  candidate that passes is checked with a visibility render. The object is
+  moved in place, so no assets are loaded. Returns False and leaves the
+  object where it was if there is no such position.
   """
-  all_relationships = {}
-  for name, direction_vec in scene_struct['directions'].items():
-    if name == 'above' or name == 'below': continue
-    all_relationships[name] = []
-    for i, obj1 in enumerate(scene_struct['objects']):
-      coords1 = obj1['3d_coords']
-      related = set()
-      for j, obj2 in enumerate(scene_struct['objects']):
-        if obj1 == obj2: continue
-        coords2 = obj2['3d_coords']
-        diff = [coords2[k] - coords1[k] for k in [0, 1, 2]]
-        dot = sum(diff[k] * direction_vec[k] for k in [0, 1, 2])
-        if dot > eps:
-          related.add(j)
-      all_relationships[name].append(sorted(list(related)))
-  return all_relationships
+  blender_obj = blender_objects[index]
+  position, num_tries = layout.sample_move(
+      positions, index, scene_struct['directions'],
+      utils.get_camera_model(camera), args.min_dist, args.margin,
+      args.min_pixels_per_object, args.max_retries)
+  telemetry.count('move_attempts', num_tries)
+  if position is None:
+    return False
+
+  x, y = position
+  (px, py, r) = positions[index]
+  old_location = blender_obj.location.copy()
+  old_record = objects[index]
+  blender_obj.location = (x, y, old_location[2])
+  positions[index] = (x, y, r)
+  # Replace the record rather than editing it, it may be shared with the
+  # original scene
+  objects[index] = dict(old_record, **{
+    '3d_coords': tuple(blender_obj.location),
+    'pixel_coords': utils.get_camera_coords(camera, blender_obj.location),
+  })
+
+  # Check that all objects are at least partially visible in the rendered image
+  if check_visibility(blender_objects, args.min_pixels_per_object):
+    return True
+
+  # The estimate was too optimistic; put the object back
+  telemetry.count('move_visibility_failures')
+  blender_obj.location = old_location
+  positions[index] = (px, py, r)
+  objects[index] = old_record
+  return False
 
 
 def check_visibility(blender_objects, min_pixels_per_object):
@@ -1099,13 +1796,17 @@ def check_visibility(blender_objects, min_pixels_per_object):
 
   Returns True if all objects are visible and False otherwise.
   """
-  f, path = tempfile.mkstemp(suffix='.png')
-  object_colors = render_shadeless(blender_objects, path=path)
-  img = bpy.data.images.load(path)
-  p = list(img.pixels)
-  color_count = Counter((p[i], p[i+1], p[i+2], p[i+3])
-                        for i in range(0, len(p), 4))
-  os.remove(path)
+  with telemetry.phase('visibility'):
+    f, path = tempfile.mkstemp(suffix='.png')
+    os.close(f)
+    object_colors = render_shadeless(blender_objects, path=path)
+    img = bpy.data.images.load(path)
+    p = list(img.pixels)
+    color_count = Counter((p[i], p[i+1], p[i+2], p[i+3])
+                          for i in range(0, len(p), 4))
+    # Loaded images stay in the file until they are removed
+    bpy.data.images.remove(img)
+    os.remove(path)
   if len(color_count) != len(blender_objects) + 1:
     return False
   for _, count in color_count.most_common():
@@ -1144,15 +1845,12 @@ def render_shadeless(blender_objects, path='flat.png'):
   old_materials = []
   for i, obj in enumerate(blender_objects):
     old_materials.append(obj.data.materials[0])
-    bpy.ops.material.new()
-    mat = bpy.data.materials['Material']
-    mat.name = 'Material_%d' % i
+    mat = utils.get_shadeless_material(i)
     while True:
-      r, g, b = [random.random() for _ in range(3)]
+      r, g, b = [palette_rng.random() for _ in range(3)]
       if (r, g, b) not in object_colors: break
     object_colors.add((r, g, b))
     mat.diffuse_color = [r, g, b]
-    mat.use_shadeless = True
     obj.data.materials[0] = mat
 
   # Render the scene
@@ -1183,12 +1881,57 @@ if __name__ == '__main__':
     args = parser.parse_args(argv)
     if not os.path.isdir(args.output_image_dir):
       os.makedirs(args.output_image_dir)
-    if not os.path.isdir(args.output_scene_dir):
+    if args.save_scene_files and not os.path.isdir(args.output_scene_dir):
       os.makedirs(args.output_scene_dir)
     if args.save_blendfiles == 1 and not os.path.isdir(args.output_blend_dir):
       os.makedirs(args.output_blend_dir)
 
-    render_log = LogRenderInfo('../output/blender_render.log')
+    render_log = LogRenderInfo(args.render_log_file)
+    timing_file = args.timing_file
+    if timing_file is None:
+      timing_file = os.path.splitext(args.log_file)[0] + '_timing.jsonl'
+    telemetry = render_telemetry.RenderTelemetry(timing_file)
+    if args.action and args.num_views > 1:
+      parser.error('--num_views is not supported with --action 1')
+    variants = []
+    if args.resolution_variants:
+      try:
+        variants = resolutions.parse_variants(args.resolution_variants,
+                                              args.width, args.height)
+      except ValueError as e:
+        parser.error(str(e))
+      for variant in variants:
+        variant_dir = os.path.join(args.output_image_dir, variant.name)
+        if not os.path.isdir(variant_dir):
+          os.makedirs(variant_dir)
+      # Variants are decoded and resized on the image writer thread, never
+      # in the render loop
+      args.async_write = 1
+    memory = session.SessionMemory()
+    shared_layout = {}
+    change_counts = None
+    if args.resume:
+      change_counts = change_scheduler.load_counts(args.output_count_file)
+    scheduler = change_scheduler.ChangeScheduler(
+        change_scheduler.parse_distribution(args.change_distribution),
+        counts=change_counts, seed=args.seed)
+    render_cache = None
+    asset_hash = None
+    if args.render_cache_dir is not None:
+      render_cache = cache.RenderCache(args.render_cache_dir)
+    scene_log_dir = os.path.dirname(args.output_scene_log)
+    if scene_log_dir and not os.path.isdir(scene_log_dir):
+      os.makedirs(scene_log_dir)
+    scene_log = io_utils.SceneLog(args.output_scene_log)
+    shard_writer = None
+    if args.output_shard_dir is not None:
+      shard_writer = shards.ShardWriter(
+          args.output_shard_dir, prefix=args.shard_prefix or args.filename_prefix,
+          samples_per_shard=args.samples_per_shard)
+    image_writer = None
+    if args.async_write:
+      image_writer = io_utils.AsyncImageWriter(
+          compress_level=args.png_compression, color_mode=args.png_color_mode)
     if args.debug:
       logging.basicConfig(level=logging.DEBUG)
     else:
@@ -0,0 +1,163 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import copy, json, os
+
+import numpy as np
+
+import io_utils
+
+"""
+Smaller variants of rendered images. A variant such as 320x240 is made from
+the full resolution render by cropping the center to the aspect ratio of the
+variant and then downsampling with an area filter, where every output pixel
+is the exact average of the input pixels it covers. Scenes get their
+pixel_coords mapped into the variant.
+
+The camera of the base scene fits its field of view to the image width, so a
+render that is only shorter than another one is its center rows: a 480x320
+variant cropped from a 480x360 render matches a 480x320 render exactly, and
+so does a 320x240 variant. Variants that need columns cropped have a
+narrower field of view than a render at their size.
+"""
+
+
+class Variant(object):
+  def __init__(self, width, height, source_width, source_height):
+    self.width = width
+    self.height = height
+    self.name = '%dx%d' % (width, height)
+    # The largest centered box of the source with the variant's aspect ratio
+    if width * source_height >= height * source_width:
+      crop_w = source_width
+      crop_h = int(round(source_width * height / float(width)))
+    else:
+      crop_h = source_height
+      crop_w = int(round(source_height * width / float(height)))
+    if crop_w < width or crop_h < height:
+      raise ValueError('Variant %s is larger than the %dx%d render'
+                       % (self.name, source_width, source_height))
+    x0 = (source_width - crop_w) // 2
+    y0 = (source_height - crop_h) // 2
+    self.crop = (x0, y0, x0 + crop_w, y0 + crop_h)
+    self.scale = (width / float(crop_w), height / float(crop_h))
+
+
+def parse_variants(text, source_width, source_height):
+  """ Parse a list of sizes such as "320x240,160x120" """
+  variants = []
+  for item in text.split(','):
+    width, _, height = item.strip().partition('x')
+    if not width.isdigit() or not height.isdigit():
+      raise ValueError('Expected <width>x<height>, got "%s"' % item)
+    variants.append(Variant(int(width), int(height), source_width,
+                            source_height))
+  return variants
+
+
+def _area_weights(n_in, n_out):
+  """
+  The (n_out, n_in) matrix averaging n_in input pixels into n_out output
+  pixels by the length of their overlap.
+  """
+  scale = n_in / float(n_out)
+  edges = np.arange(n_out + 1) * scale
+  lo, hi = edges[:-1, None], edges[1:, None]
+  pixels = np.arange(n_in)[None, :]
+  overlap = np.clip(np.minimum(hi, pixels + 1) - np.maximum(lo, pixels), 0, None)
+  return overlap / scale
+
+
+def resize(pixels, width, height):
+  """ Downsample a (height, width, channels) uint8 image with an area filter """
+  h, w, c = pixels.shape
+  if (w, h) == (width, height):
+    return pixels
+  wy = _area_weights(h, height)
+  wx = _area_weights(w, width)
+  # Rows first, then columns; both are plain matrix products
+  out = np.tensordot(wy, pixels.astype(np.float64), axes=(1, 0))
+  out = np.tensordot(out, wx, axes=(1, 1)).transpose(0, 2, 1)
+  return np.clip(np.round(out), 0, 255).astype(np.uint8)
+
+
+def make_variant(pixels, variant):
+  x0, y0, x1, y1 = variant.crop
+  return resize(pixels[y0:y1, x0:x1], variant.width, variant.height)
+
+
+def write_variant_images(source_path, output_path, variants, compress_level=6):
+  """
+  Write every variant of the PNG at source_path; output_path(variant) gives
+  the file for each one.
+  """
+  pixels = io_utils.read_png(source_path)
+  for variant in variants:
+    data = io_utils.encode_png(make_variant(pixels, variant), compress_level)
+    path = output_path(variant)
+    tmp = io_utils.temp_path(path)
+    with open(tmp, 'wb') as f:
+      f.write(data)
+    os.replace(tmp, path)
+
+
+def rescale_pixel_coords(pixel_coords, variant):
+  px, py, z = pixel_coords
+  x0, y0, _, _ = variant.crop
+  sx, sy = variant.scale
+  return (int(round((px - x0) * sx)), int(round((py - y0) * sy)), z)
+
+
+def rescale_scene(scene, variant):
+  """
+  A copy of a scene record for a variant: the pixel_coords of all objects,
+  including the objects recorded under "changes" in action scenes, are mapped
+  into the variant and the render_info has the variant's size.
+  """
+  scene = copy.deepcopy(scene)
+  records = []
+  for key, value in scene.items():
+    if key.endswith('objects') and isinstance(value, list):
+      records += value
+  changes = scene.get('changes')
+  if isinstance(changes, dict):
+    records += [changes[k] for k in ('obj', 'cobj')
+                if isinstance(changes.get(k), dict)]
+  for record in records:
+    if 'pixel_coords' in record:
+      record['pixel_coords'] = rescale_pixel_coords(record['pixel_coords'],
+                                                    variant)
+  if isinstance(scene.get('render_info'), dict):
+    scene['render_info']['width'] = variant.width
+    scene['render_info']['height'] = variant.height
+  return scene
+
+
+def write_variant_scenes(output_path, info, entries, keys, variant):
+  """
+  Like io_utils.write_scenes_from_log, but every scene is parsed and
+  rescaled to variant.
+  """
+  tmp = io_utils.temp_path(output_path)
+  logs = {}
+  try:
+    with open(tmp, 'w') as out:
+      out.write('{"info": %s, "scenes": [' % json.dumps(info))
+      for i, key in enumerate(keys):
+        path, offset, length = entries[key]
+        if path not in logs:
+          logs[path] = open(path, 'rb')
+        logs[path].seek(offset)
+        scene = json.loads(logs[path].read(length).decode('utf-8'))
+        if i > 0:
+          out.write(', ')
+        out.write(json.dumps(rescale_scene(scene, variant)))
+      out.write(']}')
+  finally:
+    for f in logs.values():
+      f.close()
+  os.replace(tmp, output_path)
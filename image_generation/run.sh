@@ -1,15 +1,6 @@
 #!/usr/bin/env bash
+# Usage: ./run.sh START_IDX NUM_IMAGES GPU_ID MANIFEST
+# Renders NUM_IMAGES images starting at START_IDX on the given GPU, restarting
+# Blender on crashes. See render_farm.py for running several workers at once.
 
-truncate -s 0 $4
-
-blender --background --python render_images.py -- --use_gpu $3 --start_idx $1 --num_images $2 --log_file $4 @args
-
-start=$(tail -n 1 $4)
-rest=$(( $2 - $start + $1 ))
-
-while [[ $rest > 0 ]]
-do
-    blender --background --python render_images.py -- --use_gpu $3 --start_idx $start --num_images $rest --log_file $4 @args
-    start=$(tail -n 1 $4)
-    rest=$(( $2 - $start + $1 ))
-done
+python render_farm.py --start_idx $1 --num_images $2 --gpus $3 --manifest $4 -- @args
@@ -0,0 +1,355 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, numbers, os
+from collections import OrderedDict
+try:
+  from collections.abc import MutableMapping
+except ImportError:
+  from collections import MutableMapping
+
+try:
+  import numpy as np
+except ImportError:
+  # Only needed for scene stores; load_scenes also reads plain JSON files
+  np = None
+
+"""
+A columnar, memory-mapped alternative to the combined scene JSON files. A
+scene store is a directory of .npy arrays:
+
+- for every object list of the scenes ("objects", and "cor_objects" for cb
+  scenes) an offsets array giving the range of objects of each scene, and one
+  array per object attribute: integer codes for string attributes such as
+  color and shape, and numeric arrays for 3d_coords, pixel_coords, rotation;
+- every relationship list in CSR form: per-scene row offsets, per-row index
+  pointers and the concatenated object indices;
+- the image_index of every scene, and all remaining per-scene fields as a JSON
+  blob per scene with their offsets.
+
+meta.json holds the vocabularies of the string attributes and the layout.
+Arrays are opened with memory mapping, so opening a store is fast and uses
+hardly any memory; a scene is only decoded when it is accessed, and then only
+the fields that are read. SceneStore[i] returns a mapping that behaves like the
+scene dict from the JSON file.
+
+Object attributes are stored with one type per column, so numbers are not
+always returned as they were written: a column holding both ints and floats
+is a float column, and e.g. a rotation of 7 comes back as 7.0. The vector
+components of e.g. pixel_coords stay ints only if they are ints in every
+object. All other fields are returned exactly as in the JSON file.
+
+Convert a combined scene file with:
+
+python scene_store.py --input_scene_file ../output/CLEVR_cb_scenes.json \
+  --output_dir ../output/CLEVR_cb_scenes
+"""
+
+
+STORE_VERSION = 1
+
+
+def _column_kind(values):
+  """ Pick the storage for one object attribute given all of its values """
+  if all(isinstance(v, str) for v in values):
+    return 'category', None
+  if all(isinstance(v, numbers.Real) for v in values):
+    if all(isinstance(v, numbers.Integral) for v in values):
+      return 'int', None
+    return 'float', None
+  if all(isinstance(v, (list, tuple)) for v in values):
+    lengths = set(len(v) for v in values)
+    if len(lengths) == 1:
+      length = lengths.pop()
+      # Remember which components are integers (e.g. the pixel x, y of
+      # pixel_coords) so they come back as ints
+      int_mask = [all(isinstance(v[k], numbers.Integral) for v in values)
+                  for k in range(length)]
+      return 'vector', int_mask
+  raise ValueError('Cannot store object attribute with values like %r'
+                   % (values[0],))
+
+
+def _first_seen(items):
+  """ The distinct items in the order they first appear """
+  seen = set()
+  out = []
+  for item in items:
+    if item not in seen:
+      seen.add(item)
+      out.append(item)
+  return out
+
+
+def write_scene_store(output_dir, scenes, info=None):
+  """
+  Write a list of scene dicts as a scene store in output_dir. All objects in
+  an object list must have the same attributes.
+  """
+  if np is None:
+    raise ImportError('Writing a scene store requires numpy')
+  if not os.path.isdir(output_dir):
+    os.makedirs(output_dir)
+
+  def save(name, array):
+    np.save(os.path.join(output_dir, name + '.npy'), array)
+
+  # Keys, attributes and relationship names keep the order of the JSON
+  # scenes, since consumers such as generate_questions.py iterate over them
+  object_lists = _first_seen(k for s in scenes for k, v in s.items()
+                             if k.endswith('objects') and isinstance(v, list))
+  relationship_keys = _first_seen(k for s in scenes for k, v in s.items()
+                                  if k.endswith('relationships')
+                                  and isinstance(v, dict))
+  meta = {
+    'version': STORE_VERSION,
+    'num_scenes': len(scenes),
+    'info': info,
+    'scene_keys': _first_seen(k for s in scenes for k in s),
+    'object_lists': {},
+    'relationships': {},
+  }
+
+  for list_name in object_lists:
+    objects = [obj for s in scenes for obj in s.get(list_name, [])]
+    offsets = np.cumsum([0] + [len(s.get(list_name, [])) for s in scenes])
+    save('%s.offsets' % list_name, offsets.astype(np.int64))
+    columns = {}
+    attributes = _first_seen(k for obj in objects for k in obj)
+    for attr in attributes:
+      values = [obj[attr] for obj in objects]
+      kind, int_mask = _column_kind(values)
+      column = {'kind': kind}
+      if kind == 'category':
+        vocab = sorted(set(values))
+        codes = {v: i for i, v in enumerate(vocab)}
+        dtype = np.uint8 if len(vocab) <= 256 else np.int32
+        array = np.array([codes[v] for v in values], dtype=dtype)
+        column['vocab'] = vocab
+      elif kind == 'int':
+        array = np.array(values, dtype=np.int64)
+      elif kind == 'float':
+        array = np.array(values, dtype=np.float64)
+      else:
+        array = np.array(values, dtype=np.float64).reshape(len(values), -1)
+        column['int_mask'] = int_mask
+      save('%s.%s' % (list_name, attr), array)
+      columns[attr] = column
+    meta['object_lists'][list_name] = columns
+
+  for rel_key in relationship_keys:
+    names = _first_seen(name for s in scenes for name in s.get(rel_key, {}))
+    num_rows = [len(next(iter(s[rel_key].values()))) if s.get(rel_key) else 0
+                for s in scenes]
+    save('%s.row_offsets' % rel_key,
+         np.cumsum([0] + num_rows).astype(np.int64))
+    for name in names:
+      if any(s.get(rel_key) and name not in s[rel_key] for s in scenes):
+        raise ValueError('Relationship %s is missing from some scenes' % name)
+      rows = [row for s in scenes for row in s.get(rel_key, {}).get(name, [])]
+      indptr = np.cumsum([0] + [len(row) for row in rows]).astype(np.int64)
+      indices = np.array([j for row in rows for j in row], dtype=np.int32)
+      save('%s.%s.indptr' % (rel_key, name), indptr)
+      save('%s.%s.indices' % (rel_key, name), indices)
+    meta['relationships'][rel_key] = names
+
+  save('image_index', np.array([s.get('image_index', -1) for s in scenes],
+                               dtype=np.int64))
+
+  # Everything else is kept as JSON, parsed only when it is accessed
+  stored = set(object_lists) | set(relationship_keys)
+  blobs = [json.dumps({k: v for k, v in s.items() if k not in stored},
+                      separators=(',', ':')).encode('utf-8') for s in scenes]
+  save('extras.offsets',
+       np.cumsum([0] + [len(b) for b in blobs]).astype(np.int64))
+  with open(os.path.join(output_dir, 'extras.bin'), 'wb') as f:
+    for b in blobs:
+      f.write(b)
+
+  # meta.json is written last; a store without it is incomplete
+  with open(os.path.join(output_dir, 'meta.json'), 'w') as f:
+    json.dump(meta, f, indent=2)
+
+
+class SceneStore(object):
+  """
+  Read-only access to a scene store directory. Arrays are memory mapped and
+  only opened when first needed.
+  """
+  def __init__(self, path):
+    if np is None:
+      raise ImportError('Reading a scene store requires numpy')
+    self.path = path
+    with open(os.path.join(path, 'meta.json'), 'r') as f:
+      self.meta = json.load(f, object_pairs_hook=OrderedDict)
+    if self.meta['version'] != STORE_VERSION:
+      raise ValueError('Unsupported scene store version %r'
+                       % self.meta['version'])
+    self.info = self.meta['info']
+    self.key_order = {k: i for i, k in
+                      enumerate(self.meta.get('scene_keys', []))}
+    self._arrays = {}
+    self._image_index_map = None
+
+  def array(self, name):
+    if name not in self._arrays:
+      self._arrays[name] = np.load(os.path.join(self.path, name + '.npy'),
+                                   mmap_mode='r')
+    return self._arrays[name]
+
+  def __len__(self):
+    return self.meta['num_scenes']
+
+  def __getitem__(self, i):
+    if i < 0:
+      i += len(self)
+    if not 0 <= i < len(self):
+      raise IndexError('scene index out of range')
+    return LazyScene(self, i)
+
+  def __iter__(self):
+    for i in range(len(self)):
+      yield LazyScene(self, i)
+
+  def find(self, image_index):
+    """ Return the scene with the given image_index """
+    if self._image_index_map is None:
+      indices = self.array('image_index')
+      self._image_index_map = {int(idx): i for i, idx in enumerate(indices)}
+    return self[self._image_index_map[image_index]]
+
+  def extras(self, i):
+    offsets = self.array('extras.offsets')
+    start, end = int(offsets[i]), int(offsets[i + 1])
+    with open(os.path.join(self.path, 'extras.bin'), 'rb') as f:
+      f.seek(start)
+      return json.loads(f.read(end - start).decode('utf-8'))
+
+  def objects(self, list_name, i):
+    offsets = self.array('%s.offsets' % list_name)
+    start, end = int(offsets[i]), int(offsets[i + 1])
+    columns = self.meta['object_lists'][list_name]
+    objects = [{} for _ in range(end - start)]
+    for attr, column in columns.items():
+      values = self.array('%s.%s' % (list_name, attr))[start:end]
+      if column['kind'] == 'category':
+        vocab = column['vocab']
+        values = [vocab[code] for code in values.tolist()]
+      elif column['kind'] == 'vector':
+        int_mask = column['int_mask']
+        values = [[int(x) if is_int else x for x, is_int in zip(v, int_mask)]
+                  for v in values.tolist()]
+      else:
+        values = values.tolist()
+      for obj, value in zip(objects, values):
+        obj[attr] = value
+    return objects
+
+  def relationships(self, rel_key, i):
+    row_offsets = self.array('%s.row_offsets' % rel_key)
+    r0, r1 = int(row_offsets[i]), int(row_offsets[i + 1])
+    out = {}
+    for name in self.meta['relationships'][rel_key]:
+      indptr = self.array('%s.%s.indptr' % (rel_key, name))[r0:r1 + 1]
+      indices = self.array('%s.%s.indices' % (rel_key, name))
+      ptr = indptr.tolist()
+      rows = indices[ptr[0]:ptr[-1]].tolist()
+      out[name] = [rows[a - ptr[0]:b - ptr[0]] for a, b in zip(ptr, ptr[1:])]
+    return out
+
+
+class LazyScene(MutableMapping):
+  """
+  One scene of a SceneStore with the interface of a scene dict. Fields are
+  decoded on first access; assigned values are kept in memory only.
+  """
+  def __init__(self, store, i):
+    self.store = store
+    self.i = i
+    self._data = {}
+    self._extras = None
+    self._deleted = set()
+
+  def _get_extras(self):
+    if self._extras is None:
+      self._extras = self.store.extras(self.i)
+    return self._extras
+
+  def _stored_keys(self):
+    keys = list(self.store.meta['object_lists']) + \
+           list(self.store.meta['relationships'])
+    keys += list(self._get_extras())
+    # In the order of the JSON scenes
+    order = self.store.key_order
+    return sorted(keys, key=lambda k: order.get(k, len(order)))
+
+  def __getitem__(self, key):
+    if key in self._deleted:
+      raise KeyError(key)
+    if key not in self._data:
+      if key in self.store.meta['object_lists']:
+        self._data[key] = self.store.objects(key, self.i)
+      elif key in self.store.meta['relationships']:
+        self._data[key] = self.store.relationships(key, self.i)
+      else:
+        self._data[key] = self._get_extras()[key]
+    return self._data[key]
+
+  def __setitem__(self, key, value):
+    self._deleted.discard(key)
+    self._data[key] = value
+
+  def __delitem__(self, key):
+    if key not in self:
+      raise KeyError(key)
+    self._data.pop(key, None)
+    self._deleted.add(key)
+
+  def __iter__(self):
+    seen = set()
+    for key in self._stored_keys() + list(self._data):
+      if key not in seen and key not in self._deleted:
+        seen.add(key)
+        yield key
+
+  def __len__(self):
+    return sum(1 for _ in self)
+
+  def __contains__(self, key):
+    if key in self._deleted:
+      return False
+    return key in self._data or key in self._stored_keys()
+
+  def to_dict(self):
+    """ Decode the whole scene into a plain dict """
+    return {key: self[key] for key in self}
+
+
+def load_scenes(path):
+  """
+  Return (info, scenes) from either a combined scene JSON file or a scene
+  store directory, so that consumers can read both formats.
+  """
+  if os.path.isdir(path):
+    store = SceneStore(path)
+    return store.info, store
+  with open(path, 'r') as f:
+    data = json.load(f)
+  return data.get('info'), data['scenes']
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description="Convert a combined scene JSON file to a scene store")
+  parser.add_argument('--input_scene_file', required=True)
+  parser.add_argument('--output_dir', required=True)
+  args = parser.parse_args()
+  with open(args.input_scene_file, 'r') as f:
+    data = json.load(f)
+  write_scene_store(args.output_dir, data['scenes'], info=data.get('info'))
+  print('Wrote %d scenes to %s' % (len(data['scenes']), args.output_dir))
@@ -0,0 +1,111 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import resource, sys
+import bpy
+
+"""
+Memory bookkeeping for long Blender sessions. Every scene appends objects and
+creates materials and images; deleting an object leaves its mesh behind as an
+orphan datablock. SessionMemory remembers the state of the base scene so that
+a scene can be cleaned up without reloading the file, removes orphaned
+datablocks, and reports datablock counts and the resident memory of the
+process.
+"""
+
+
+# Exit code of render_images.py when it stops early because it crossed
+# --memory_ceiling_mb; render_farm.py relaunches the worker for the rest
+# (this is EX_TEMPFAIL from sysexits.h)
+EXIT_RECYCLE = 75
+
+# Collections reported by SessionMemory.counts
+COUNTED = ['objects', 'meshes', 'materials', 'images', 'textures',
+           'node_groups']
+
+# Collections whose unused datablocks are removed by purge_orphans. Node
+# groups are left alone: the material node groups from load_materials have no
+# users until a material uses them.
+PURGEABLE = ['meshes', 'materials', 'images', 'textures']
+
+
+def rss_mb():
+  """ Resident memory of this process in MB """
+  try:
+    with open('/proc/self/status', 'r') as f:
+      for line in f:
+        if line.startswith('VmRSS:'):
+          return int(line.split()[1]) / 1024.0
+  except (IOError, OSError):
+    pass
+  # Peak rather than current memory, but better than nothing; ru_maxrss is
+  # in bytes on macOS and in kB elsewhere
+  maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  if sys.platform == 'darwin':
+    return maxrss / (1024.0 * 1024.0)
+  return maxrss / 1024.0
+
+
+class SessionMemory(object):
+  def __init__(self):
+    self.base_objects = None
+    self.transforms = {}
+    self.materials_loaded = False
+
+  def snapshot(self):
+    """
+    Remember the objects of the base scene and their transforms; call this
+    right after loading the base scene.
+    """
+    self.base_objects = set(obj.name for obj in bpy.data.objects)
+    self.transforms = {}
+    for obj in bpy.data.objects:
+      self.transforms[obj.name] = (obj.location.copy(),
+                                   obj.rotation_euler.copy(),
+                                   obj.scale.copy())
+
+  def restore(self):
+    """
+    Bring the scene back to the snapshot without reloading the file: remove
+    all objects added since, undo moves of the base objects (such as the
+    camera and light jitter) and purge the orphans this leaves behind.
+    Returns the number of purged datablocks.
+    """
+    for obj in list(bpy.data.objects):
+      if obj.name not in self.base_objects:
+        bpy.data.objects.remove(obj, do_unlink=True)
+    for name, (location, rotation, scale) in self.transforms.items():
+      obj = bpy.data.objects.get(name)
+      if obj is not None:
+        obj.location = location
+        obj.rotation_euler = rotation
+        obj.scale = scale
+    return self.purge_orphans()
+
+  def purge_orphans(self):
+    """
+    Remove datablocks that nothing uses any more. Datablocks with a fake user
+    and cached materials (see utils.add_material) are kept, as are the
+    special images such as "Render Result".
+    """
+    removed = 0
+    for name in PURGEABLE:
+      collection = getattr(bpy.data, name)
+      for block in list(collection):
+        if block.users > 0 or block.use_fake_user:
+          continue
+        if block.get('cache_key') is not None:
+          continue
+        if name == 'images' and block.type != 'IMAGE':
+          continue
+        collection.remove(block)
+        removed += 1
+    return removed
+
+  def counts(self):
+    """ Number of datablocks per collection """
+    return {name: len(getattr(bpy.data, name)) for name in COUNTED}
@@ -0,0 +1,247 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, io, json, os, re, tarfile, time
+from collections import defaultdict
+
+"""
+Pack rendered samples into tar shards instead of hundreds of thousands of
+small files. Each sample (for action scenes: the new image, the cor image,
+the cb scene and optionally its questions) is stored as consecutive tar
+members named <key>.<suffix>, as in the WebDataset format, e.g.
+
+CLEVR_000042.new.png
+CLEVR_000042.cor.png
+CLEVR_000042.cb.json
+CLEVR_000042.questions.json
+
+Shards are named <prefix>-000000.tar, <prefix>-000001.tar, ... and are
+uncompressed, so every member can also be read directly at its byte offset.
+Next to the shards an index file (<prefix>.index.jsonl) holds one JSON line
+per sample:
+
+{"image_index": 42, "key": "CLEVR_000042", "shard": "CLEVR-000000.tar",
+ "members": {"new.png": [offset, size], ...}}
+
+Several writers can share a directory as long as they use different prefixes
+(render_farm.py gives every worker its own); readers merge all index files.
+render_images.py can write shards directly with --output_shard_dir; run this
+file as a script to convert the outputs of an earlier run:
+
+python shards.py --input_image_dir ../output/images \
+  --input_scene_dir ../output/scenes --output_dir ../output/shards
+"""
+
+
+INDEX_SUFFIX = '.index.jsonl'
+
+
+class ShardWriter(object):
+  """
+  Writes samples to a sequence of tar shards in output_dir and records them in
+  its index file. A new shard is started once the current one holds
+  samples_per_shard samples or max_shard_bytes bytes. Existing shards are
+  never modified: when output_dir already contains shards, numbering
+  continues after the last one.
+  """
+  def __init__(self, output_dir, prefix='CLEVR', samples_per_shard=1000,
+               max_shard_bytes=1 << 30):
+    if not os.path.isdir(output_dir):
+      os.makedirs(output_dir)
+    self.output_dir = output_dir
+    self.prefix = prefix
+    self.samples_per_shard = samples_per_shard
+    self.max_shard_bytes = max_shard_bytes
+    # Shards left open by a crash keep their temporary name and may still be
+    # referenced by the index, so their numbers are not reused either
+    pattern = re.compile(r'^%s-(\d+)\.tar(\.tmp)?$' % re.escape(prefix))
+    numbers = [int(m.group(1)) for m in map(pattern.match,
+                                            os.listdir(output_dir)) if m]
+    self.next_shard = max(numbers) + 1 if numbers else 0
+    self.tar = None
+    self.shard_name = None
+    self.num_samples = 0
+    self.index = open(os.path.join(output_dir, prefix + INDEX_SUFFIX), 'a')
+
+  def _open_shard(self):
+    self.shard_name = '%s-%06d.tar' % (self.prefix, self.next_shard)
+    self.next_shard += 1
+    self.num_samples = 0
+    # Written under a temporary name so that readers never see a shard
+    # without its end-of-archive marker
+    path = os.path.join(self.output_dir, self.shard_name)
+    self.tar = tarfile.open(path + '.tmp', 'w', format=tarfile.USTAR_FORMAT)
+
+  def _close_shard(self):
+    if self.tar is None:
+      return
+    path = os.path.join(self.output_dir, self.shard_name)
+    self.tar.close()
+    os.replace(path + '.tmp', path)
+    self.tar = None
+
+  def write(self, image_index, key, members):
+    """
+    Add one sample. members is a list of (suffix, data) pairs where data is
+    either bytes or the path of a file to copy into the shard.
+    """
+    if self.tar is not None and (
+        self.num_samples >= self.samples_per_shard or
+        self.tar.fileobj.tell() >= self.max_shard_bytes):
+      self._close_shard()
+    if self.tar is None:
+      self._open_shard()
+
+    mtime = time.time()
+    entry = {
+      'image_index': image_index,
+      'key': key,
+      'shard': self.shard_name,
+      'members': {},
+    }
+    for suffix, data in members:
+      if not isinstance(data, bytes):
+        with open(data, 'rb') as f:
+          data = f.read()
+      info = tarfile.TarInfo('%s.%s' % (key, suffix))
+      info.size = len(data)
+      info.mtime = mtime
+      self.tar.addfile(info, io.BytesIO(data))
+      # addfile leaves the offset after the data, padded to whole blocks
+      padded = -(-info.size // tarfile.BLOCKSIZE) * tarfile.BLOCKSIZE
+      entry['members'][suffix] = [self.tar.offset - padded, info.size]
+    self.num_samples += 1
+    # Only index samples once the tar data is on disk; a shard that is still
+    # open has a temporary name, which readers resolve through the index.
+    self.tar.fileobj.flush()
+    self.index.write(json.dumps(entry, sort_keys=True) + '\n')
+    self.index.flush()
+
+  def close(self):
+    self._close_shard()
+    self.index.close()
+
+
+def load_index(shard_dir):
+  """
+  Read all index files of a shard directory. Returns a dict mapping
+  image_index to its index entry; torn lines from a crash are skipped.
+  """
+  entries = {}
+  if not os.path.isdir(shard_dir):
+    return entries
+  for filename in sorted(os.listdir(shard_dir)):
+    if not filename.endswith(INDEX_SUFFIX):
+      continue
+    with open(os.path.join(shard_dir, filename), 'r') as f:
+      for line in f:
+        if not line.endswith('\n'):
+          continue
+        try:
+          entry = json.loads(line)
+        except ValueError:
+          continue
+        entries[entry['image_index']] = entry
+  return entries
+
+
+def shard_path(shard_dir, entry):
+  """ Path of the shard holding entry, or of its temporary file if open """
+  path = os.path.join(shard_dir, entry['shard'])
+  if not os.path.isfile(path) and os.path.isfile(path + '.tmp'):
+    return path + '.tmp'
+  return path
+
+
+def read_member(shard_dir, entry, suffix):
+  """ Return the bytes of one member of an indexed sample """
+  offset, size = entry['members'][suffix]
+  with open(shard_path(shard_dir, entry), 'rb') as f:
+    f.seek(offset)
+    return f.read(size)
+
+
+def sample_members(image_template, scene_template, index, action=1,
+                   split='new', asplit='cor', csplit='cb'):
+  """
+  List the (suffix, path) members of the sample for index. Action samples
+  hold the new and cor images and the cb scene; other samples hold the image
+  and scene of split.
+  """
+  if action:
+    return [
+      ('%s.png' % split, image_template % (split, index)),
+      ('%s.png' % asplit, image_template % (asplit, index)),
+      ('%s.json' % csplit, scene_template % (csplit, index)),
+    ]
+  return [
+    ('%s.png' % split, image_template % (split, index)),
+    ('%s.json' % split, scene_template % (split, index)),
+  ]
+
+
+def main(args):
+  image_template = os.path.join(args.input_image_dir,
+                                '%s_%%s_%%06d.png' % args.filename_prefix)
+  scene_template = os.path.join(args.input_scene_dir,
+                                '%s_%%s_%%06d.json' % args.filename_prefix)
+  scene_split = args.csplit if args.action else args.split
+  pattern = re.compile(r'^%s_%s_(\d+)\.json$'
+                       % (re.escape(args.filename_prefix), re.escape(scene_split)))
+  indices = sorted(int(m.group(1)) for m in
+                   map(pattern.match, os.listdir(args.input_scene_dir)) if m)
+
+  questions = defaultdict(list)
+  if args.input_questions_file is not None:
+    with open(args.input_questions_file, 'r') as f:
+      for q in json.load(f)['questions']:
+        questions[q['image_index']].append(q)
+
+  done = load_index(args.output_dir)
+  writer = ShardWriter(args.output_dir, prefix=args.filename_prefix,
+                       samples_per_shard=args.samples_per_shard,
+                       max_shard_bytes=args.max_shard_bytes)
+  num_written = 0
+  try:
+    for index in indices:
+      if index in done:
+        continue
+      members = sample_members(image_template, scene_template, index,
+                               args.action, args.split, args.asplit,
+                               args.csplit)
+      if not all(os.path.isfile(path) for _, path in members):
+        print('Skipping incomplete sample %d' % index)
+        continue
+      if index in questions:
+        data = json.dumps(questions[index]).encode('utf-8')
+        members.append(('questions.json', data))
+      writer.write(index, '%s_%06d' % (args.filename_prefix, index), members)
+      num_written += 1
+  finally:
+    writer.close()
+  print('Wrote %d samples (%d already packed)' % (num_written, len(done)))
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description="Pack rendered images and scenes into tar shards")
+  parser.add_argument('--input_image_dir', default='../output/images')
+  parser.add_argument('--input_scene_dir', default='../output/scenes')
+  parser.add_argument('--input_questions_file', default=None,
+      help="Optional questions file from generate_questions.py; the " +
+           "questions of each image are added to its sample.")
+  parser.add_argument('--output_dir', default='../output/shards')
+  parser.add_argument('--filename_prefix', default='CLEVR')
+  parser.add_argument('--action', default=1, type=int)
+  parser.add_argument('--split', default='new')
+  parser.add_argument('--asplit', default='cor')
+  parser.add_argument('--csplit', default='cb')
+  parser.add_argument('--samples_per_shard', default=1000, type=int)
+  parser.add_argument('--max_shard_bytes', default=1 << 30, type=int,
+      help="Start a new shard once the current one reaches this size")
+  main(parser.parse_args())
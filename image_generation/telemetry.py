@@ -0,0 +1,176 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+from __future__ import print_function
+import argparse, json, time
+from collections import defaultdict
+from contextlib import contextmanager
+
+"""
+Per-image timing for render_images.py. While an image is being rendered, the
+time spent in each phase (scene reset, material loading, object placement,
+visibility checks, the Cycles render itself, ...) is accumulated together with
+event counters such as placement attempts; when the image is done, one JSON
+line is appended to the timing file.
+
+Run this file as a script to summarize one or more timing files:
+
+python telemetry.py ../output/log_timing.jsonl
+"""
+
+
+class RenderTelemetry(object):
+  """
+  Collects phase timings and counters for the image currently being rendered
+  and writes them as one JSON line per image. If path is None nothing is
+  written, but timing still works so callers do not need to check.
+  """
+  def __init__(self, path=None):
+    self.path = path
+    self.record = None
+    self.start = None
+
+  def start_image(self, image_index):
+    self.start = time.time()
+    self.record = {
+      'image_index': image_index,
+      'phases': defaultdict(float),
+      'calls': defaultdict(int),
+      'counters': defaultdict(int),
+    }
+
+  @contextmanager
+  def phase(self, name):
+    """
+    Time a block of code as the phase name. Phases may be entered many times
+    per image; their durations and number of calls add up.
+    """
+    tic = time.time()
+    try:
+      yield
+    finally:
+      if self.record is not None:
+        self.record['phases'][name] += time.time() - tic
+        self.record['calls'][name] += 1
+
+  def count(self, name, n=1):
+    if self.record is not None:
+      self.record['counters'][name] += n
+
+  def end_image(self, success=True, **extra):
+    """ Finish the current image and append its record to the timing file """
+    if self.record is None:
+      return
+    record = self.record
+    self.record = None
+    record['success'] = success
+    record['total'] = time.time() - self.start
+    record['time'] = self.start
+    record.update(extra)
+    if self.path is not None:
+      with open(self.path, 'a') as f:
+        f.write(json.dumps(record, sort_keys=True) + '\n')
+    return record
+
+
+def percentile(sorted_values, q):
+  """ Linearly interpolated percentile q (0-100) of a sorted list """
+  if not sorted_values:
+    return 0.0
+  pos = (len(sorted_values) - 1) * q / 100.0
+  lo = int(pos)
+  hi = min(lo + 1, len(sorted_values) - 1)
+  return sorted_values[lo] + \
+         (sorted_values[hi] - sorted_values[lo]) * (pos - lo)
+
+
+def load_records(paths):
+  records = []
+  for path in paths:
+    with open(path, 'r') as f:
+      for line in f:
+        line = line.strip()
+        if line:
+          records.append(json.loads(line))
+  return records
+
+
+def summarize(records, percentiles=(50, 90, 99)):
+  """
+  Aggregate timing records into per-phase and per-counter statistics. Returns
+  a dict with the number of images, the overall share of each phase in the
+  total time, and percentiles of the per-image values.
+  """
+  phase_names = set(k for r in records for k in r['phases'])
+  counter_names = set(k for r in records for k in r['counters'])
+  phases = {name: [r['phases'].get(name, 0.0) for r in records]
+            for name in phase_names}
+  counters = {name: [r['counters'].get(name, 0) for r in records]
+              for name in counter_names}
+  totals = [r['total'] for r in records]
+  num_failed = sum(1 for r in records if not r.get('success', True))
+
+  def stats(values):
+    values = sorted(values)
+    out = {'mean': sum(values) / float(len(values)) if values else 0.0,
+           'total': sum(values)}
+    for q in percentiles:
+      out['p%d' % q] = percentile(values, q)
+    return out
+
+  grand_total = sum(totals)
+  summary = {
+    'num_images': len(records),
+    'num_failed': num_failed,
+    'total': stats(totals),
+    'phases': {},
+    'counters': {},
+  }
+  for name, values in phases.items():
+    summary['phases'][name] = stats(values)
+    summary['phases'][name]['share'] = \
+      sum(values) / grand_total if grand_total > 0 else 0.0
+  for name, values in counters.items():
+    summary['counters'][name] = stats(values)
+  return summary
+
+
+def print_summary(summary):
+  print('%d images (%d failed)' % (summary['num_images'],
+                                   summary['num_failed']))
+  keys = sorted(k for k in summary['total'] if k.startswith('p'))
+  header = '%-24s %8s %8s ' % ('', 'share', 'mean') + \
+           ' '.join('%8s' % k for k in keys)
+  print(header)
+
+  def row(name, s, share=None):
+    share = '%7.1f%%' % (100 * share) if share is not None else ''
+    print('%-24s %8s %8.3f ' % (name, share, s['mean']) +
+          ' '.join('%8.3f' % s[k] for k in keys))
+
+  row('total (s)', summary['total'], 1.0)
+  phases = sorted(summary['phases'].items(), key=lambda x: -x[1]['total'])
+  for name, s in phases:
+    row(name, s, s['share'])
+  if summary['counters']:
+    print()
+    for name, s in sorted(summary['counters'].items()):
+      row(name, s)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description="Summarize per-image timing files from render_images.py")
+  parser.add_argument('timing_files', nargs='+')
+  parser.add_argument('--json', action='store_true',
+      help="Print the summary as JSON instead of a table")
+  args = parser.parse_args()
+  summary = summarize(load_records(args.timing_files))
+  if args.json:
+    print(json.dumps(summary, indent=2, sort_keys=True))
+  else:
+    print_summary(summary)
@@ -6,11 +6,18 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 import sys, random, os
+import numpy as np
 import bpy, bpy_extras
+from mathutils import Vector
+
+import layout
 
 
 """
-Some utility functions for interacting with Blender
+Some utility functions for interacting with Blender. Objects and materials
+are created and removed through bpy.data rather than through operators
+(bpy.ops), which depend on the selection and context and trigger a scene
+update on every call.
 """
 
 
@@ -33,13 +40,9 @@ def parse_args(parser, argv=None):
   return parser.parse_args(extract_args(argv))
 
 
-# I wonder if there's a better way to do this?
 def delete_object(obj):
   """ Delete a specified blender object """
-  for o in bpy.data.objects:
-    o.select = False
-  obj.select = True
-  bpy.ops.object.delete()
+  bpy.data.objects.remove(obj, do_unlink=True)
 
 
 def get_camera_coords(cam, pos):
@@ -65,6 +68,89 @@ def get_camera_coords(cam, pos):
   return (px, py, z)
 
 
+def get_camera_model(cam):
+  """
+  Describe a camera as a layout.CameraModel, which projects points without
+  Blender. The scene is updated first so that the world matrix reflects any
+  camera jitter.
+  """
+  scene = bpy.context.scene
+  scene.update()
+  scale = scene.render.resolution_percentage / 100.0
+  w = int(scale * scene.render.resolution_x)
+  h = int(scale * scene.render.resolution_y)
+  matrix_world = [list(row) for row in cam.matrix_world]
+  return layout.CameraModel(matrix_world, cam.data.angle, w, h)
+
+
+def get_screen_bbox(cam, obj, lamps=(), padding=0):
+  """
+  Get the pixel-space bounding box of an object as seen from a camera.
+
+  Inputs:
+  - cam: Camera object
+  - obj: Object whose bounding box should be projected
+  - lamps: Lamp objects; the box also covers the shadow that the object's
+    bounding box casts onto the ground plane (z = 0) from each lamp position
+  - padding: Number of pixels to grow the box by on every side
+
+  Returns a tuple (x0, y0, x1, y1) of integer pixel coordinates, with the
+  origin at the top left of the image as in get_camera_coords, clamped to the
+  image and with x1, y1 exclusive.
+  """
+  scene = bpy.context.scene
+  scale = scene.render.resolution_percentage / 100.0
+  w = int(scale * scene.render.resolution_x)
+  h = int(scale * scene.render.resolution_y)
+
+  corners = [obj.matrix_world * Vector(c) for c in obj.bound_box]
+  points = list(corners)
+  for lamp in lamps:
+    light = lamp.matrix_world.translation
+    for c in corners:
+      if light.z > c.z:
+        t = light.z / (light.z - c.z)
+        points.append(light + (c - light) * t)
+
+  coords = [get_camera_coords(cam, p) for p in points]
+  xs = [px for px, _, _ in coords]
+  ys = [py for _, py, _ in coords]
+  x0 = max(0, min(xs) - padding)
+  y0 = max(0, min(ys) - padding)
+  x1 = min(w, max(xs) + padding + 1)
+  y1 = min(h, max(ys) + padding + 1)
+  return (x0, y0, x1, y1)
+
+
+def composite_region(base_path, region_path, output_path, box):
+  """
+  Copy the pixels inside box from the image at region_path onto the image at
+  base_path and save the result as a PNG at output_path. Both images must have
+  the same size; box is (x0, y0, x1, y1) as returned by get_screen_bbox.
+  """
+  base = bpy.data.images.load(base_path)
+  region = bpy.data.images.load(region_path)
+  w, h = base.size
+  assert tuple(region.size) == (w, h)
+  c = base.channels
+  base_pixels = np.array(base.pixels[:]).reshape(h, w, c)
+  region_pixels = np.array(region.pixels[:]).reshape(h, w, region.channels)
+
+  # Blender stores image rows bottom to top
+  x0, y0, x1, y1 = box
+  r0, r1 = h - y1, h - y0
+  base_pixels[r0:r1, x0:x1, :3] = region_pixels[r0:r1, x0:x1, :3]
+  if c == 4 and region.channels == 4:
+    base_pixels[r0:r1, x0:x1, 3] = region_pixels[r0:r1, x0:x1, 3]
+
+  base.pixels = base_pixels.ravel().tolist()
+  base.filepath_raw = output_path
+  base.file_format = 'PNG'
+  base.save()
+  bpy.data.images.remove(base)
+  bpy.data.images.remove(region)
+
+
 def set_layer(obj, layer_idx):
   """ Move an object to a particular layer """
   # Set the target layer to True first because an object must always be on
@@ -74,6 +160,10 @@ def set_layer(obj, layer_idx):
     obj.layers[i] = (i == layer_idx)
 
 
+# Number of objects added so far per object name, used to name new objects
+_object_counts = {}
+
+
 def add_object(object_dir, name, scale, loc, theta=0):
   """
   Load an object from a file. We assume that in the directory object_dir, there
@@ -83,27 +173,32 @@ def add_object(object_dir, name, scale, loc, theta=0):
   - scale: scalar giving the size that the object should be in the scene
   - loc: tuple (x, y) giving the coordinates on the ground plane where the
     object should be placed.
-  """
-  # First figure out how many of this object are already in the scene so we can
-  # give the new object a unique name
-  count = 0
-  for obj in bpy.data.objects:
-    if obj.name.startswith(name):
-      count += 1
-
-  filename = os.path.join(object_dir, '%s.blend' % name, 'Object', name)
-  bpy.ops.wm.append(filename=filename)
 
-  # Give it a new name to avoid conflicts
-  new_name = '%s_%d' % (name, count)
-  bpy.data.objects[name].name = new_name
+  The new object is made the active object and returned.
+  """
+  # Give the new object a unique name. The first time a name is seen, count
+  # the objects that already use it; after that the counter only grows, so
+  # names stay unique even after objects are deleted or the file reverted.
+  if name not in _object_counts:
+    _object_counts[name] = sum(1 for obj in bpy.data.objects
+                               if obj.name.startswith(name))
+  count = _object_counts[name]
+  _object_counts[name] += 1
+
+  filepath = os.path.join(object_dir, '%s.blend' % name)
+  with bpy.data.libraries.load(filepath) as (data_from, data_to):
+    data_to.objects = [name]
+  obj = data_to.objects[0]
+  obj.name = '%s_%d' % (name, count)
+  bpy.context.scene.objects.link(obj)
 
   # Set the new object as active, then rotate, scale, and translate it
   x, y = loc
-  bpy.context.scene.objects.active = bpy.data.objects[new_name]
-  bpy.context.object.rotation_euler[2] = theta
-  bpy.ops.transform.resize(value=(scale, scale, scale))
-  bpy.ops.transform.translate(value=(x, y, scale))
+  bpy.context.scene.objects.active = obj
+  obj.rotation_euler[2] = theta
+  obj.scale = [s * scale for s in obj.scale]
+  obj.location = obj.location + Vector((x, y, scale))
+  return obj
 
 
 def load_materials(material_dir):
@@ -115,40 +210,72 @@ def load_materials(material_dir):
   for fn in os.listdir(material_dir):
     if not fn.endswith('.blend'): continue
     name = os.path.splitext(fn)[0]
-    filepath = os.path.join(material_dir, fn, 'NodeTree', name)
-    bpy.ops.wm.append(filename=filepath)
+    filepath = os.path.join(material_dir, fn)
+    with bpy.data.libraries.load(filepath) as (data_from, data_to):
+      data_to.node_groups = [name]
 
 
-def add_material(name, **properties):
-  """
-  Create a new material and assign it to the active object. "name" should be the
-  name of a material that has been previously loaded using load_materials.
-  """
-  # Figure out how many materials are already in the scene
-  mat_count = len(bpy.data.materials)
+# Materials created by add_material, keyed by the node group name and the
+# group inputs; values are material names, since the datablocks themselves
+# disappear when the file is reverted.
+_material_cache = {}
+_shadeless_materials = {}
+
+
+def _cache_key(name, properties):
+  items = []
+  for k, v in sorted(properties.items()):
+    if not isinstance(v, (str, int, float)):
+      v = tuple(v)
+    items.append((k, v))
+  return (name, tuple(items))
+
 
-  # Create a new material; it is not attached to anything and
-  # it will be called "Material"
-  bpy.ops.material.new()
+def _cached_material(cache, key):
+  """ Look up a cached material, checking that it is still the same one """
+  mat = bpy.data.materials.get(cache.get(key, ''))
+  if mat is None or mat.get('cache_key') != repr(key):
+    return None
+  return mat
 
-  # Get a reference to the material we just created and rename it;
-  # then the next time we make a new material it will still be called
-  # "Material" and we will still be able to look it up by name
-  mat = bpy.data.materials['Material']
-  mat.name = 'Material_%d' % mat_count
 
-  # Attach the new material to the active object
+def add_material(name, **properties):
+  """
+  Assign a material to the active object. "name" should be the name of a
+  material that has been previously loaded using load_materials; properties
+  set the inputs of that node group, e.g. Color.
+
+  Objects with the same material and properties share one material, which is
+  created the first time it is needed and reused for the rest of the session,
+  so Cycles only has to compile one shader per (material, color) pair.
+  """
+  key = _cache_key(name, properties)
+  mat = _cached_material(_material_cache, key)
+  if mat is None or mat.node_tree.nodes['Group'].node_tree != \
+      bpy.data.node_groups[name]:
+    mat = _new_material(name, properties)
+    mat['cache_key'] = repr(key)
+    _material_cache[key] = mat.name
+
+  # Attach the material to the active object
   # Make sure it doesn't already have materials
   obj = bpy.context.active_object
   assert len(obj.data.materials) == 0
   obj.data.materials.append(mat)
 
+
+def _new_material(name, properties):
+  """ Create a material that uses the node group name with properties """
+  # Figure out how many materials are already in the scene
+  mat_count = len(bpy.data.materials)
+
+  # Create a new material; it is not attached to anything. Enabling nodes
+  # gives it the default node tree with a "Material Output" node.
+  mat = bpy.data.materials.new('Material_%d' % mat_count)
+  mat.use_nodes = True
+
   # Find the output node of the new material
-  output_node = None
-  for n in mat.node_tree.nodes:
-    if n.name == 'Material Output':
-      output_node = n
-      break
+  output_node = mat.node_tree.nodes.get('Material Output')
 
   # Add a new GroupNode to the node tree of the active material,
   # and copy the node tree from the preloaded node group to the
@@ -156,6 +283,7 @@ def add_material(name, **properties):
   # we can create multiple materials of the same type without them
   # clobbering each other
   group_node = mat.node_tree.nodes.new('ShaderNodeGroup')
+  group_node.name = 'Group'
   group_node.node_tree = bpy.data.node_groups[name]
 
   # Find and set the "Color" input of the new group node
@@ -169,4 +297,22 @@ def add_material(name, **properties):
       group_node.outputs['Shader'],
       output_node.inputs['Surface'],
   )
+  return mat
 
+
+def get_shadeless_material(index):
+  """
+  Return the shadeless material used for the index-th object by the
+  visibility check. One material per index is kept for the whole session and
+  only its color changes between checks. Materials are kept with a fake user
+  as they are not assigned to anything in between.
+  """
+  key = ('shadeless', index)
+  mat = _cached_material(_shadeless_materials, key)
+  if mat is None:
+    mat = bpy.data.materials.new('Shadeless_%d' % index)
+    mat.use_shadeless = True
+    mat.use_fake_user = True
+    mat['cache_key'] = repr(key)
+    _shadeless_materials[key] = mat.name
+  return mat
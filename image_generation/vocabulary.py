@@ -0,0 +1,79 @@
+# Copyright 2017-present, Facebook, Inc.
+# All rights reserved.
+#
+# This source code is licensed under the BSD-style license found in the
+# LICENSE file in the root directory of this source tree. An additional grant
+# of patent rights can be found in the PATENTS file in the same directory.
+
+import json
+
+"""
+The vocabulary that CLEVR scenes are built from: shapes, colors, materials and
+sizes from the properties JSON file, and optionally the allowed shape / color
+combinations for CLEVR-CoGenT. Files are parsed once per process and the
+lookup tables used while placing and modifying objects are precomputed.
+"""
+
+
+class SceneVocabulary(object):
+  """
+  Parsed object properties. The list attributes keep the (blend name, CLEVR
+  name) ordering used by render_images.py so they can be passed directly to
+  random.choice. They are sorted by CLEVR name, since the order of dicts is
+  not fixed in Blender's Python 3.5 and a seeded generator has to pick from
+  the same order in every process:
+
+  - color_items: list of (color name, RGBA list with values in [0, 1])
+  - material_mapping: list of (material blend name, material name)
+  - object_mapping: list of (shape blend name, shape name)
+  - size_mapping: list of (size name, scale)
+  - shape_color_combos: list of (shape name, list of color names), or None
+
+  and the dicts map CLEVR names to values:
+
+  - color_name_to_rgba: color name -> RGBA list
+  - materials: material name -> material blend name
+  - shapes: shape name -> shape blend name
+  - sizes: size name -> scale
+  - shape_to_colors: shape name -> allowed color names, or None
+  """
+  def __init__(self, properties, shape_color_combos=None):
+    self.color_name_to_rgba = {}
+    for name, rgb in properties['colors'].items():
+      rgba = [float(c) / 255.0 for c in rgb] + [1.0]
+      self.color_name_to_rgba[name] = rgba
+    self.color_items = sorted(self.color_name_to_rgba.items())
+    self.materials = dict(properties['materials'])
+    self.shapes = dict(properties['shapes'])
+    self.sizes = dict(properties['sizes'])
+    self.material_mapping = [(v, k) for k, v
+                             in sorted(properties['materials'].items())]
+    self.object_mapping = [(v, k) for k, v
+                           in sorted(properties['shapes'].items())]
+    self.size_mapping = sorted(properties['sizes'].items())
+
+    self.shape_color_combos = None
+    self.shape_to_colors = None
+    if shape_color_combos is not None:
+      self.shape_color_combos = sorted(shape_color_combos.items())
+      self.shape_to_colors = dict(shape_color_combos)
+
+
+_vocabularies = {}
+
+
+def load_vocabulary(properties_json, shape_color_combos_json=None):
+  """
+  Return the SceneVocabulary for the given files, reading and parsing them
+  only the first time they are requested in this process.
+  """
+  key = (properties_json, shape_color_combos_json)
+  if key not in _vocabularies:
+    with open(properties_json, 'r') as f:
+      properties = json.load(f)
+    shape_color_combos = None
+    if shape_color_combos_json is not None:
+      with open(shape_color_combos_json, 'r') as f:
+        shape_color_combos = json.load(f)
+    _vocabularies[key] = SceneVocabulary(properties, shape_color_combos)
+  return _vocabularies[key]
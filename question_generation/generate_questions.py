@@ -6,12 +6,18 @@
 # of patent rights can be found in the PATENTS file in the same directory.
 
 from __future__ import print_function
-import argparse, json, os, itertools, random, shutil, copy
+import argparse, json, os, itertools, random, shutil, copy, hashlib, struct
+import sys
 import time
 import re
 
 import question_engine as qeng
 
+# Scene stores are read with scene_store.py from image_generation
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                             '..', 'image_generation'))
+import scene_store
+
 """
 Generate synthetic questions and answers for CLEVR images. Input is a single
 JSON file containing ground-truth scene information for all images, and output
@@ -46,7 +52,9 @@ parser = argparse.ArgumentParser(fromfile_prefix_chars='@')
 # Inputs
 parser.add_argument('--input_scene_file', default='../output/CLEVR_scenes.json',
     help="JSON file containing ground-truth scene information for all images " +
-         "from render_images.py")
+         "from render_images.py, or a scene store directory written by " +
+         "image_generation/scene_store.py, whose scenes are only decoded " +
+         "one at a time as they are used")
 parser.add_argument('--metadata_file', default='metadata.json',
     help="JSON file containing metadata about functions")
 parser.add_argument('--synonyms_json', default='synonyms.json',
@@ -85,6 +93,14 @@ parser.add_argument('--reset_counts_every', default=250, type=int,
     help="How often to reset template and answer counts. Higher values will " +
          "result in flatter distributions over templates and answers, but " +
          "will result in longer runtimes.")
+parser.add_argument('--seed', default=None, type=int,
+    help="If given, the random state is derived from this seed and the " +
+         "image index before each image, and template and answer counts " +
+         "are reset whenever the image index enters a new block of " +
+         "--reset_counts_every images. The questions of a block then only " +
+         "depend on the seed and the scenes of that block, so any range of " +
+         "whole blocks can be regenerated on its own; only question_index " +
+         "depends on where the run started.")
 parser.add_argument('--verbose', action='store_true',
     help="Print more verbose output")
 parser.add_argument('--time_dfs', action='store_true',
@@ -546,9 +562,10 @@ def instantiate_templates(scene_struct, template, metadata, answer_counts,
   has_changed = True if type_of_change in [COLOR_CHANGED, MAT_CHANGED, SIZE_CHANGED] else False
   relate_changed = True if type_of_change == SIZE_CHANGED else False
   if relate_changed:
-    # This is a temporary fix of a bug in render_images.py
-    # TODO: Fix where (x,y,r) is saved, but it barely moved, so the change is not captured by
-    # TODO: relation computation, therefore, its tag should be SIZE_UNCHANGED
+    # Older versions of render_images.py could move an object so little that
+    # the move is not captured by the relation computation; such scenes are
+    # treated as SIZE_UNCHANGED. Moves are now screened for this before
+    # rendering (see layout.changes_relation).
     test = find_true_relation(objs[0])
     if test == '':
       type_of_change = SIZE_UNCHANGED
@@ -701,6 +718,12 @@ def replace_optionals(s):
   return s
 
 
+def seed_scene(seed, image_index):
+  """ Seed the random module from --seed and the image index of a scene """
+  digest = hashlib.sha256(('%d:%d' % (seed, image_index)).encode('utf-8'))
+  random.seed(struct.unpack('<I', digest.digest()[:4])[0])
+
+
 def main(args):
   ############################################
   # Load required data for question generation
@@ -721,7 +744,9 @@ def main(args):
   num_loaded_templates = 0
   templates = {}
   template_dir = args.action_template_dir if args.action else args.template_dir
-  for fn in os.listdir(template_dir):
+  # Sorted, so that templates with equal counts are tried in the same order
+  # on every filesystem
+  for fn in sorted(os.listdir(template_dir)):
     if not fn.endswith('.json'): continue
     with open(os.path.join(template_dir, fn), 'r') as f:
       base = os.path.splitext(fn)[0]
@@ -756,18 +781,18 @@ def main(args):
 
   template_counts, template_answer_counts = reset_counts()
 
-  # Read file containing input scenes
-  all_scenes = []
-  with open(args.input_scene_file, 'r') as f:
-    scene_data = json.load(f)
-    all_scenes = scene_data['scenes']
-    scene_info = scene_data['info']
+  # Read file containing input scenes, or open the scene store
+  scene_info, all_scenes = scene_store.load_scenes(args.input_scene_file)
   begin = args.scene_start_idx
+  end = len(all_scenes)
   if args.num_scenes > 0:
-    end = args.scene_start_idx + args.num_scenes
-    all_scenes = all_scenes[begin:end]
-  else:
-    all_scenes = all_scenes[begin:]
+    end = min(end, begin + args.num_scenes)
+  num_scenes = max(end - begin, 0)
+
+  def input_scenes():
+    # Scenes of a store are decoded one at a time and not kept around
+    for k in range(begin, end):
+      yield all_scenes[k]
 
 
 
@@ -780,13 +805,24 @@ def main(args):
       synonyms = json.load(f)
     questions = []
     scene_count = 0
-    for i, scene in enumerate(all_scenes):
+    count_block = None
+    for i, scene in enumerate(input_scenes()):
       scene_fn = scene['image_filename']
       scene_struct = scene
       print('starting image %s (%d / %d)'
-            % (scene_fn, i + 1, len(all_scenes)))
-
-      if scene_count % args.reset_counts_every == 0:
+            % (scene_fn, i + 1, num_scenes))
+      image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
+
+      if args.seed is not None:
+        # Reset at block boundaries of the image index rather than of the
+        # position in this run, so that results do not depend on the start
+        block = image_index // args.reset_counts_every
+        if block != count_block:
+          print('resetting counts')
+          template_counts, template_answer_counts = reset_counts()
+          count_block = block
+        seed_scene(args.seed, image_index)
+      elif scene_count % args.reset_counts_every == 0:
         print('resetting counts')
         template_counts, template_answer_counts = reset_counts()
       scene_count += 1
@@ -814,7 +850,6 @@ def main(args):
         if args.time_dfs and args.verbose:
           toc = time.time()
           print('that took ', toc - tic)
-        image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
         for t, q, a in zip(ts, qs, ans):
           questions.append({
             'split': scene_info['split'],
@@ -846,12 +881,23 @@ def main(args):
       synonyms = json.load(f)
     questions = []
     scene_count = 0
-    for i, scene in enumerate(all_scenes):
+    count_block = None
+    for i, scene in enumerate(input_scenes()):
       scene_fn = scene['image_filename']
       scene_struct = scene
-      print('starting image %s (%d / %d)' % (scene_fn, i + 1, len(all_scenes)))
-
-      if scene_count % args.reset_counts_every == 0:
+      print('starting image %s (%d / %d)' % (scene_fn, i + 1, num_scenes))
+      image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
+
+      if args.seed is not None:
+        # Reset at block boundaries of the image index rather than of the
+        # position in this run, so that results do not depend on the start
+        block = image_index // args.reset_counts_every
+        if block != count_block:
+          print('resetting counts')
+          template_counts, template_answer_counts = reset_counts()
+          count_block = block
+        seed_scene(args.seed, image_index)
+      elif scene_count % args.reset_counts_every == 0:
         print('resetting counts')
         template_counts, template_answer_counts = reset_counts()
       scene_count += 1
@@ -900,8 +946,6 @@ def main(args):
           toc = time.time()
           print('that took ', toc - tic)
 
-        image_index = int(os.path.splitext(scene_fn)[0].split('_')[-1])
-
         for t, q, a in zip(ts, qs, ans):
           questions.append({
             'split': scene_info['split'],